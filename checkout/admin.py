@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Transaction, Subscription
+from .models import Transaction, Subscription, WebhookEvent
 
 
 # Register your models here.
@@ -8,11 +8,20 @@ class SubscriptionAdmin(admin.ModelAdmin):
     list_display = (
         'user', 'user_email', 'stripe_customer_id', 'stripe_subscription_id', 'paid_amount', 'active', 'start_date',
         'end_date',)
+    list_filter = ('active',)
 
 
 class TransactionAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'currency', 'amount', 'status', 'gateway', 'create_at', 'update_at',)
+    list_filter = ('status',)
+
+
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('id', 'event_id', 'type', 'status', 'received_at', 'processed_at',)
+    list_filter = ('status', 'type',)
+    search_fields = ('event_id',)
 
 
 admin.site.register(Transaction, TransactionAdmin)
 admin.site.register(Subscription, SubscriptionAdmin)
+admin.site.register(WebhookEvent, WebhookEventAdmin)
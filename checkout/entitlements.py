@@ -0,0 +1,89 @@
+"""
+User levels resolved from their Stripe subscriptions.
+
+A user's level is the highest level, by SUBSCRIPTION_PRICE_LEVELS, of the
+prices of their active, unexpired subscriptions, by user or by email, and
+ENTITLEMENT_DEFAULT_LEVEL without one. It is cached per user, so checking it
+costs no query, until a subscription of theirs changes or ends.
+"""
+import logging
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Subscription
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "checkout:entitlement"
+
+
+def entitlement_key(user_id):
+    return f"{KEY_PREFIX}:{user_id}"
+
+
+def price_level(price_id):
+    return settings.SUBSCRIPTION_PRICE_LEVELS.get(price_id, settings.ENTITLEMENT_DEFAULT_LEVEL)
+
+
+def load_level(user):
+    """
+    The user's level and the number of seconds it holds for: until the
+    first of the subscriptions it comes from ends, at most ENTITLEMENT_CACHE_TTL.
+    """
+    now = timezone.now()
+    owner = Q(user=user)
+    if user.email:
+        owner |= Q(user_email=user.email)
+    subscriptions = Subscription.objects.filter(owner, Q(end_date=None) | Q(end_date__gt=now), active=True)
+
+    level = settings.ENTITLEMENT_DEFAULT_LEVEL
+    timeout = settings.ENTITLEMENT_CACHE_TTL
+    for price_id, end_date in subscriptions.values_list("stripe_price_id", "end_date"):
+        level = max(level, price_level(price_id))
+        if end_date is not None:
+            timeout = min(timeout, (end_date - now).total_seconds())
+    return level, max(int(timeout), 1)
+
+
+def resolve_level(user):
+    """The level of a signed-in user, from the cache or their subscriptions."""
+    key = entitlement_key(user.pk)
+    try:
+        level = cache.get(key)
+    except Exception as e:
+        logger.warning("Entitlement cache unavailable: %s", e)
+        return load_level(user)[0]
+    if level is None:
+        level, timeout = load_level(user)
+        try:
+            cache.set(key, level, timeout)
+        except Exception as e:
+            logger.warning("Entitlement cache unavailable: %s", e)
+    return level
+
+
+def invalidate_entitlements(subscriptions):
+    """
+    Drop the cached levels of the users of the given subscriptions, once the
+    transaction that changed them commits, so they are resolved again.
+    """
+    user_ids = {subscription.user_id for subscription in subscriptions if subscription.user_id}
+    emails = {subscription.user_email for subscription in subscriptions if subscription.user_email}
+    if emails:
+        user_ids.update(get_user_model().objects.filter(email__in=emails).values_list("pk", flat=True))
+    if not user_ids:
+        return
+
+    def invalidate():
+        try:
+            cache.delete_many([entitlement_key(user_id) for user_id in user_ids])
+        except Exception as e:
+            # The levels are resolved again after ENTITLEMENT_CACHE_TTL seconds anyway
+            logger.warning("Entitlement cache unavailable: %s", e)
+
+    transaction.on_commit(invalidate)
@@ -0,0 +1,56 @@
+# Generated by Django 5.0.3 on 2026-10-17 22:18
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Subscription',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_email', models.EmailField(blank=True, max_length=254, null=True, verbose_name='Email')),
+                ('stripe_subscription_id', models.CharField(blank=True, max_length=100, null=True, unique=True, verbose_name='Subscription ID')),
+                ('stripe_customer_id', models.CharField(blank=True, max_length=100, null=True, verbose_name='Customer ID')),
+                ('stripe_price_id', models.CharField(blank=True, max_length=100, null=True, verbose_name='Price ID')),
+                ('paid_amount', models.DecimalField(blank=True, decimal_places=2, error_messages={'name': {'max_length': 'the amount must be between 0 and 99999.99'}}, help_text='format : maximum amount 99999.99', max_digits=9, null=True, verbose_name='Paid Amount')),
+                ('active', models.BooleanField(default=True, verbose_name='Activate')),
+                ('start_date', models.DateTimeField(blank=True, null=True, verbose_name='Start Date')),
+                ('end_date', models.DateTimeField(blank=True, null=True, verbose_name='End Date')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='user_subscriptions', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Subscription',
+                'verbose_name_plural': 'Subscriptions',
+                'ordering': ['-start_date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Transaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payment_id', models.CharField(blank=True, max_length=255, null=True, unique=True)),
+                ('currency', models.CharField(blank=True, max_length=255, null=True)),
+                ('amount', models.DecimalField(blank=True, decimal_places=2, error_messages={'name': {'max_length': 'the amount must be between 0 and 99999.99'}}, help_text='format : maximum amount 99999.99', max_digits=9, null=True, verbose_name='amount have to pay')),
+                ('status', models.CharField(blank=True, choices=[('PENDING', 'Pending'), ('COMPLETED', 'Completed'), ('CANCELLED', 'Cancelled')], default='PENDING', max_length=255, null=True, verbose_name='payment status')),
+                ('gateway', models.CharField(help_text='format : credit,debit,mastercard,paypal...etc', max_length=255, verbose_name='payment method')),
+                ('create_at', models.DateTimeField(auto_now_add=True, help_text='format : y-m-d H:M:S', verbose_name='date payment created')),
+                ('update_at', models.DateTimeField(auto_now=True, help_text='format : y-m-d H:M:S', verbose_name='date payment last updated')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='user_transactions', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Transaction',
+                'verbose_name_plural': 'Transactions',
+                'ordering': ['-create_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.3 on 2026-10-17 22:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0002_webhookevent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='webhookevent',
+            name='event_id',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True, verbose_name='Event ID'),
+        ),
+        migrations.AddIndex(
+            model_name='webhookevent',
+            index=models.Index(fields=['received_at'], name='webhook_event_received_idx'),
+        ),
+    ]
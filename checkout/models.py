@@ -57,6 +57,11 @@ class Subscription(models.Model):
         verbose_name = _("Subscription")
         verbose_name_plural = _("Subscriptions")
         ordering = ["-start_date"]
+        indexes = [
+            # Active subscriptions of a user, by email or by user, for resolving their level
+            models.Index(fields=["user_email", "active", "end_date"], name="subscription_email_active_idx"),
+            models.Index(fields=["user", "active", "end_date"], name="subscription_user_active_idx"),
+        ]
 
     def __str__(self):
         return f"{self.id} - {self.user_email} - {self.stripe_subscription_id}"
@@ -116,6 +121,57 @@ class Transaction(models.Model):
         verbose_name = _("Transaction")
         verbose_name_plural = _("Transactions")
         ordering = ["-create_at"]
+        indexes = [
+            # Transactions of a user, and transactions by status, newest first
+            models.Index(fields=["user", "-create_at"], name="transaction_user_created_idx"),
+            models.Index(fields=["status", "-create_at"], name="transaction_status_created_idx"),
+        ]
 
     def __str__(self):
         return f"{self.id} - {self.user} : {self.payment_id}"
+
+
+class WebhookEvent(models.Model):
+    """
+    A Stripe webhook event as received, kept in an inbox until a Celery
+    consumer applies it to the Transactions and Subscriptions. Stripe may
+    deliver an event more than once; the unique event_id keeps only the first
+    delivery. Handled events are deleted after WEBHOOK_EVENT_RETENTION.
+    """
+    class StatusChoices(models.TextChoices):
+        PENDING = 'PENDING', _('Pending')
+        PROCESSED = 'PROCESSED', _('Processed')
+        FAILED = 'FAILED', _('Failed')
+
+    event_id = models.CharField(max_length=255, unique=True, null=True, blank=True, verbose_name=_("Event ID"))
+    type = models.CharField(max_length=255, verbose_name=_("Event Type"))
+    payload = models.JSONField(verbose_name=_("Payload"))
+    status = models.CharField(
+        max_length=20, verbose_name=_("processing status"),
+        choices=StatusChoices, default=StatusChoices.PENDING,
+    )
+    error = models.TextField(blank=True, default="", verbose_name=_("Error"))
+    received_at = models.DateTimeField(
+        auto_now_add=True,
+        editable=False,
+        verbose_name=_("date event received"),
+        help_text=_("format : y-m-d H:M:S")
+    )
+    processed_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name=_("date event processed"),
+        help_text=_("format : y-m-d H:M:S")
+    )
+
+    class Meta:
+        verbose_name = _("Webhook Event")
+        verbose_name_plural = _("Webhook Events")
+        ordering = ["-received_at"]
+        indexes = [
+            models.Index(fields=["status", "id"], name="webhook_event_status_idx"),
+            models.Index(fields=["received_at"], name="webhook_event_received_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.id} - {self.type} : {self.event_id}"
@@ -0,0 +1,155 @@
+"""
+Reuse of open Checkout sessions.
+
+Double clicks and client retries ask for the same Checkout session again. A
+new session is cached for CHECKOUT_SESSION_CACHE_TTL seconds under its
+request, (client, currency, title, amount) or (email, price_id), where the
+client is the signed-in user or the browser session, and identical requests
+get its URL instead of a new session and Transaction. Identical requests that
+arrive while it is being created wait for it rather than create their own:
+the first takes a lock with cache.add, for longer than the Stripe client can
+take to create it, and the others poll the cache. A session is forgotten once
+it is completed.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "checkout:session"
+POLL_INTERVAL = 0.05
+
+
+def session_key(*parts):
+    digest = hashlib.sha256("\0".join(str(part) for part in parts).encode("utf-8"))
+    return f"{KEY_PREFIX}:{digest.hexdigest()}"
+
+
+def payment_session_key(client, currency, title, amount):
+    # Requests of unidentified clients are never identical
+    if client is None:
+        return None
+    return session_key("payment", client, currency, title, amount)
+
+
+def subscription_session_key(email, price_id):
+    return session_key("subscription", email, price_id)
+
+
+def lock_key(key):
+    return f"{key}:lock"
+
+
+def index_key(session_id):
+    # Maps a session back to its cache entry, to forget it when it is completed
+    return f"{KEY_PREFIX}:id:{session_id}"
+
+
+def session_data(session):
+    return {"id": session.id, "url": session.url}
+
+
+def cached_entries(key, session):
+    return {key: session, index_key(session["id"]): key}
+
+
+def cache_session(key, session):
+    try:
+        cache.set_many(cached_entries(key, session), settings.CHECKOUT_SESSION_CACHE_TTL)
+    except Exception as e:
+        logger.warning("Checkout session cache unavailable: %s", e)
+
+
+async def acache_session(key, session):
+    try:
+        await cache.aset_many(cached_entries(key, session), settings.CHECKOUT_SESSION_CACHE_TTL)
+    except Exception as e:
+        logger.warning("Checkout session cache unavailable: %s", e)
+
+
+def get_or_create_session(key, create):
+    """
+    The {"id", "url"} of the cached Checkout session for key, or of the one
+    create() makes and returns, which is then cached. Errors of create() are
+    raised. If the cache is down, or key is None, every request creates its
+    own session.
+    """
+    if key is None:
+        return session_data(create())
+    timeout = settings.CHECKOUT_SESSION_LOCK_TIMEOUT
+    while True:
+        try:
+            session = cache.get(key)
+            locked = session is None and cache.add(lock_key(key), True, timeout=timeout)
+        except Exception as e:
+            logger.warning("Checkout session cache unavailable: %s", e)
+            return session_data(create())
+
+        if session is not None:
+            return session
+        if locked:
+            try:
+                session = session_data(create())
+                cache_session(key, session)
+                return session
+            finally:
+                release_lock(key)
+        # An identical request is creating the session, or failed to and released the lock
+        time.sleep(POLL_INTERVAL)
+
+
+async def aget_or_create_session(key, create):
+    """Async version of get_or_create_session, for an async create()."""
+    if key is None:
+        return session_data(await create())
+    timeout = settings.CHECKOUT_SESSION_LOCK_TIMEOUT
+    while True:
+        try:
+            session = await cache.aget(key)
+            locked = session is None and await cache.aadd(lock_key(key), True, timeout=timeout)
+        except Exception as e:
+            logger.warning("Checkout session cache unavailable: %s", e)
+            return session_data(await create())
+
+        if session is not None:
+            return session
+        if locked:
+            try:
+                session = session_data(await create())
+                await acache_session(key, session)
+                return session
+            finally:
+                await arelease_lock(key)
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+def release_lock(key):
+    try:
+        cache.delete(lock_key(key))
+    except Exception as e:
+        # The lock expires after CHECKOUT_SESSION_LOCK_TIMEOUT seconds anyway
+        logger.warning("Checkout session cache unavailable: %s", e)
+
+
+async def arelease_lock(key):
+    try:
+        await cache.adelete(lock_key(key))
+    except Exception as e:
+        logger.warning("Checkout session cache unavailable: %s", e)
+
+
+def forget_sessions(session_ids):
+    """Stop reusing the given Checkout sessions, e.g. once they are completed."""
+    index_keys = [index_key(session_id) for session_id in session_ids]
+    if not index_keys:
+        return
+    try:
+        keys = cache.get_many(index_keys)
+        cache.delete_many([*keys.values(), *keys])
+    except Exception as e:
+        logger.warning("Checkout session cache unavailable: %s", e)
@@ -0,0 +1,272 @@
+import asyncio
+import contextlib
+import os
+import random
+import threading
+import time
+import uuid
+import weakref
+from urllib.parse import urlencode
+
+import httpx
+import requests
+import stripe
+from django.conf import settings
+# The pinned stripe library's own request encoding and error handling, for the async client.
+# They are private, so upgrading stripe needs the AsyncStripeClient tests in checkout/tests.py
+# to pass against the new version.
+from stripe._api_requestor import _APIRequestor
+from stripe._encode import _api_encode
+
+# Responses worth retrying, unless Stripe says otherwise in Stripe-Should-Retry
+RETRY_STATUS_CODES = {409, 429, 500, 502, 503, 504}
+
+
+def is_outage(error):
+    """Whether a stripe.error exception means Stripe is failing, rather than the request."""
+    return isinstance(error, stripe.error.APIConnectionError) or (error.http_status or 0) >= 500
+
+
+class CircuitOpenError(stripe.error.APIConnectionError):
+    """Stripe requests are failing, so the request was not sent."""
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to Stripe after failure_threshold failed requests
+    in a row, so that an outage fails fast instead of holding every web
+    thread for the full timeout. After reset_timeout seconds one request is
+    let through: the circuit closes again if it succeeds.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def before_request(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if self._probing or time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError("Stripe is unavailable, the request was not sent.")
+            self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    @contextlib.contextmanager
+    def guard(self):
+        """
+        Let one request through, or raise CircuitOpenError, and record how it
+        ended. Anything but an answer from Stripe, e.g. a cancelled request,
+        counts as a failure, so a probe always ends.
+        """
+        self.before_request()
+        failed = True
+        try:
+            yield
+            failed = False
+        except stripe.error.StripeError as e:
+            failed = is_outage(e)
+            raise
+        finally:
+            if failed:
+                self.record_failure()
+            else:
+                self.record_success()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+
+class StripeClient:
+    """
+    Stripe API client for sync views: the stripe library's StripeClient, with
+    one keep-alive pool of up to max_connections connections per process.
+    Every request is bounded by connect_timeout and timeout, and connection
+    errors and retryable responses are retried up to max_network_retries
+    times with jittered exponential backoff. The library sends POST requests
+    with an idempotency key, the same for every retry, so a retried request
+    never runs twice. Failed requests count towards the circuit breaker,
+    which rejects requests while Stripe is down.
+    """
+
+    def __init__(self, api_key=None, api_base=None, timeout=30, connect_timeout=5, max_network_retries=2,
+                 max_connections=20, circuit_breaker=None):
+        self.api_key = api_key
+        self.api_base = api_base
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_network_retries = max_network_retries
+        self.max_connections = max_connections
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self._lock = threading.Lock()
+        self._stripe = None
+        self._pid = None
+
+    def _client(self):
+        # A pool created before a fork must not be shared with the child process
+        with self._lock:
+            if self._stripe is None or self._pid != os.getpid():
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._stripe = stripe.StripeClient(
+                    self.api_key or stripe.api_key,
+                    base_addresses={"api": self.api_base} if self.api_base else {},
+                    max_network_retries=self.max_network_retries,
+                    http_client=stripe.RequestsClient(timeout=(self.connect_timeout, self.timeout), session=session),
+                )
+                self._pid = os.getpid()
+            return self._stripe
+
+    def create_checkout_session(self, idempotency_key=None, **params):
+        client = self._client()
+        options = {"idempotency_key": idempotency_key} if idempotency_key else {}
+        with self.circuit_breaker.guard():
+            return client.checkout.sessions.create(params, options)
+
+    def cancel_subscription(self, subscription_id, **params):
+        client = self._client()
+        with self.circuit_breaker.guard():
+            return client.subscriptions.cancel(subscription_id, params)
+
+
+class AsyncStripeClient:
+    """
+    Stripe API client for async views. The stripe library only makes blocking
+    requests, so this client sends the requests the library would send
+    through httpx, with connections pooled per event loop, and returns the
+    same StripeObject results and stripe.error exceptions. Timeouts, retries,
+    idempotency keys and the circuit breaker work as in StripeClient.
+    """
+
+    def __init__(self, api_key=None, api_base=None, timeout=30, connect_timeout=5, max_network_retries=2,
+                 max_connections=20, initial_retry_delay=0.5, max_retry_delay=5, circuit_breaker=None,
+                 transport=None):
+        self.api_key = api_key
+        self.api_base = api_base
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.max_network_retries = max_network_retries
+        self.initial_retry_delay = initial_retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        # An httpx transport to send the requests through instead of the network, e.g. in tests
+        self.transport = transport
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(base_url=self.api_base or stripe.api_base, timeout=self.timeout,
+                                       limits=self.limits, transport=self.transport)
+            self._clients[loop] = client
+        return client
+
+    def prepare(self, method, path, params=None, idempotency_key=None):
+        """Keyword arguments of the httpx request for a Stripe API call."""
+        api_key = self.api_key or stripe.api_key
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Stripe-Version": stripe.api_version,
+            "User-Agent": f"Stripe/v1 PythonBindings/{stripe.VERSION} httpx",
+        }
+        encoded = list(_api_encode(params or {}))
+
+        if method == "post":
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+            headers["Idempotency-Key"] = idempotency_key or str(uuid.uuid4())
+            return dict(method="POST", url=path, content=urlencode(encoded), headers=headers)
+        return dict(method=method.upper(), url=path, params=encoded, headers=headers)
+
+    def should_retry(self, attempt, response, error):
+        if attempt >= self.max_network_retries:
+            return False
+        if error is not None:
+            return isinstance(error, httpx.TransportError)
+        should_retry = response.headers.get("Stripe-Should-Retry")
+        if should_retry is not None:
+            return should_retry == "true"
+        return response.status_code in RETRY_STATUS_CODES
+
+    def retry_delay(self, attempt, response):
+        delay = min(self.initial_retry_delay * 2 ** attempt, self.max_retry_delay)
+        # Jitter, so that clients failing together do not retry together
+        delay *= random.uniform(0.5, 1)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get("Retry-After", 0))
+            except ValueError:
+                retry_after = 0
+            if retry_after <= self.max_retry_delay:
+                delay = max(delay, retry_after)
+        return delay
+
+    def result(self, response, error):
+        """Return the result of the final attempt of a request, or raise its stripe.error exception."""
+        if error is not None:
+            raise stripe.error.APIConnectionError(f"Error communicating with Stripe: {error}")
+        stripe_response = _APIRequestor()._interpret_response(response.content, response.status_code,
+                                                              response.headers)
+        return stripe.util.convert_to_stripe_object(stripe_response.data, self.api_key or stripe.api_key)
+
+    async def request(self, method, path, params=None, idempotency_key=None):
+        request = self.prepare(method, path, params, idempotency_key)
+        with self.circuit_breaker.guard():
+            attempt = 0
+            while True:
+                response = error = None
+                try:
+                    response = await self._client().request(**request)
+                except httpx.HTTPError as e:
+                    error = e
+                if not self.should_retry(attempt, response, error):
+                    return self.result(response, error)
+                await asyncio.sleep(self.retry_delay(attempt, response))
+                attempt += 1
+
+    async def create_checkout_session(self, idempotency_key=None, **params):
+        return await self.request("post", "/v1/checkout/sessions", params, idempotency_key)
+
+    async def cancel_subscription(self, subscription_id, **params):
+        return await self.request("delete", f"/v1/subscriptions/{subscription_id}", params)
+
+
+def client_settings():
+    return dict(
+        api_key=settings.STRIPE_SECRET_KEY,
+        api_base=settings.STRIPE_API_BASE,
+        timeout=settings.STRIPE_TIMEOUT,
+        connect_timeout=settings.STRIPE_CONNECT_TIMEOUT,
+        max_network_retries=settings.STRIPE_MAX_NETWORK_RETRIES,
+        max_connections=settings.STRIPE_MAX_CONNECTIONS,
+        circuit_breaker=circuit_breaker,
+    )
+
+
+# Both clients call the same Stripe, so they share one circuit breaker
+circuit_breaker = CircuitBreaker(
+    failure_threshold=settings.STRIPE_CIRCUIT_FAILURE_THRESHOLD,
+    reset_timeout=settings.STRIPE_CIRCUIT_RESET_TIMEOUT,
+)
+stripe_client = StripeClient(**client_settings())
+async_stripe_client = AsyncStripeClient(**client_settings(), max_retry_delay=settings.STRIPE_MAX_RETRY_DELAY)
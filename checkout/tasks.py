@@ -0,0 +1,228 @@
+import logging
+
+import stripe
+from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .entitlements import invalidate_entitlements
+from .models import Subscription, Transaction, WebhookEvent
+from .session_cache import forget_sessions
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_SCHEDULED_KEY = "checkout:webhook_processing_scheduled"
+
+SUBSCRIPTION_FIELDS = ["active", "start_date", "end_date", "stripe_customer_id", "stripe_price_id", "paid_amount"]
+
+
+class WebhookBatch:
+    """
+    The Transactions and Subscriptions a batch of webhook events refers to,
+    loaded with one query per model. Events are applied to them in memory, in
+    the order they were received, and save() writes every change at once.
+    """
+
+    def __init__(self, payloads):
+        payment_ids = set()
+        subscription_ids = set()
+        emails = set()
+        for payload in payloads:
+            data = payload.get("data", {}).get("object", {})
+            if payload.get("type") == "checkout.session.completed":
+                payment_ids.add(data.get("id"))
+            elif payload.get("type") == "invoice.paid":
+                subscription_ids.add(data.get("subscription"))
+                emails.add(data.get("customer_email"))
+            elif payload.get("type") == "customer.subscription.deleted":
+                subscription_ids.add(data.get("id"))
+
+        self.transactions = Transaction.objects.in_bulk(payment_ids - {None}, field_name="payment_id")
+        subscriptions = Subscription.objects.filter(
+            Q(stripe_subscription_id__in=subscription_ids - {None})
+            | Q(stripe_subscription_id=None, user_email__in=emails - {None})
+        )
+        self.subscriptions = {
+            (subscription.user_email, subscription.stripe_subscription_id): subscription
+            for subscription in subscriptions
+        }
+        self.subscriptions_by_id = {
+            subscription.stripe_subscription_id: subscription
+            for subscription in subscriptions if subscription.stripe_subscription_id
+        }
+
+        self.changed_transactions = {}
+        self.changed_subscriptions = {}
+        self.new_subscriptions = []
+
+    def apply(self, event):
+        if event.type == 'checkout.session.completed':
+            self.checkout_session_completed(event.data.object)
+        elif event.type == 'invoice.paid':
+            self.invoice_paid(event.data.object)
+        elif event.type == 'customer.subscription.deleted':
+            self.subscription_deleted(event.data.object)
+
+    def checkout_session_completed(self, data):
+        transaction = self.transactions.get(data['id'])
+        if transaction is None:
+            raise Transaction.DoesNotExist(f"Transaction with payment ID {data['id']} not found in the database.")
+        transaction.status = Transaction.StatusPaymentChoices.COMPLETED
+        if not transaction.amount:
+            transaction.amount = data['amount_total'] / 100
+        self.changed_transactions[transaction.pk] = transaction
+
+    def invoice_paid(self, data):
+        customer_email = data.customer_email
+        subscription_id = data['subscription']
+        fields = {
+            "active": True,
+            "start_date": timezone.datetime.utcfromtimestamp(data.lines.data[0].period.start),
+            "end_date": timezone.datetime.utcfromtimestamp(data.lines.data[0].period.end),
+            "stripe_customer_id": data.customer,
+            "stripe_price_id": data.lines.data[0].price.id,
+            "paid_amount": data.amount_paid / 100,
+        }
+
+        # Update or create the Subscription, like update_or_create would
+        subscription = self.subscriptions_by_id.get(subscription_id) if subscription_id else None
+        if subscription is None:
+            subscription = self.subscriptions.get((customer_email, subscription_id))
+        if subscription is None:
+            subscription = Subscription(user_email=customer_email, stripe_subscription_id=subscription_id, **fields)
+            self.subscriptions[(customer_email, subscription_id)] = subscription
+            if subscription_id:
+                self.subscriptions_by_id[subscription_id] = subscription
+            self.new_subscriptions.append(subscription)
+            return
+
+        for field, value in fields.items():
+            setattr(subscription, field, value)
+        if subscription.pk is not None:
+            self.changed_subscriptions[subscription.pk] = subscription
+
+    def subscription_deleted(self, data):
+        subscription = self.subscriptions_by_id.get(data["id"])
+        if subscription is None:
+            logger.warning("Subscription with ID %s not found in the database.", data["id"])
+            return
+
+        # Mark the subscription as inactive
+        subscription.active = False
+        if subscription.pk is not None:
+            self.changed_subscriptions[subscription.pk] = subscription
+
+    def save(self):
+        if self.changed_transactions:
+            now = timezone.now()
+            # bulk_update() does not set auto_now fields
+            for changed in self.changed_transactions.values():
+                changed.update_at = now
+            Transaction.objects.bulk_update(self.changed_transactions.values(), ["status", "amount", "update_at"])
+            # Completed sessions must not be handed out again to identical checkout
+            # requests; a batch that rolls back completed none of them.
+            payment_ids = [changed.payment_id for changed in self.changed_transactions.values()]
+            transaction.on_commit(lambda: forget_sessions(payment_ids))
+        if self.changed_subscriptions:
+            Subscription.objects.bulk_update(self.changed_subscriptions.values(), SUBSCRIPTION_FIELDS)
+        if self.new_subscriptions:
+            Subscription.objects.bulk_create(self.new_subscriptions)
+        # The levels of their users change with them
+        invalidate_entitlements([*self.changed_subscriptions.values(), *self.new_subscriptions])
+
+
+def apply_webhook_events(events):
+    """Apply inbox events as one batch, marking each as processed, or as failed with the error."""
+    batch = WebhookBatch([event.payload for event in events])
+    now = timezone.now()
+    for event in events:
+        try:
+            batch.apply(stripe.Event.construct_from(event.payload, stripe.api_key))
+            event.status = WebhookEvent.StatusChoices.PROCESSED
+            event.error = ""
+        except Exception as e:
+            logger.exception("Webhook event %s (%s) failed", event.event_id, event.type)
+            event.status = WebhookEvent.StatusChoices.FAILED
+            event.error = str(e)
+        event.processed_at = now
+
+    batch.save()
+    WebhookEvent.objects.bulk_update(events, ["status", "error", "processed_at"])
+
+
+def process_webhook_batch(events):
+    """
+    Apply a batch of inbox events. If saving the batch fails, e.g. on a
+    constraint violation, its changes are rolled back and its events are
+    applied one at a time instead, so the event that cannot be saved is
+    marked as failed with the error, instead of staying pending and blocking
+    the inbox.
+    """
+    try:
+        with transaction.atomic():
+            apply_webhook_events(events)
+        return
+    except Exception as e:
+        if len(events) > 1:
+            logger.exception("Saving a batch of %d webhook events failed, applying them one at a time", len(events))
+            for event in events:
+                process_webhook_batch([event])
+            return
+        logger.exception("Saving webhook event %s (%s) failed", events[0].event_id, events[0].type)
+        error = e
+
+    event = events[0]
+    event.status = WebhookEvent.StatusChoices.FAILED
+    event.error = str(error)
+    event.processed_at = timezone.now()
+    event.save(update_fields=["status", "error", "processed_at"])
+
+
+@shared_task
+def process_webhook_events():
+    """
+    Apply the pending webhook events of the inbox, oldest first, in batches of
+    WEBHOOK_BATCH_SIZE. Returns the number of events processed.
+    """
+    processed = 0
+    while True:
+        with transaction.atomic():
+            # Concurrent consumers skip the events another one has locked
+            events = list(
+                WebhookEvent.objects.select_for_update(skip_locked=True)
+                .filter(status=WebhookEvent.StatusChoices.PENDING)
+                .order_by("id")[:settings.WEBHOOK_BATCH_SIZE]
+            )
+            if not events:
+                return processed
+            process_webhook_batch(events)
+        processed += len(events)
+
+
+@shared_task
+def purge_webhook_events(batch_size=1000):
+    """
+    Delete processed and failed webhook events received more than
+    WEBHOOK_EVENT_RETENTION seconds ago, a batch at a time. Returns how many
+    were deleted. Redeliveries of an event are only skipped while it is kept.
+    """
+    cutoff = timezone.now() - timezone.timedelta(seconds=settings.WEBHOOK_EVENT_RETENTION)
+    expired = WebhookEvent.objects.filter(received_at__lt=cutoff).exclude(status=WebhookEvent.StatusChoices.PENDING)
+    deleted = 0
+    while True:
+        ids = list(expired.values_list("id", flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += WebhookEvent.objects.filter(id__in=ids).delete()[0]
+
+
+def schedule_webhook_processing():
+    """
+    Run process_webhook_events shortly. Events received within
+    WEBHOOK_BATCH_DELAY seconds of each other are processed as one batch.
+    """
+    if cache.add(WEBHOOK_SCHEDULED_KEY, True, timeout=settings.WEBHOOK_BATCH_DELAY):
+        process_webhook_events.apply_async(countdown=settings.WEBHOOK_BATCH_DELAY)
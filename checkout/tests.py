@@ -1,3 +1,356 @@
-from django.test import TestCase
+import asyncio
+import datetime
+from unittest import mock
+from urllib.parse import parse_qs
 
-# Create your tests here.
+import httpx
+import stripe
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from core.db_routers import PrimaryReplicaRouter, replica_reads, replica_reads_middleware, use_primary
+
+from .entitlements import invalidate_entitlements, load_level, resolve_level
+from .models import Subscription, Transaction, WebhookEvent
+from .session_cache import cache_session
+from .stripe_client import AsyncStripeClient, CircuitBreaker, CircuitOpenError
+from .tasks import process_webhook_events
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def open_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        return breaker
+
+    def test_client_errors_do_not_open_the_circuit(self):
+        breaker = CircuitBreaker(failure_threshold=1)
+        with self.assertRaises(stripe.error.InvalidRequestError):
+            with breaker.guard():
+                raise stripe.error.InvalidRequestError("No such price", "price", http_status=400)
+        self.assertFalse(breaker.is_open)
+
+        with self.assertRaises(stripe.error.APIError):
+            with breaker.guard():
+                raise stripe.error.APIError("Server error", http_status=500)
+        self.assertTrue(breaker.is_open)
+
+    def test_successful_probe_closes_the_circuit(self):
+        breaker = self.open_breaker()
+        with breaker.guard():
+            pass
+        self.assertFalse(breaker.is_open)
+
+    def test_failed_probe_is_always_recorded(self):
+        for error in (RuntimeError("unexpected"), asyncio.CancelledError()):
+            breaker = self.open_breaker()
+            with self.assertRaises(type(error)):
+                with breaker.guard():
+                    raise error
+            # The probe ended, so the next request after reset_timeout is let through again
+            self.assertTrue(breaker.is_open)
+            with breaker.guard():
+                pass
+            self.assertFalse(breaker.is_open)
+
+    def test_requests_fail_fast_while_probing(self):
+        breaker = self.open_breaker()
+        with breaker.guard():
+            with self.assertRaises(CircuitOpenError):
+                with breaker.guard():
+                    pass
+
+
+class AsyncStripeClientTests(SimpleTestCase):
+    def stripe_client(self, *responses):
+        self.requests = []
+        responses = iter(responses)
+
+        def handle(request):
+            self.requests.append(request)
+            return next(responses)
+
+        return AsyncStripeClient(api_key="sk_test_1", api_base="https://stripe.test", initial_retry_delay=0,
+                                 circuit_breaker=CircuitBreaker(failure_threshold=10),
+                                 transport=httpx.MockTransport(handle))
+
+    def test_requests_are_encoded_like_the_stripe_library(self):
+        client = self.stripe_client(httpx.Response(200, json={"id": "cs_1", "object": "checkout.session", "url": "u"}))
+        session = asyncio.run(client.create_checkout_session(
+            mode="payment", line_items=[{"price": "price_1", "quantity": 2}], metadata={"title": "Credits"},
+        ))
+
+        self.assertIsInstance(session, stripe.checkout.Session)
+        self.assertEqual((session.id, session.url), ("cs_1", "u"))
+        request, = self.requests
+        self.assertEqual((request.method, str(request.url)), ("POST", "https://stripe.test/v1/checkout/sessions"))
+        self.assertEqual(request.headers["Authorization"], "Bearer sk_test_1")
+        self.assertEqual(request.headers["Stripe-Version"], stripe.api_version)
+        self.assertEqual(parse_qs(request.content.decode()), {
+            "mode": ["payment"],
+            "line_items[0][price]": ["price_1"],
+            "line_items[0][quantity]": ["2"],
+            "metadata[title]": ["Credits"],
+        })
+
+    def test_failed_requests_are_retried_with_the_same_idempotency_key(self):
+        client = self.stripe_client(httpx.Response(503, json={"error": {"message": "Unavailable"}}),
+                             httpx.Response(200, json={"id": "sub_1", "object": "subscription", "status": "canceled"}))
+        subscription = asyncio.run(client.cancel_subscription("sub_1"))
+
+        self.assertEqual(subscription.status, "canceled")
+        self.assertEqual([request.method for request in self.requests], ["DELETE", "DELETE"])
+
+        client = self.stripe_client(httpx.Response(500, json={"error": {"message": "Error"}}),
+                             httpx.Response(200, json={"id": "cs_1", "object": "checkout.session"}))
+        asyncio.run(client.create_checkout_session(mode="payment"))
+        first, second = self.requests
+        self.assertEqual(first.headers["Idempotency-Key"], second.headers["Idempotency-Key"])
+
+    def test_errors_raise_the_stripe_library_exceptions(self):
+        client = self.stripe_client(httpx.Response(400, json={"error": {"message": "No such price", "param": "price"}}))
+        with self.assertRaises(stripe.error.InvalidRequestError) as raised:
+            asyncio.run(client.create_checkout_session(mode="payment"))
+        self.assertEqual((raised.exception.http_status, raised.exception.param), (400, "price"))
+        self.assertEqual(len(self.requests), 1)
+
+
+def session_completed(event_id, payment_id, amount_total=500):
+    return {
+        "id": event_id,
+        "type": "checkout.session.completed",
+        "data": {"object": {"id": payment_id, "amount_total": amount_total}},
+    }
+
+
+def invoice_paid(event_id, subscription_id, email):
+    return {
+        "id": event_id,
+        "type": "invoice.paid",
+        "data": {"object": {
+            "subscription": subscription_id,
+            "customer": "cus_1",
+            "customer_email": email,
+            "amount_paid": 900,
+            "lines": {"data": [{"period": {"start": 1700000000, "end": 1702592000}, "price": {"id": "price_1"}}]},
+        }},
+    }
+
+
+def subscription_deleted(event_id, subscription_id):
+    return {
+        "id": event_id,
+        "type": "customer.subscription.deleted",
+        "data": {"object": {"id": subscription_id}},
+    }
+
+
+class WebhookInboxTests(TestCase):
+    def receive(self, *payloads):
+        WebhookEvent.objects.bulk_create(
+            [WebhookEvent(event_id=payload["id"], type=payload["type"], payload=payload) for payload in payloads]
+        )
+
+    def statuses(self):
+        return dict(WebhookEvent.objects.values_list("event_id", "status"))
+
+    def test_batch_is_applied(self):
+        Transaction.objects.create(payment_id="cs_1", gateway="stripe")
+        Subscription.objects.create(user_email="old@example.com", stripe_subscription_id="sub_old")
+        self.receive(
+            session_completed("evt_1", "cs_1"),
+            invoice_paid("evt_2", "sub_1", "new@example.com"),
+            subscription_deleted("evt_3", "sub_old"),
+        )
+
+        with self.settings(WEBHOOK_BATCH_SIZE=10):
+            self.assertEqual(process_webhook_events(), 3)
+
+        transaction = Transaction.objects.get(payment_id="cs_1")
+        self.assertEqual(transaction.status, Transaction.StatusPaymentChoices.COMPLETED)
+        self.assertEqual(transaction.amount, 5)
+        subscription = Subscription.objects.get(stripe_subscription_id="sub_1")
+        self.assertEqual((subscription.user_email, subscription.stripe_price_id), ("new@example.com", "price_1"))
+        self.assertFalse(Subscription.objects.get(stripe_subscription_id="sub_old").active)
+        self.assertEqual(set(self.statuses().values()), {WebhookEvent.StatusChoices.PROCESSED})
+        self.assertEqual(process_webhook_events(), 0)
+
+    @mock.patch("checkout.views.schedule_webhook_processing")
+    def test_redelivered_event_is_stored_and_applied_once(self, schedule_webhook_processing):
+        Transaction.objects.create(payment_id="cs_1", gateway="stripe")
+        client = APIClient()
+        for _ in range(2):
+            response = client.post("/api/checkout/webhook/", session_completed("evt_1", "cs_1"), format="json")
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+        self.assertEqual(process_webhook_events(), 1)
+        self.assertEqual(self.statuses(), {"evt_1": WebhookEvent.StatusChoices.PROCESSED})
+
+    def test_failed_event_does_not_block_the_inbox(self):
+        Transaction.objects.create(payment_id="cs_1", gateway="stripe")
+        Transaction.objects.create(payment_id="cs_2", gateway="stripe")
+        self.receive(
+            session_completed("evt_1", "cs_1"),
+            # Fails to apply: no such transaction
+            session_completed("evt_2", "cs_missing"),
+            # Applies, but fails to save: the amount does not fit the column
+            session_completed("evt_3", "cs_2", amount_total=10 ** 12),
+        )
+
+        with self.settings(WEBHOOK_BATCH_SIZE=10):
+            self.assertEqual(process_webhook_events(), 3)
+
+        self.assertEqual(self.statuses(), {
+            "evt_1": WebhookEvent.StatusChoices.PROCESSED,
+            "evt_2": WebhookEvent.StatusChoices.FAILED,
+            "evt_3": WebhookEvent.StatusChoices.FAILED,
+        })
+        self.assertIn("cs_missing", WebhookEvent.objects.get(event_id="evt_2").error)
+        self.assertNotEqual(WebhookEvent.objects.get(event_id="evt_3").error, "")
+        self.assertEqual(Transaction.objects.get(payment_id="cs_1").status, Transaction.StatusPaymentChoices.COMPLETED)
+        self.assertEqual(Transaction.objects.get(payment_id="cs_2").status, Transaction.StatusPaymentChoices.PENDING)
+        self.assertEqual(process_webhook_events(), 0)
+
+    def test_completed_sessions_are_forgotten_once_committed(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        Transaction.objects.create(payment_id="cs_1", gateway="stripe")
+        cache_session("checkout:session:1", {"id": "cs_1", "url": "https://checkout/1"})
+        self.receive(session_completed("evt_1", "cs_1"))
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertEqual(process_webhook_events(), 1)
+        self.assertIsNotNone(cache.get("checkout:session:1"))
+        for callback in callbacks:
+            callback()
+        self.assertIsNone(cache.get("checkout:session:1"))
+
+
+class CheckoutSessionReuseTests(TestCase):
+    url = "/api/checkout/session/"
+    body = {"currency": "usd", "title": "Credits", "amount": "5.00"}
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        sessions = (stripe.util.convert_to_stripe_object({"id": f"cs_{n}", "url": f"https://checkout/{n}"})
+                    for n in range(100))
+        patcher = mock.patch("checkout.views.stripe_client.create_checkout_session",
+                             side_effect=lambda **params: next(sessions))
+        self.create_checkout_session = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, client):
+        response = client.post(self.url, self.body, format="json")
+        self.assertEqual(response.status_code, 200)
+        return response.json()["url"]
+
+    def test_identical_requests_of_a_user_reuse_the_session(self):
+        client = APIClient()
+        client.force_login(get_user_model().objects.create_user("alice"))
+        self.assertEqual(self.post(client), self.post(client))
+        self.assertEqual(self.create_checkout_session.call_count, 1)
+
+        other = APIClient()
+        other.force_login(get_user_model().objects.create_user("bob"))
+        self.assertNotEqual(self.post(other), self.post(client))
+
+    def test_clients_without_a_session_share_nothing(self):
+        # Both come from the same address, e.g. behind one NAT
+        self.assertNotEqual(self.post(APIClient()), self.post(APIClient()))
+        self.assertEqual(self.create_checkout_session.call_count, 2)
+
+
+@override_settings(SUBSCRIPTION_PRICE_LEVELS={"price_1": 2, "price_pro": 4}, ENTITLEMENT_DEFAULT_LEVEL=0)
+class EntitlementTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = get_user_model().objects.create_user("alice", email="alice@example.com")
+
+    def test_level_is_resolved_once_from_active_subscriptions(self):
+        yesterday = timezone.now() - datetime.timedelta(days=1)
+        Subscription.objects.create(user=self.user, stripe_price_id="price_1")
+        Subscription.objects.create(user_email="alice@example.com", stripe_price_id="price_pro", end_date=yesterday)
+        Subscription.objects.create(user=self.user, stripe_price_id="price_pro", active=False)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(resolve_level(self.user), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_level(self.user), 2)
+
+    def test_level_is_cached_until_its_subscription_ends(self):
+        self.assertEqual(load_level(self.user), (0, 60 * 60))
+        end_date = timezone.now() + datetime.timedelta(minutes=5)
+        Subscription.objects.create(user_email="alice@example.com", stripe_price_id="price_pro", end_date=end_date)
+        level, timeout = load_level(self.user)
+        self.assertEqual(level, 4)
+        self.assertTrue(290 <= timeout <= 300)
+
+    def test_changed_subscriptions_drop_the_cached_level(self):
+        Subscription.objects.create(user=self.user, stripe_subscription_id="sub_pro", stripe_price_id="price_pro")
+        self.assertEqual(resolve_level(self.user), 4)
+
+        payload = subscription_deleted("evt_1", "sub_pro")
+        WebhookEvent.objects.create(event_id=payload["id"], type=payload["type"], payload=payload)
+        with self.captureOnCommitCallbacks(execute=True):
+            process_webhook_events()
+        self.assertEqual(resolve_level(self.user), 0)
+
+        # Subscriptions of the user's email count too
+        subscription = Subscription.objects.create(user_email="alice@example.com", stripe_price_id="price_1")
+        self.assertEqual(resolve_level(self.user), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_entitlements([subscription])
+        self.assertEqual(resolve_level(self.user), 2)
+
+
+@override_settings(DATABASE_REPLICAS=["replica_1"])
+class ReplicaRouterTests(SimpleTestCase):
+    router = PrimaryReplicaRouter()
+
+    def read_database(self, model=Transaction):
+        return self.router.db_for_read(model)
+
+    def test_reads_go_to_the_primary_by_default(self):
+        self.assertEqual(self.read_database(), "default")
+        with use_primary():
+            self.assertEqual(self.read_database(), "default")
+        with override_settings(DATABASE_REPLICAS=[]), replica_reads():
+            self.assertEqual(self.read_database(), "default")
+
+    def test_replica_reads_until_a_write(self):
+        with replica_reads():
+            self.assertEqual(self.read_database(), "replica_1")
+            self.assertEqual(self.read_database(Session), "default")
+            with use_primary():
+                self.assertEqual(self.read_database(), "default")
+            self.assertEqual(self.read_database(), "replica_1")
+
+            self.assertEqual(self.router.db_for_write(Transaction), "default")
+            self.assertEqual(self.read_database(), "default")
+        self.assertEqual(self.read_database(), "default")
+
+    def test_only_the_primary_is_migrated(self):
+        self.assertTrue(self.router.allow_migrate("default", "checkout"))
+        self.assertFalse(self.router.allow_migrate("replica_1", "checkout"))
+
+    def test_middleware_reads_safe_requests_from_the_replicas(self):
+        def get_response(request):
+            return self.read_database()
+
+        async def aget_response(request):
+            return self.read_database()
+
+        factory = RequestFactory()
+        for method, database in (("get", "replica_1"), ("head", "replica_1"), ("post", "default")):
+            request = getattr(factory, method)("/admin/")
+            self.assertEqual(replica_reads_middleware(get_response)(request), database)
+            self.assertEqual(asyncio.run(replica_reads_middleware(aget_response)(request)), database)
+        self.assertEqual(self.read_database(), "default")
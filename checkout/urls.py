@@ -1,5 +1,6 @@
 from django.urls import path
 from .views import CheckoutSessionView, CheckoutSubscriptionView, WebhookView,CheckoutCancelSubscriptionView
+from .views import AsyncCheckoutSessionView, AsyncCheckoutSubscriptionView, AsyncCheckoutCancelSubscriptionView
 
 app_name = 'checkout'
 
@@ -7,6 +8,10 @@ urlpatterns = [
     path('checkout/session/', CheckoutSessionView.as_view(), name='checkoutSession'),
     path('checkout/subscribe/', CheckoutSubscriptionView.as_view(), name='checkoutSubscription'),
     path('checkout/subscribe/cancel/', CheckoutCancelSubscriptionView.as_view(), name='checkoutCancelSubscription'),
+    path('checkout/async/session/', AsyncCheckoutSessionView.as_view(), name='checkoutSessionAsync'),
+    path('checkout/async/subscribe/', AsyncCheckoutSubscriptionView.as_view(), name='checkoutSubscriptionAsync'),
+    path('checkout/async/subscribe/cancel/', AsyncCheckoutCancelSubscriptionView.as_view(),
+         name='checkoutCancelSubscriptionAsync'),
     path('checkout/webhook/', WebhookView.as_view(), name='webhook')
 
 ]
@@ -1,17 +1,72 @@
 import json
+from asgiref.sync import sync_to_async
 from rest_framework import status, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from .serializers import CheckoutSessionSerializer, CheckoutSubscriptionSerializer
-from .models import Transaction, Subscription
+from .models import Transaction, Subscription, WebhookEvent
 from django.contrib.auth import get_user_model
 from django.conf import settings
 import stripe
 from decimal import Decimal
-from django.utils import timezone
+from core.async_views import AsyncAPIView
+from .entitlements import invalidate_entitlements
+from .session_cache import aget_or_create_session, get_or_create_session, payment_session_key, subscription_session_key
+from .stripe_client import async_stripe_client, stripe_client
+from .tasks import schedule_webhook_processing
+import logging
 
 stripe.api_key = settings.STRIPE_SECRET_KEY
 
+logger = logging.getLogger(__name__)
+
+
+def payment_session_params(currency, title, amount):
+    # Parameters of a one-off payment Checkout session
+    return dict(
+        mode="payment",
+        success_url=f"{settings.FRONTEND_URL}/?payment=success",
+        cancel_url=f"{settings.FRONTEND_URL}/?payment=cancel",
+        line_items=[
+            {
+                "price_data": {
+                    "currency": currency,
+                    "product_data": {
+                        "name": title,
+                    },
+                    "unit_amount": int(amount * 100),
+                },
+                "quantity": 1,
+            }
+        ],
+        billing_address_collection="required",
+    )
+
+
+def client_ident(user, session):
+    """
+    Who a checkout request is from: the signed-in user, or else the browser
+    session. Addresses are shared behind NATs and proxies, so clients with
+    neither are not identified, and get no session of another request.
+    """
+    if user.is_authenticated:
+        return f"user:{user.pk}"
+    if session.session_key:
+        return f"session:{session.session_key}"
+    return None
+
+
+def subscription_session_params(email, price_id):
+    # Parameters of a subscription Checkout session
+    return dict(
+        mode="subscription",
+        success_url=f"{settings.FRONTEND_URL}/?payment=success",
+        cancel_url=f"{settings.FRONTEND_URL}/?payment=cancel",
+        line_items=[{"price": price_id, "quantity": 1}],
+        customer_email=email,
+        payment_method_collection="always",
+    )
+
 
 class CheckoutSessionView(APIView):
     """
@@ -64,35 +119,24 @@ class CheckoutSessionView(APIView):
             title = serializer.validated_data.get('title')
             amount = serializer.validated_data.get('amount')
 
-            try:
+            def create_session():
                 # Create a new Checkout session using the Stripe API
-                session = stripe.checkout.Session.create(
-                    mode="payment",
-                    success_url=f"{settings.FRONTEND_URL}/?payment=success",
-                    cancel_url=f"{settings.FRONTEND_URL}/?payment=cancel",
-                    line_items=[
-                        {
-                            "price_data": {
-                                "currency": currency,
-                                "product_data": {
-                                    "name": title,
-                                },
-                                "unit_amount": int(amount * 100),
-                            },
-                            "quantity": 1,
-                        }
-                    ],
-                    billing_address_collection="required",
-                )
+                session = stripe_client.create_checkout_session(**payment_session_params(currency, title, amount))
                 Transaction.objects.create(
                     currency=currency,
                     amount=amount,
                     gateway="stripe",
                     payment_id=session.id
                 )
+                return session
+
+            try:
+                # Reuse the open session of an identical request, e.g. a double click
+                key = payment_session_key(client_ident(request.user, request.session), currency, title, amount)
+                session = get_or_create_session(key, create_session)
 
                 # Return the Checkout session URL to the client
-                return Response({"url": session.url})
+                return Response({"url": session["url"]})
             except ValueError as ve:
                 return Response({"error": str(ve)}, status=status.HTTP_400_BAD_REQUEST)
             except stripe.error.StripeError as se:
@@ -150,23 +194,21 @@ class CheckoutSubscriptionView(APIView):
             email = serializer.validated_data.get('email')
             price_id = serializer.validated_data.get('price_id')
 
-            try:
+            def create_session():
                 # Create a new Checkout subscription session using the Stripe API
-                session = stripe.checkout.Session.create(
-                    mode="subscription",
-                    success_url=f"{settings.FRONTEND_URL}/?payment=success",
-                    cancel_url=f"{settings.FRONTEND_URL}/?payment=cancel",
-                    line_items=[{"price": price_id, "quantity": 1}],
-                    customer_email=email,
-                    payment_method_collection="always",
-                )
+                session = stripe_client.create_checkout_session(**subscription_session_params(email, price_id))
                 Transaction.objects.create(
                     gateway="stripe",
                     payment_id=session.id
                 )
+                return session
+
+            try:
+                # Reuse the open session of an identical request, e.g. a double click
+                session = get_or_create_session(subscription_session_key(email, price_id), create_session)
 
                 # Return the Checkout subscription session URL to the client
-                return Response({"url": session.url})
+                return Response({"url": session["url"]})
             except stripe.error.StripeError as se:
                 return Response({"error": str(se)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -221,11 +263,12 @@ class CheckoutCancelSubscriptionView(APIView):
             subscription = Subscription.objects.get(stripe_subscription_id=subscription_id)
 
             # Cancel the subscription using the Stripe API
-            stripe.Subscription.cancel(subscription.stripe_subscription_id)
+            stripe_client.cancel_subscription(subscription.stripe_subscription_id)
 
             # Optionally, mark the subscription as inactive in the database or let webhook handle it
             subscription.active = False
             subscription.save()
+            invalidate_entitlements([subscription])
 
             return Response({"message": "Subscription canceled successfully."}, status=status.HTTP_200_OK)
 
@@ -237,18 +280,175 @@ class CheckoutCancelSubscriptionView(APIView):
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+class AsyncCheckoutSessionView(AsyncAPIView):
+    """
+    Async version of CheckoutSessionView, for the ASGI server.
+
+    The Stripe API is called through the async Stripe client and the
+    transaction is saved with the async ORM. Takes the same fields and
+    returns the same responses as CheckoutSessionView.
+    """
+
+    async def post(self, request):
+        """
+        Create a new Stripe Checkout session.
+
+        Returns:
+        - JsonResponse: JSON response containing the Checkout session URL.
+        """
+        request_data = await self.parse_data(request)
+        if request_data is None:
+            return self.invalid_body()
+
+        serializer = CheckoutSessionSerializer(data=request_data)
+
+        if serializer.is_valid():
+            currency = serializer.validated_data.get('currency', 'usd')
+            title = serializer.validated_data.get('title')
+            amount = serializer.validated_data.get('amount')
+
+            async def create_session():
+                # Create a new Checkout session using the Stripe API
+                session = await async_stripe_client.create_checkout_session(
+                    **payment_session_params(currency, title, amount)
+                )
+                await Transaction.objects.acreate(
+                    currency=currency,
+                    amount=amount,
+                    gateway="stripe",
+                    payment_id=session.id
+                )
+                return session
+
+            try:
+                # Reuse the open session of an identical request, e.g. a double click
+                client = client_ident(await request.auser(), request.session)
+                key = payment_session_key(client, currency, title, amount)
+                session = await aget_or_create_session(key, create_session)
+
+                # Return the Checkout session URL to the client
+                return self.response({"url": session["url"]})
+            except ValueError as ve:
+                return self.response({"error": str(ve)}, status=status.HTTP_400_BAD_REQUEST)
+            except stripe.error.StripeError as se:
+                return self.response({"error": str(se)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            except Exception as e:
+                return self.response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        else:
+            return self.response({"error": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class AsyncCheckoutSubscriptionView(AsyncAPIView):
+    """
+    Async version of CheckoutSubscriptionView, for the ASGI server.
+
+    Takes the same fields and returns the same responses as
+    CheckoutSubscriptionView.
+    """
+
+    async def post(self, request):
+        """
+        Create a new Stripe Checkout subscription session.
+
+        Returns:
+        - JsonResponse: JSON response containing the Checkout subscription session URL.
+        """
+        request_data = await self.parse_data(request)
+        if request_data is None:
+            return self.invalid_body()
+
+        serializer = CheckoutSubscriptionSerializer(data=request_data)
+
+        if serializer.is_valid():
+            email = serializer.validated_data.get('email')
+            price_id = serializer.validated_data.get('price_id')
+
+            async def create_session():
+                # Create a new Checkout subscription session using the Stripe API
+                session = await async_stripe_client.create_checkout_session(
+                    **subscription_session_params(email, price_id)
+                )
+                await Transaction.objects.acreate(
+                    gateway="stripe",
+                    payment_id=session.id
+                )
+                return session
+
+            try:
+                # Reuse the open session of an identical request, e.g. a double click
+                session = await aget_or_create_session(subscription_session_key(email, price_id), create_session)
+
+                # Return the Checkout subscription session URL to the client
+                return self.response({"url": session["url"]})
+            except stripe.error.StripeError as se:
+                return self.response({"error": str(se)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+            except Exception as e:
+                return self.response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        else:
+            return self.response({"error": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class AsyncCheckoutCancelSubscriptionView(AsyncAPIView):
+    """
+    Async version of CheckoutCancelSubscriptionView, for the ASGI server.
+
+    Takes the same payload and returns the same responses as
+    CheckoutCancelSubscriptionView.
+    """
+
+    async def post(self, request):
+        """
+        Cancel a Stripe subscription.
+
+        Returns:
+        - JsonResponse: JSON response indicating the success or failure of the subscription cancellation.
+        """
+        data = await self.parse_data(request)
+        if data is None:
+            return self.invalid_body()
+
+        subscription_id = data.get("subscription_id") if isinstance(data, dict) else None
+
+        if not subscription_id:
+            return self.response({"error": "subscription_id field is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            # Retrieve the subscription from the database
+            subscription = await Subscription.objects.aget(stripe_subscription_id=subscription_id)
+
+            # Cancel the subscription using the Stripe API
+            await async_stripe_client.cancel_subscription(subscription.stripe_subscription_id)
+
+            # Optionally, mark the subscription as inactive in the database or let webhook handle it
+            subscription.active = False
+            await subscription.asave()
+            await sync_to_async(invalidate_entitlements)([subscription])
+
+            return self.response({"message": "Subscription canceled successfully."}, status=status.HTTP_200_OK)
+
+        except stripe.error.StripeError as se:
+            return self.response({"error": str(se)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        except Subscription.DoesNotExist:
+            return self.response({"error": "Subscription not found."}, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            return self.response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 class WebhookView(APIView):
     """
     Webhook endpoint for handling Stripe events.
 
-    This view is responsible for processing Stripe webhook events,
-    such as 'checkout.session.completed' and 'invoice.paid'.
+    This view stores Stripe webhook events, such as 'checkout.session.completed'
+    and 'invoice.paid', in the WebhookEvent inbox and answers right away. The
+    events are applied to the database in batches by the
+    process_webhook_events Celery task.
 
     Permissions:
     - AllowAny: Accessible by anyone, as it's intended for Stripe to send webhook events.
 
     Methods:
-    - post: Handles incoming Stripe webhook events and updates the database accordingly.
+    - post: Stores an incoming Stripe webhook event for processing.
     """
 
     permission_classes = [permissions.AllowAny]
@@ -257,13 +457,13 @@ class WebhookView(APIView):
         """
         Handle incoming Stripe webhook events.
 
-        This method processes Stripe webhook events and updates the database based on the event type.
+        This method stores the event in the inbox and schedules its processing.
 
         Args:
         - request (Request): Django REST framework request object containing the webhook payload.
 
         Returns:
-        - Response: HTTP response indicating the success or failure of processing the webhook event.
+        - Response: HTTP response indicating whether the webhook event was accepted.
         """
 
         payload = request.data
@@ -276,56 +476,17 @@ class WebhookView(APIView):
             # Return a 400 Bad Request response if the payload cannot be parsed
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        if event.type == 'checkout.session.completed':
-            # Handle 'checkout.session.completed' event
-            data = event.data.object
-            transaction = Transaction.objects.get(payment_id=data['id'])
-            transaction.status = Transaction.StatusPaymentChoices.COMPLETED
-            if not transaction.amount:
-                transaction.amount = data['amount_total'] / 100
-            transaction.save()
-        elif event.type == 'invoice.paid':
-            # Handle 'invoice.paid' event
-            data = event.data.object
-            customer_email = data.customer_email
-            customer_id = data.customer
-            subscription_id = data['subscription']
-            price_id = data.lines.data[0].price.id
-            paid_amount = data.amount_paid
-            start_date = timezone.datetime.utcfromtimestamp(data.lines.data[0].period.start)
-            end_date = timezone.datetime.utcfromtimestamp(data.lines.data[0].period.end)
-
-            # Update or create a Subscription record in the database
-            Subscription.objects.update_or_create(
-                user_email=customer_email,
-                stripe_subscription_id=subscription_id,
-                defaults={
-                    "active": True,
-                    "start_date": start_date,
-                    "end_date": end_date,
-                    "stripe_customer_id": customer_id,
-                    "stripe_price_id": price_id,
-                    "paid_amount": paid_amount / 100,
-                }
-            )
-        elif event.type == 'customer.subscription.deleted':
-            data = event.data.object
-            subscription_id = data["id"]
+        # Stripe delivers events at least once: a redelivered event is skipped by the insert itself
+        WebhookEvent.objects.bulk_create(
+            [WebhookEvent(event_id=event.get("id") or None, type=event.get("type") or "", payload=payload)],
+            ignore_conflicts=True,
+        )
 
-            try:
-                # Attempt to get the subscription from the database
-                subscription = Subscription.objects.get(stripe_subscription_id=subscription_id)
-
-                # Mark the subscription as inactive
-                subscription.active = False
-                subscription.save()
-
-            except Subscription.DoesNotExist:
-                # Handle the case where the subscription is not found
-                print(f"Subscription with ID {subscription_id} not found in the database.")
-            except Exception as e:
-                # Handle other exceptions that might occur during the process
-                print(f"An error occurred: {str(e)}")
+        try:
+            schedule_webhook_processing()
+        except Exception as e:
+            # The event is stored, so the periodic run of process_webhook_events will pick it up
+            logger.warning("Could not schedule webhook processing: %s", e)
 
-        # Return a 200 OK response upon successful processing of the webhook event
+        # Return a 200 OK response once the event is stored
         return Response(status=status.HTTP_200_OK)
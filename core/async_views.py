@@ -0,0 +1,87 @@
+import asyncio
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from celery.exceptions import TimeoutError
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.authentication import CSRFCheck
+from rest_framework.utils.encoders import JSONEncoder
+
+
+async def await_result(result, timeout=None, interval=0.05, max_interval=0.5):
+    """
+    Wait for a Celery AsyncResult without blocking the event loop.
+
+    The result backend is polled from a worker thread, backing off from
+    interval up to max_interval seconds between polls. Raises
+    celery.exceptions.TimeoutError after timeout seconds.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while not await sync_to_async(result.ready, thread_sensitive=False)():
+        if deadline is not None and time.monotonic() >= deadline:
+            raise TimeoutError("The operation timed out.")
+        await asyncio.sleep(interval)
+        interval = min(interval * 2, max_interval)
+    return await sync_to_async(result.get, thread_sensitive=False)()
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncAPIView(View):
+    """
+    Base class for async JSON API views.
+
+    DRF's APIView cannot have async handlers, so this is the small part of it
+    the async views need: CSRF checks like APIView with SessionAuthentication,
+    a JSON or multipart request body, and JSON responses rendered the way DRF
+    renders them. Request data is still validated with the DRF serializers.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        # Like DRF's SessionAuthentication, only requests signed in by the
+        # session cookie need a CSRF token: the cookie is sent by any site
+        user = await request.auser()
+        if user.is_authenticated:
+            # Reading a form for its token may write uploaded files to disk
+            reason = await sync_to_async(self.csrf_failure, thread_sensitive=False)(request)
+            if reason:
+                return self.response({"detail": f"CSRF Failed: {reason}"}, status=403)
+        return await super().dispatch(request, *args, **kwargs)
+
+    @staticmethod
+    def csrf_failure(request):
+        """The reason the request fails the CSRF check, or None if it passes."""
+        check = CSRFCheck(lambda request: None)
+        # Populates request.META["CSRF_COOKIE"], which process_view() checks against
+        check.process_request(request)
+        return check.process_view(request, None, (), {})
+
+    @staticmethod
+    async def parse_data(request):
+        """
+        Return the request data: the decoded JSON body, or the fields and
+        files of a multipart form. Returns None if the body is not valid JSON.
+        """
+        if request.content_type == "multipart/form-data":
+            # Parsing the form may write uploaded files to disk
+            return await sync_to_async(AsyncAPIView.form_data, thread_sensitive=False)(request)
+        try:
+            return json.loads(request.body or b"{}")
+        except ValueError:
+            return None
+
+    @staticmethod
+    def form_data(request):
+        data = request.POST.dict()
+        data.update(request.FILES.dict())
+        return data
+
+    @staticmethod
+    def response(data=None, status=200, headers=None):
+        return JsonResponse(data, status=status, headers=headers, encoder=JSONEncoder, safe=False)
+
+    def invalid_body(self):
+        return self.response({"error": "The request body must be valid JSON."}, status=400)
@@ -2,9 +2,14 @@ import os
 
 from celery import Celery
 
+from .serialization import register_zmsgpack
+
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
+# Register the serializer before any message is sent or received
+register_zmsgpack()
+
 app = Celery('core')
 
 # Using a string here means the worker doesn't have to serialize
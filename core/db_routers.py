@@ -0,0 +1,74 @@
+"""
+Routing of reads to the read replicas in DATABASE_REPLICAS.
+
+Writes always go to the primary, "default". Reads go to a replica, one picked
+at random for the whole block, only inside replica_reads(), which the
+middleware enters for safe requests (GET, HEAD and OPTIONS), such as admin
+and reporting pages. Sessions are always read from the primary, so a session
+is found right after login. Everything else, like checkout and webhook
+requests, Celery tasks and management commands, reads from the primary. A
+write pins the rest of the request to the primary, so it never reads data
+older than its own writes from a lagging replica.
+"""
+import contextlib
+import contextvars
+import random
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+PRIMARY_ONLY_APPS = {"sessions"}
+
+# The replica reads go to, or None for the primary
+_replica = contextvars.ContextVar("replica", default=None)
+
+
+@contextlib.contextmanager
+def replica_reads(enabled=True):
+    """Send the reads in this block to the replicas, or to the primary if not enabled."""
+    replica = random.choice(settings.DATABASE_REPLICAS) if enabled and settings.DATABASE_REPLICAS else None
+    token = _replica.set(replica)
+    try:
+        yield
+    finally:
+        _replica.reset(token)
+
+
+def use_primary():
+    """Read from the primary in this block, e.g. data that was just written elsewhere."""
+    return replica_reads(False)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label in PRIMARY_ONLY_APPS:
+            return "default"
+        return _replica.get() or "default"
+
+    def db_for_write(self, model, **hints):
+        # Later reads must see this write
+        _replica.set(None)
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == "default"
+
+
+@sync_and_async_middleware
+def replica_reads_middleware(get_response):
+    """Read from the replicas during safe requests."""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            with replica_reads(request.method in SAFE_METHODS):
+                return await get_response(request)
+    else:
+        def middleware(request):
+            with replica_reads(request.method in SAFE_METHODS):
+                return get_response(request)
+    return middleware
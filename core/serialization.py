@@ -0,0 +1,82 @@
+"""
+The "zmsgpack" Celery serializer: msgpack, zlib compressed above a size threshold.
+
+Every payload starts with one header byte telling whether the msgpack data
+that follows is compressed, so small payloads skip compression entirely and
+the decoder needs no configuration. Decimals, datetimes, dates, times and
+UUIDs, which Kombu's JSON serializer round trips, are packed as msgpack
+extension types holding their string form, so tasks can pass them either way.
+"""
+import datetime
+import decimal
+import uuid
+import zlib
+
+import msgpack
+from django.conf import settings
+from kombu.serialization import register
+
+NAME = "zmsgpack"
+CONTENT_TYPE = "application/x-zmsgpack"
+
+PLAIN = b"\x00"
+ZLIB = b"\x01"
+
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+# Level 1 gets most of the size reduction for a fraction of the CPU time of the default
+COMPRESSION_LEVEL = 1
+
+# Extension type code -> (type, parse(str)); the codes are part of the wire format
+EXT_TYPES = {
+    1: (decimal.Decimal, decimal.Decimal),
+    # datetime before date, which it subclasses
+    2: (datetime.datetime, datetime.datetime.fromisoformat),
+    3: (datetime.date, datetime.date.fromisoformat),
+    4: (datetime.time, datetime.time.fromisoformat),
+    5: (uuid.UUID, uuid.UUID),
+}
+
+
+def _default(obj):
+    for code, (type_, _) in EXT_TYPES.items():
+        if isinstance(obj, type_):
+            value = obj.isoformat() if hasattr(obj, "isoformat") else str(obj)
+            return msgpack.ExtType(code, value.encode("ascii"))
+    raise TypeError(f"Object of type {type(obj).__name__} is not {NAME} serializable")
+
+
+def _ext_hook(code, data):
+    if code not in EXT_TYPES:
+        return msgpack.ExtType(code, data)
+    return EXT_TYPES[code][1](data.decode("ascii"))
+
+
+def pack(obj, compress_min_size=DEFAULT_COMPRESS_MIN_SIZE):
+    data = msgpack.packb(obj, use_bin_type=True, default=_default)
+    if compress_min_size is not None and len(data) >= compress_min_size:
+        compressed = zlib.compress(data, COMPRESSION_LEVEL)
+        # Random or already compressed data can come out larger
+        if len(compressed) < len(data):
+            return ZLIB + compressed
+    return PLAIN + data
+
+
+def unpack(data):
+    header, data = data[:1], data[1:]
+    if header == ZLIB:
+        data = zlib.decompress(data)
+    elif header != PLAIN:
+        raise ValueError(f"Unknown {NAME} payload header: {header!r}")
+    return msgpack.unpackb(data, raw=False, strict_map_key=False, ext_hook=_ext_hook)
+
+
+def dumps(obj):
+    return pack(obj, getattr(settings, "TASK_PAYLOAD_COMPRESS_MIN_SIZE", DEFAULT_COMPRESS_MIN_SIZE))
+
+
+def loads(data):
+    return unpack(bytes(data) if isinstance(data, memoryview) else data)
+
+
+def register_zmsgpack():
+    register(NAME, dumps, loads, content_type=CONTENT_TYPE, content_encoding="binary")
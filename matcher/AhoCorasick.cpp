@@ -0,0 +1,88 @@
+#include "AhoCorasick.h"
+
+#include <algorithm>
+#include <queue>
+
+AhoCorasick::AhoCorasick()
+    : alphabetSize_(1), maxPatternLength_(0) {
+    byteClass_.fill(0);
+    addState();
+}
+
+int32_t AhoCorasick::addState() {
+    trie_.emplace_back();
+    ids_.emplace_back();
+    terminal_.push_back(0);
+    return static_cast<int32_t>(trie_.size() - 1);
+}
+
+void AhoCorasick::addPattern(const std::string& literal, std::size_t id) {
+    int32_t state = 0;
+    for (char c : literal) {
+        unsigned char byte = static_cast<unsigned char>(c);
+        int32_t next = -1;
+        for (const auto& edge : trie_[state]) {
+            if (edge.first == byte) {
+                next = edge.second;
+                break;
+            }
+        }
+        if (next < 0) {
+            next = addState();
+            trie_[state].emplace_back(byte, next);
+        }
+        state = next;
+    }
+    ids_[state].push_back(id);
+    terminal_[state] = 1;
+    maxPatternLength_ = std::max(maxPatternLength_, literal.size());
+}
+
+void AhoCorasick::build() {
+    // Bytes that never occur in a literal share class 0, which keeps the
+    // dense table small for typical (mostly alphabetic) pattern sets.
+    byteClass_.fill(0);
+    alphabetSize_ = 1;
+    for (const auto& edges : trie_) {
+        for (const auto& edge : edges) {
+            if (byteClass_[edge.first] == 0) {
+                byteClass_[edge.first] = static_cast<uint16_t>(alphabetSize_++);
+            }
+        }
+    }
+
+    const std::size_t states = trie_.size();
+    failure_.assign(states, 0);
+    outputLink_.assign(states, 0);
+    delta_.assign(states * alphabetSize_, 0);
+
+    std::queue<int32_t> pending;
+    for (const auto& edge : trie_[0]) {
+        delta_[byteClass_[edge.first]] = edge.second;
+        pending.push(edge.second);
+    }
+
+    // Breadth-first order guarantees the failure state's row is complete
+    // before it is copied into its children.
+    while (!pending.empty()) {
+        int32_t state = pending.front();
+        pending.pop();
+
+        int32_t fail = failure_[state];
+        outputLink_[state] = terminal_[fail] ? fail : outputLink_[fail];
+
+        int32_t* row = &delta_[state * alphabetSize_];
+        const int32_t* failRow = &delta_[fail * alphabetSize_];
+        std::copy(failRow, failRow + alphabetSize_, row);
+
+        for (const auto& edge : trie_[state]) {
+            uint16_t cls = byteClass_[edge.first];
+            failure_[edge.second] = failRow[cls];
+            row[cls] = edge.second;
+            pending.push(edge.second);
+        }
+    }
+
+    trie_.clear();
+    trie_.shrink_to_fit();
+}
@@ -0,0 +1,58 @@
+#ifndef AHOCORASICK_H
+#define AHOCORASICK_H
+
+#include <array>
+#include <cstddef>
+#include <cstdint>
+#include <string>
+#include <vector>
+
+// Multi-pattern literal matcher. All literals are located in a single pass
+// over the text, so the cost is O(text + matches) regardless of how many
+// literals were added.
+class AhoCorasick {
+public:
+    AhoCorasick();
+
+    // Register a literal under the given id. Must be called before build().
+    void addPattern(const std::string& literal, std::size_t id);
+
+    // Compute failure links and the dense transition table.
+    void build();
+
+    bool empty() const { return ids_.empty(); }
+    std::size_t maxPatternLength() const { return maxPatternLength_; }
+
+    // Scan data[begin, end) and call onMatch(id, matchEnd) for every
+    // occurrence of every literal, in order of matchEnd. Overlapping
+    // occurrences are all reported.
+    template <typename Callback>
+    void scan(const char* data, std::size_t begin, std::size_t end, Callback&& onMatch) const {
+        int32_t state = 0;
+        for (std::size_t pos = begin; pos < end; ++pos) {
+            state = delta_[state * alphabetSize_ + byteClass_[static_cast<unsigned char>(data[pos])]];
+            for (int32_t out = terminal_[state] ? state : outputLink_[state]; out > 0; out = outputLink_[out]) {
+                for (std::size_t id : ids_[out]) {
+                    onMatch(id, pos + 1);
+                }
+            }
+        }
+    }
+
+private:
+    int32_t addState();
+
+    std::array<uint16_t, 256> byteClass_;
+    std::size_t alphabetSize_;
+    std::size_t maxPatternLength_;
+
+    // Trie built by addPattern(), keyed by raw byte.
+    std::vector<std::vector<std::pair<unsigned char, int32_t>>> trie_;
+    std::vector<std::vector<std::size_t>> ids_;
+    std::vector<char> terminal_;
+    std::vector<int32_t> failure_;
+    std::vector<int32_t> outputLink_;
+    std::vector<int32_t> delta_;
+};
+
+#endif // AHOCORASICK_H
@@ -0,0 +1,215 @@
+#include "PatternSet.h"
+
+namespace {
+
+inline bool isWordBoundary(const char* data, std::size_t size, std::size_t pos) {
+    bool before = pos > 0 && isWordChar(static_cast<unsigned char>(data[pos - 1]));
+    bool after = pos < size && isWordChar(static_cast<unsigned char>(data[pos]));
+    return before != after;
+}
+
+} // namespace
+
+PatternSet::PatternSet(const std::vector<std::string>& patterns)
+    : patternCount_(patterns.size()) {
+    std::string literal;
+    bool boundaryStart;
+    bool boundaryEnd;
+    for (std::size_t index = 0; index < patterns.size(); ++index) {
+        if (parseLiteralPattern(patterns[index], literal, boundaryStart, boundaryEnd)) {
+            literals_.addPattern(literal, literalPatterns_.size());
+            literalPatterns_.push_back({index, literal.size(), boundaryStart, boundaryEnd});
+        } else {
+            compiledPatterns_.emplace_back(index, std::regex(patterns[index]));
+        }
+    }
+    literals_.build();
+}
+
+PatternSet::~PatternSet() {}
+
+bool PatternSet::parseLiteralPattern(const std::string& pattern, std::string& literal,
+                                     bool& boundaryStart, bool& boundaryEnd) {
+    static const std::string syntaxChars = "^$\\.*+?()[]{}|";
+
+    literal.clear();
+    boundaryStart = false;
+    boundaryEnd = false;
+
+    for (std::size_t i = 0; i < pattern.size(); ++i) {
+        char c = pattern[i];
+        if (c != '\\') {
+            if (syntaxChars.find(c) != std::string::npos) {
+                return false;
+            }
+            literal.push_back(c);
+            continue;
+        }
+
+        if (++i == pattern.size()) {
+            return false;
+        }
+        char escaped = pattern[i];
+        if (escaped == 'b') {
+            // \b is only supported as an anchor around the whole literal.
+            if (i == 1 && !boundaryStart) {
+                boundaryStart = true;
+            } else if (i == pattern.size() - 1 && !literal.empty()) {
+                boundaryEnd = true;
+            } else {
+                return false;
+            }
+        } else if (syntaxChars.find(escaped) != std::string::npos || escaped == '/') {
+            literal.push_back(escaped);
+        } else if (escaped == 't') {
+            literal.push_back('\t');
+        } else if (escaped == 'n') {
+            literal.push_back('\n');
+        } else if (escaped == 'r') {
+            literal.push_back('\r');
+        } else if (escaped == 'f') {
+            literal.push_back('\f');
+        } else if (escaped == 'v') {
+            literal.push_back('\v');
+        } else {
+            return false;
+        }
+    }
+
+    return !literal.empty();
+}
+
+void PatternSet::match(const char* data, std::size_t size, std::vector<MatchSpan>& spans,
+                       unsigned int numThreads, std::size_t shardSize) const {
+    unsigned int threads = numThreads ? numThreads : std::max(1u, std::thread::hardware_concurrency());
+    shardSize = std::max<std::size_t>(shardSize, 1);
+
+    // Literal matching is split by text position, regex matching by pattern;
+    // every task is independent, so they share one pool of workers.
+    std::vector<std::function<std::vector<MatchSpan>()>> tasks;
+
+    if (!literals_.empty()) {
+        std::size_t shards = std::min<std::size_t>(threads, (size + shardSize - 1) / shardSize);
+        shards = std::max<std::size_t>(shards, 1);
+        std::size_t step = (size + shards - 1) / shards;
+        for (std::size_t begin = 0; begin < size || begin == 0; begin += step) {
+            std::size_t end = std::min(size, begin + step);
+            tasks.push_back([this, data, size, begin, end]() { return literalMatching(data, size, begin, end); });
+            if (end == size) {
+                break;
+            }
+        }
+    }
+
+    if (!compiledPatterns_.empty()) {
+        std::size_t groups = std::min<std::size_t>(threads, compiledPatterns_.size());
+        std::size_t step = (compiledPatterns_.size() + groups - 1) / groups;
+        for (std::size_t first = 0; first < compiledPatterns_.size(); first += step) {
+            std::size_t last = std::min(compiledPatterns_.size(), first + step);
+            tasks.push_back([this, data, size, first, last]() { return regexMatching(data, size, first, last); });
+        }
+    }
+
+    std::vector<std::vector<MatchSpan>> results(tasks.size());
+    std::atomic<std::size_t> next(0);
+    auto worker = [&]() {
+        for (std::size_t task = next++; task < tasks.size(); task = next++) {
+            results[task] = tasks[task]();
+        }
+    };
+
+    std::vector<std::thread> workers;
+    std::size_t extraWorkers = std::min<std::size_t>(threads, tasks.size());
+    for (std::size_t i = 1; i < extraWorkers; ++i) {
+        workers.emplace_back(worker);
+    }
+    worker();
+    for (auto& thread : workers) {
+        thread.join();
+    }
+
+    std::size_t total = 0;
+    for (const auto& result : results) {
+        total += result.size();
+    }
+    spans.clear();
+    spans.reserve(total);
+    for (const auto& result : results) {
+        spans.insert(spans.end(), result.begin(), result.end());
+    }
+    selectNonOverlapping(spans);
+}
+
+std::vector<MatchSpan> PatternSet::literalMatching(const char* data, std::size_t size,
+                                                   std::size_t begin, std::size_t end) const {
+    std::vector<MatchSpan> matches;
+    if (literals_.empty()) {
+        return matches;
+    }
+
+    // Scan past the end of the shard far enough to finish any literal that
+    // starts inside it. Occurrences starting in the overlap belong to the next
+    // shard, so each one is reported exactly once.
+    std::size_t scanEnd = std::min(size, end + literals_.maxPatternLength() - 1);
+
+    literals_.scan(data, begin, scanEnd, [&](std::size_t id, std::size_t matchEnd) {
+        const LiteralPattern& literal = literalPatterns_[id];
+        std::size_t matchStart = matchEnd - literal.length;
+        if (matchStart >= end) {
+            return;
+        }
+        if (literal.boundaryStart && !isWordBoundary(data, size, matchStart)) {
+            return;
+        }
+        if (literal.boundaryEnd && !isWordBoundary(data, size, matchEnd)) {
+            return;
+        }
+        matches.push_back({static_cast<int64_t>(literal.index),
+                           static_cast<int64_t>(matchStart),
+                           static_cast<int64_t>(matchEnd)});
+    });
+
+    return matches;
+}
+
+std::vector<MatchSpan> PatternSet::regexMatching(const char* data, std::size_t size,
+                                                 std::size_t first, std::size_t last) const {
+    std::vector<MatchSpan> matches;
+
+    try {
+        for (std::size_t i = first; i < last; ++i) {
+            const auto& pattern = compiledPatterns_[i];
+            for (std::cregex_iterator it(data, data + size, pattern.second), end; it != end; ++it) {
+                matches.push_back({static_cast<int64_t>(pattern.first),
+                                   static_cast<int64_t>(it->position(0)),
+                                   static_cast<int64_t>(it->position(0) + it->length(0))});
+            }
+        }
+    } catch (const std::regex_error& e) {
+        std::cerr << "Regex Error: " << e.what() << std::endl;
+    }
+
+    return matches;
+}
+
+void PatternSet::selectNonOverlapping(std::vector<MatchSpan>& spans) {
+    // Order by pattern, then position, which is the order a pattern-by-pattern
+    // scan produces. The automaton reports every occurrence of a literal, so
+    // keep only the leftmost non-overlapping ones as std::regex would.
+    std::sort(spans.begin(), spans.end(), [](const MatchSpan& a, const MatchSpan& b) {
+        return a.pattern != b.pattern ? a.pattern < b.pattern : a.start < b.start;
+    });
+
+    std::size_t kept = 0;
+    int64_t lastPattern = -1;
+    int64_t lastEnd = 0;
+    for (const auto& span : spans) {
+        if (span.pattern == lastPattern && span.start < lastEnd) {
+            continue;
+        }
+        lastPattern = span.pattern;
+        lastEnd = span.end;
+        spans[kept++] = span;
+    }
+    spans.resize(kept);
+}
@@ -0,0 +1,78 @@
+#ifndef PATTERNSET_H
+#define PATTERNSET_H
+
+#include <iostream>
+#include <regex>
+#include <string>
+#include <vector>
+#include <algorithm>
+#include <thread>
+#include <cstdint>
+#include <atomic>
+#include <functional>
+
+#include "AhoCorasick.h"
+
+// One match as a (pattern index, start, end) triple of byte offsets. A
+// vector of these is laid out exactly like an int64 array of shape (n, 3).
+struct MatchSpan {
+    int64_t pattern;
+    int64_t start;
+    int64_t end;
+};
+
+static_assert(sizeof(MatchSpan) == 3 * sizeof(int64_t), "MatchSpan must be tightly packed");
+
+// A pattern that is a plain literal, optionally anchored by \b on either side.
+struct LiteralPattern {
+    std::size_t index;
+    std::size_t length;
+    bool boundaryStart;
+    bool boundaryEnd;
+};
+
+// Word characters as seen by std::regex \b in the classic locale.
+inline bool isWordChar(unsigned char c) {
+    return (c >= 'a' && c <= 'z') || (c >= 'A' && c <= 'Z') || (c >= '0' && c <= '9') || c == '_';
+}
+
+// A compiled, immutable set of patterns. Literal patterns share one
+// Aho-Corasick automaton; the rest are compiled to std::regex. A PatternSet
+// may be matched against any number of texts, from any number of threads.
+class PatternSet {
+public:
+    // Texts are split into shards of at least this many bytes per thread.
+    static const std::size_t kDefaultShardSize = 1 << 20;
+
+    explicit PatternSet(const std::vector<std::string>& patterns);
+    ~PatternSet();
+
+    // Replace the contents of spans with every match in data[0, size),
+    // ordered by (pattern, start). numThreads == 0 uses every available
+    // hardware thread.
+    void match(const char* data, std::size_t size, std::vector<MatchSpan>& spans,
+               unsigned int numThreads = 0, std::size_t shardSize = kDefaultShardSize) const;
+
+    std::size_t size() const { return patternCount_; }
+    std::size_t literalCount() const { return literalPatterns_.size(); }
+    const AhoCorasick& literals() const { return literals_; }
+    const std::vector<LiteralPattern>& literalPatterns() const { return literalPatterns_; }
+    const std::vector<std::pair<std::size_t, std::regex>>& regexPatterns() const { return compiledPatterns_; }
+
+    static bool parseLiteralPattern(const std::string& pattern, std::string& literal,
+                                    bool& boundaryStart, bool& boundaryEnd);
+
+private:
+    std::vector<MatchSpan> literalMatching(const char* data, std::size_t size,
+                                           std::size_t begin, std::size_t end) const;
+    std::vector<MatchSpan> regexMatching(const char* data, std::size_t size,
+                                         std::size_t first, std::size_t last) const;
+    static void selectNonOverlapping(std::vector<MatchSpan>& spans);
+
+    std::size_t patternCount_;
+    AhoCorasick literals_;
+    std::vector<LiteralPattern> literalPatterns_;
+    std::vector<std::pair<std::size_t, std::regex>> compiledPatterns_;
+};
+
+#endif // PATTERNSET_H
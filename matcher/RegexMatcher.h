@@ -1,30 +1,29 @@
 #ifndef REGEXMATCHER_H
 #define REGEXMATCHER_H
 
-#include <iostream>
-#include <regex>
+#include <memory>
 #include <string>
 #include <vector>
-#include <algorithm>
-#include <iterator>
-#include <chrono>
-#include <thread>
+
+#include "PatternSet.h"
 
 class RegexMatcher {
 public:
-    RegexMatcher(const std::string& text, const std::vector<std::string>& patterns);
+    // numThreads == 0 uses every available hardware thread.
+    RegexMatcher(const std::string& text, const std::vector<std::string>& patterns,
+                 unsigned int numThreads = 0, std::size_t shardSize = PatternSet::kDefaultShardSize);
+    RegexMatcher(const std::string& text, std::shared_ptr<const PatternSet> patternSet,
+                 unsigned int numThreads = 0, std::size_t shardSize = PatternSet::kDefaultShardSize);
     ~RegexMatcher();
 
-    void match();
+    // Replace the contents of spans with every match, ordered by (pattern, start).
+    void match(std::vector<MatchSpan>& spans);
 
 private:
-    std::vector<std::regex> compileRegexPatterns(const std::vector<std::string>& patterns);
-    std::vector<std::string> regexMatching(const std::string& text, const std::vector<std::regex>& compiledPatterns);
-
     std::string text_;
-    std::vector<std::string> patterns_;
-    std::vector<std::regex> compiledPatterns_;
-    std::vector<std::string> matches_;
+    std::shared_ptr<const PatternSet> patternSet_;
+    unsigned int numThreads_;
+    std::size_t shardSize_;
 };
 
 #endif // REGEXMATCHER_H
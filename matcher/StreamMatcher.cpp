@@ -0,0 +1,203 @@
+#include "StreamMatcher.h"
+
+#include <exception>
+#include <pthread.h>
+
+namespace {
+
+// std::regex recurses about once per byte of a match, a few hundred bytes of
+// stack each time, so searches run on a thread with a stack sized to the text.
+const std::size_t kRegexStackBase = 1 << 20;
+const std::size_t kRegexStackPerByte = 1 << 10;
+
+struct StackTask {
+    const std::function<void()>* task;
+    std::exception_ptr error;
+};
+
+void* runStackTask(void* arg) {
+    StackTask* stackTask = static_cast<StackTask*>(arg);
+    try {
+        (*stackTask->task)();
+    } catch (...) {
+        stackTask->error = std::current_exception();
+    }
+    return nullptr;
+}
+
+// Run task on a new thread with at least stackSize bytes of stack, or on the
+// calling thread if one cannot be started.
+void runWithStack(std::size_t stackSize, const std::function<void()>& task) {
+    StackTask stackTask{&task, nullptr};
+    pthread_attr_t attr;
+    pthread_t thread;
+    bool started = pthread_attr_init(&attr) == 0;
+    if (started) {
+        started = pthread_attr_setstacksize(&attr, stackSize) == 0 &&
+                  pthread_create(&thread, &attr, runStackTask, &stackTask) == 0;
+        pthread_attr_destroy(&attr);
+    }
+    if (!started) {
+        task();
+        return;
+    }
+    pthread_join(thread, nullptr);
+    if (stackTask.error) {
+        std::rethrow_exception(stackTask.error);
+    }
+}
+
+} // namespace
+
+StreamMatcher::StreamMatcher(std::shared_ptr<const PatternSet> patternSet, std::size_t window)
+    : patternSet_(std::move(patternSet)),
+      literals_(patternSet_->literals()),
+      literalPatterns_(patternSet_->literalPatterns()),
+      compiledPatterns_(patternSet_->regexPatterns()),
+      window_(window), offset_(0), decided_(0), finished_(false) {
+    lastEnd_.assign(patternSet_->size(), 0);
+    regexResume_.assign(compiledPatterns_.size(), 0);
+}
+
+StreamMatcher::~StreamMatcher() {}
+
+void StreamMatcher::feed(const char* data, std::size_t size, std::vector<MatchSpan>& spans) {
+    spans.clear();
+    if (finished_) {
+        return;
+    }
+    // Take at most window bytes at a time, so the text a regex search sees
+    // stays within a few windows however large the chunk is.
+    std::size_t step = compiledPatterns_.empty() || window_ == 0 ? size : window_;
+    for (std::size_t done = 0; done < size; done += step) {
+        buffer_.append(data + done, std::min(step, size - done));
+        process(false, spans);
+    }
+}
+
+void StreamMatcher::finish(std::vector<MatchSpan>& spans) {
+    spans.clear();
+    if (finished_) {
+        return;
+    }
+    process(true, spans);
+    finished_ = true;
+    buffer_.clear();
+    buffer_.shrink_to_fit();
+}
+
+bool StreamMatcher::isWordBoundary(int64_t pos) const {
+    int64_t end = position();
+    bool before = pos > 0 && isWordChar(static_cast<unsigned char>(buffer_[pos - 1 - offset_]));
+    bool after = pos < end && isWordChar(static_cast<unsigned char>(buffer_[pos - offset_]));
+    return before != after;
+}
+
+void StreamMatcher::process(bool final, std::vector<MatchSpan>& spans) {
+    literalMatching(final, spans);
+    regexMatching(final, spans);
+
+    std::sort(spans.begin(), spans.end(), [](const MatchSpan& a, const MatchSpan& b) {
+        return a.start != b.start ? a.start < b.start : a.pattern < b.pattern;
+    });
+
+    // Keep enough of the tail to re-scan undecided literal occurrences (plus
+    // one byte of \b context) and to resume every regex search.
+    int64_t keepFrom = literals_.empty() ? position() : decided_ - static_cast<int64_t>(literals_.maxPatternLength());
+    for (int64_t resume : regexResume_) {
+        keepFrom = std::min(keepFrom, resume - 1);
+    }
+    keepFrom = std::max(keepFrom, offset_);
+    keepFrom = std::min(keepFrom, position());
+    buffer_.erase(0, static_cast<std::size_t>(keepFrom - offset_));
+    offset_ = keepFrom;
+}
+
+void StreamMatcher::literalMatching(bool final, std::vector<MatchSpan>& spans) {
+    if (literals_.empty()) {
+        return;
+    }
+
+    // Occurrences ending exactly at the end of the buffer may still fail a
+    // trailing \b once the next byte arrives, so they wait for the next call.
+    int64_t end = position();
+    int64_t decidable = final ? end : end - 1;
+    if (decidable <= decided_) {
+        return;
+    }
+
+    int64_t scanStart = std::max(offset_, decided_ - static_cast<int64_t>(literals_.maxPatternLength()) + 1);
+    literals_.scan(buffer_.data(), static_cast<std::size_t>(scanStart - offset_), buffer_.size(),
+                   [&](std::size_t id, std::size_t localEnd) {
+        int64_t matchEnd = offset_ + static_cast<int64_t>(localEnd);
+        if (matchEnd <= decided_ || matchEnd > decidable) {
+            return;
+        }
+        const LiteralPattern& literal = literalPatterns_[id];
+        int64_t matchStart = matchEnd - static_cast<int64_t>(literal.length);
+        if (matchStart < lastEnd_[literal.index]) {
+            return;
+        }
+        if (literal.boundaryStart && !isWordBoundary(matchStart)) {
+            return;
+        }
+        if (literal.boundaryEnd && !isWordBoundary(matchEnd)) {
+            return;
+        }
+        lastEnd_[literal.index] = matchEnd;
+        spans.push_back({static_cast<int64_t>(literal.index), matchStart, matchEnd});
+    });
+
+    decided_ = decidable;
+}
+
+void StreamMatcher::regexMatching(bool final, std::vector<MatchSpan>& spans) {
+    if (compiledPatterns_.empty()) {
+        return;
+    }
+    runWithStack(kRegexStackBase + kRegexStackPerByte * buffer_.size(),
+                 [&]() { regexSearch(final, spans); });
+}
+
+void StreamMatcher::regexSearch(bool final, std::vector<MatchSpan>& spans) {
+    int64_t end = position();
+    int64_t safeEnd = end - static_cast<int64_t>(window_);
+
+    try {
+        for (std::size_t i = 0; i < compiledPatterns_.size(); ++i) {
+            const auto& pattern = compiledPatterns_[i];
+            int64_t& resume = regexResume_[i];
+            std::smatch match;
+
+            while (resume <= end) {
+                auto first = buffer_.cbegin() + (resume - offset_);
+                auto flags = resume > 0 ? std::regex_constants::match_prev_avail
+                                        : std::regex_constants::match_default;
+                if (!std::regex_search(first, buffer_.cend(), match, pattern.second, flags)) {
+                    if (!final) {
+                        resume = std::max(resume, safeEnd);
+                    }
+                    break;
+                }
+
+                int64_t matchStart = resume + match.position(0);
+                int64_t matchEnd = matchStart + match.length(0);
+                if (!final && matchEnd > safeEnd) {
+                    if (matchEnd - matchStart <= static_cast<int64_t>(window_)) {
+                        // More input could still change this match; retry later.
+                        break;
+                    }
+                    // Too long to be decided within the window: drop it
+                    // rather than retain and rescan it on every feed.
+                    resume = matchEnd;
+                    continue;
+                }
+
+                spans.push_back({static_cast<int64_t>(pattern.first), matchStart, matchEnd});
+                resume = matchEnd > matchStart ? matchEnd : matchEnd + 1;
+            }
+        }
+    } catch (const std::regex_error& e) {
+        std::cerr << "Regex Error: " << e.what() << std::endl;
+    }
+}
@@ -0,0 +1,55 @@
+#ifndef STREAMMATCHER_H
+#define STREAMMATCHER_H
+
+#include <memory>
+
+#include "PatternSet.h"
+
+// Incremental counterpart of PatternSet::match(): text is fed in chunks and
+// only a bounded tail of it is retained between calls. Offsets in the returned
+// spans are absolute positions in the concatenated stream.
+//
+// Literal patterns are matched exactly across chunk boundaries. A fallback
+// regex match is only reported once `window` bytes of lookahead past its end
+// are available. A regex match still pending once it is longer than the
+// window is dropped, so such matches are missed, and the retained tail stays
+// within a few windows.
+class StreamMatcher {
+public:
+    static const std::size_t kDefaultWindow = 1 << 16;
+
+    StreamMatcher(std::shared_ptr<const PatternSet> patternSet, std::size_t window = kDefaultWindow);
+    ~StreamMatcher();
+
+    // Append a chunk and replace spans with the matches it completed.
+    void feed(const char* data, std::size_t size, std::vector<MatchSpan>& spans);
+
+    // Signal end of input and replace spans with the remaining matches.
+    void finish(std::vector<MatchSpan>& spans);
+
+    int64_t position() const { return offset_ + static_cast<int64_t>(buffer_.size()); }
+
+private:
+    void process(bool final, std::vector<MatchSpan>& spans);
+    void literalMatching(bool final, std::vector<MatchSpan>& spans);
+    void regexMatching(bool final, std::vector<MatchSpan>& spans);
+    void regexSearch(bool final, std::vector<MatchSpan>& spans);
+    bool isWordBoundary(int64_t pos) const;
+
+    std::shared_ptr<const PatternSet> patternSet_;
+    const AhoCorasick& literals_;
+    const std::vector<LiteralPattern>& literalPatterns_;
+    const std::vector<std::pair<std::size_t, std::regex>>& compiledPatterns_;
+    std::size_t window_;
+
+    // Retained tail of the stream; buffer_[0] is at absolute offset_.
+    std::string buffer_;
+    int64_t offset_;
+    // Literal occurrences ending at or before this position have been handled.
+    int64_t decided_;
+    std::vector<int64_t> lastEnd_;
+    std::vector<int64_t> regexResume_;
+    bool finished_;
+};
+
+#endif // STREAMMATCHER_H
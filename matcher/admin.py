@@ -1,3 +1,18 @@
 from django.contrib import admin
+from .models import DocumentFingerprint, SentenceUsage
+
 
 # Register your models here.
+
+class DocumentFingerprintAdmin(admin.ModelAdmin):
+    list_display = ('id', 'username', 'title', 'language', 'content_hash', 'create_at',)
+    search_fields = ('username', 'title', 'content_hash',)
+
+
+class SentenceUsageAdmin(admin.ModelAdmin):
+    list_display = ('id', 'username', 'period', 'sentence_count', 'update_at',)
+    search_fields = ('username',)
+
+
+admin.site.register(DocumentFingerprint, DocumentFingerprintAdmin)
+admin.site.register(SentenceUsage, SentenceUsageAdmin)
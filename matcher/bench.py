@@ -0,0 +1,300 @@
+"""
+Benchmark suite for the native regex matcher.
+
+Sweeps text size, pattern count and pattern type over every available
+backend. Each case runs in a fresh process, so peak RSS is per case. Compile
+time and match time are reported separately.
+
+Install the extension first (``pip install --no-build-isolation .``), then run
+from this directory:
+
+    python bench.py --output results.json
+    python bench.py --save-baseline bench_baseline.json
+    python bench.py --baseline bench_baseline.json   # exits 1 on regression
+
+bench_baseline.json holds the cases of the regression check, which runs them
+single-threaded so the results do not depend on the number of cores. It
+compares the median of each case's timings, in units of a calibration
+workload timed right before each run, and skips the re backend, which is
+only a reference:
+
+    python bench.py --threads 1 --sentences 1000,5000 --patterns 10,150 --baseline bench_baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import resource
+import statistics
+import string
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+WORDS_PER_SENTENCE = 25
+STREAM_CHUNK_SIZE = 1 << 16
+
+
+def generate_text(sentences, seed):
+    # Same shape of input as test.py: sentences of 25 random lowercase words.
+    rng = random.Random(seed)
+    return ' '.join(
+        ' '.join(''.join(rng.choices(string.ascii_lowercase, k=rng.randint(1, 10))) for _ in range(WORDS_PER_SENTENCE))
+        for _ in range(sentences)
+    ).encode('utf-8')
+
+
+def generate_patterns(count, pattern_type, seed):
+    rng = random.Random(seed + 1)
+    patterns = []
+    for i in range(count):
+        word = ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(1, 5)))
+        if pattern_type == 'literal' or (pattern_type == 'mixed' and i % 2 == 0):
+            patterns.append(r'\b{}\b'.format(word))
+        else:
+            patterns.append(r'\b{}[a-z]?\b'.format(word))
+    return [pattern.encode('utf-8') for pattern in patterns]
+
+
+def _native_compile(patterns, threads):
+    from regex_matcher import PyPatternSet
+    return PyPatternSet(patterns)
+
+
+def _native_match(compiled, text, threads):
+    return len(compiled.match(text, num_threads=threads))
+
+
+def _native_stream_match(compiled, text, threads):
+    stream = compiled.stream()
+    view = memoryview(text)
+    count = 0
+    for start in range(0, len(text), STREAM_CHUNK_SIZE):
+        count += len(stream.feed(view[start:start + STREAM_CHUNK_SIZE]))
+    return count + len(stream.finish())
+
+
+def _re_compile(patterns, threads):
+    return [re.compile(pattern) for pattern in patterns]
+
+
+def _re_match(compiled, text, threads):
+    return sum(1 for pattern in compiled for _ in pattern.finditer(text))
+
+
+# name -> (module required, compile(patterns, threads), match(compiled, text, threads))
+BACKENDS = {
+    'native': ('regex_matcher', _native_compile, _native_match),
+    'native_stream': ('regex_matcher', _native_compile, _native_stream_match),
+    're': (None, _re_compile, _re_match),
+}
+# Backends run for comparison only, never checked against the baseline
+REFERENCE_BACKENDS = {'re'}
+
+
+def available_backends(names):
+    available = []
+    for name in names:
+        module = BACKENDS[name][0]
+        if module:
+            try:
+                __import__(module)
+            except ImportError:
+                print(f"skipping backend {name!r}: {module} is not built", file=sys.stderr)
+                continue
+        available.append(name)
+    return available
+
+
+def _max_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def calibrate():
+    """Time a fixed pure-Python workload, used to normalise timings across runs and machines."""
+    text = generate_text(1000, 0)
+    pattern = re.compile(rb'\b[a-e]+\b')
+    timings = []
+    for _ in range(10):
+        start = time.perf_counter()
+        for _ in range(5):
+            pattern.findall(text)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run_case(case):
+    """Run one benchmark case; executed in its own process."""
+    _, compile_fn, match_fn = BACKENDS[case['backend']]
+    base_rss = _max_rss_kb()
+
+    text = generate_text(case['sentences'], case['seed'])
+    patterns = generate_patterns(case['patterns'], case['pattern_type'], case['seed'])
+
+    calibrations = []
+    compile_times = []
+    match_times = []
+    matches = 0
+    for _ in range(case['repeat']):
+        # Calibrated right before every run, so the ratio follows a machine whose speed changes during the case
+        calibrations.append(calibrate())
+
+        start = time.perf_counter()
+        compiled = compile_fn(patterns, case['threads'])
+        compile_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        matches = match_fn(compiled, text, case['threads'])
+        match_times.append(time.perf_counter() - start)
+
+    match_time = min(match_times)
+    return dict(
+        case,
+        text_bytes=len(text),
+        matches=matches,
+        compile_seconds=min(compile_times),
+        match_seconds=match_time,
+        throughput_mb_s=len(text) / match_time / 1e6 if match_time else None,
+        calibration_seconds=statistics.median(calibrations),
+        # Median run times in units of the calibration workload, compared against the baseline
+        compile_ratio=statistics.median(seconds / calibration for seconds, calibration
+                                        in zip(compile_times, calibrations)),
+        match_ratio=statistics.median(seconds / calibration for seconds, calibration in zip(match_times, calibrations)),
+        base_rss_kb=base_rss,
+        peak_rss_kb=_max_rss_kb(),
+    )
+
+
+def scanned_patterns(backend, pattern_type, patterns):
+    """Number of patterns that cost a full pass over the text."""
+    if backend == 're':
+        return patterns
+    # The native backends match every literal in a single automaton pass.
+    return {'literal': 1, 'mixed': patterns - patterns // 2 + 1, 'regex': patterns}[pattern_type]
+
+
+def case_key(result):
+    return '{backend}/{pattern_type}/sentences={sentences}/patterns={patterns}/threads={threads}'.format(**result)
+
+
+def find_regressions(results, baseline, tolerance, rss_tolerance, noise_seconds):
+    # Timings are compared as multiples of the calibration workload, so a
+    # slower or busier machine does not register as a regression. The re
+    # backend is only a reference: no change to the matcher can slow it down,
+    # so it is reported but never compared.
+    previous = {case_key(result): result for result in baseline['results']
+                if result['backend'] not in REFERENCE_BACKENDS}
+    # A baseline case that did not run, e.g. because the extension is not
+    # built, would otherwise pass unnoticed.
+    regressions = [f"{key}: not run" for key in previous.keys() - {case_key(result) for result in results}]
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is None:
+            continue
+        for metric in ('match', 'compile'):
+            ratio = result[f'{metric}_ratio']
+            old_ratio = old[f'{metric}_ratio']
+            # Differences too small to measure reliably are ignored
+            slowdown_seconds = (ratio - old_ratio) * result['calibration_seconds']
+            if ratio > old_ratio * (1 + tolerance) and slowdown_seconds > noise_seconds:
+                regressions.append(f"{case_key(result)}: {metric} {ratio:.3g} x calibration > "
+                                   f"baseline {old_ratio:.3g} x calibration (+{tolerance:.0%})")
+        if result['peak_rss_kb'] > old['peak_rss_kb'] * (1 + rss_tolerance):
+            regressions.append(f"{case_key(result)}: peak_rss_kb {result['peak_rss_kb']} > "
+                               f"baseline {old['peak_rss_kb']} (+{rss_tolerance:.0%})")
+    return regressions
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def _str_list(value):
+    return [item for item in value.split(',') if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sentences', type=_int_list, default=[1000, 15000],
+                        help='comma-separated text sizes, in 25-word sentences')
+    parser.add_argument('--patterns', type=_int_list, default=[10, 150, 1500],
+                        help='comma-separated pattern counts')
+    parser.add_argument('--pattern-types', type=_str_list, default=['literal', 'mixed', 'regex'])
+    parser.add_argument('--backends', type=_str_list, default=list(BACKENDS))
+    parser.add_argument('--threads', type=int, default=0, help='native worker threads (0 = all cores)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per case; the fastest is reported, the median is checked against the baseline')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-scan-work', type=int, default=5 * 10 ** 5,
+                        help='skip cases where sentences * per-pattern scans exceeds this')
+    parser.add_argument('--output', help='write results as JSON to this path (default: stdout)')
+    parser.add_argument('--baseline', help='fail if results regress past this stored result file')
+    parser.add_argument('--save-baseline', help='store the results as a new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed slowdown versus the baseline')
+    parser.add_argument('--rss-tolerance', type=float, default=0.25, help='allowed peak RSS growth')
+    parser.add_argument('--noise-seconds', type=float, default=0.002,
+                        help='ignore timing differences smaller than this')
+    args = parser.parse_args(argv)
+
+    unknown = set(args.backends) - set(BACKENDS)
+    if unknown:
+        parser.error(f"unknown backends: {', '.join(sorted(unknown))}")
+
+    cases = []
+    for backend in available_backends(args.backends):
+        for pattern_type in args.pattern_types:
+            for sentences in args.sentences:
+                for patterns in args.patterns:
+                    if sentences * scanned_patterns(backend, pattern_type, patterns) > args.max_scan_work:
+                        continue
+                    cases.append(dict(backend=backend, pattern_type=pattern_type, sentences=sentences,
+                                      patterns=patterns, threads=args.threads, repeat=args.repeat, seed=args.seed))
+
+    results = []
+    context = get_context('spawn')
+    for case in cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_case, case).result()
+        print(f"{case_key(result)}: compile {result['compile_seconds']:.4f}s, "
+              f"match {result['match_seconds']:.4f}s, {result['throughput_mb_s']:.1f} MB/s, "
+              f"peak RSS {result['peak_rss_kb'] / 1024:.1f} MiB", file=sys.stderr)
+        results.append(result)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            file.write(output)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = find_regressions(results, baseline, args.tolerance, args.rss_tolerance, args.noise_seconds)
+        if regressions:
+            print('Performance regressions:', *regressions, sep='\n  ', file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+"""
+Benchmark of the Celery payload serializers for the matcher tasks.
+
+Encodes the message body of each matcher task, and its result, at a few text
+sizes with every serializer, and reports the encoded size and the time to
+encode and decode it. Texts are matched against generated patterns, so the
+processed results hold as many matches as real ones would. The Redis
+transport base64 encodes message bodies, which scales every serializer alike;
+results are stored as encoded.
+
+Run from the project root:
+
+    python -m matcher.bench_serialization
+    python -m matcher.bench_serialization --sentences 10,500 --patterns 50 --output results.json
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+import django
+import msgpack
+from kombu.utils import json as kombu_json
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+django.setup()
+
+from django.conf import settings  # noqa: E402
+
+from core.serialization import DEFAULT_COMPRESS_MIN_SIZE, pack, unpack  # noqa: E402
+
+from .bench import generate_patterns, generate_text  # noqa: E402
+from .tasks import merge_shard_matches, payment_result  # noqa: E402
+
+BULK_DOCUMENTS = 50
+
+
+def serializers(compress_min_size):
+    # name -> (encode, decode), the way kombu calls the registered serializers
+    return {
+        'json': (lambda obj: kombu_json.dumps(obj).encode('utf-8'), lambda data: kombu_json.loads(data)),
+        'msgpack': (lambda obj: msgpack.packb(obj, use_bin_type=True), lambda data: msgpack.unpackb(data, raw=False)),
+        'zmsgpack': (lambda obj: pack(obj, compress_min_size), unpack),
+    }
+
+
+def task_body(args, kwargs, chain=None):
+    # Celery message protocol 2 body: (args, kwargs, embed)
+    return [list(args), kwargs, {'callbacks': None, 'errbacks': None, 'chain': chain, 'chord': None}]
+
+
+def shard_spans(text, patterns):
+    """
+    The [pattern, start, end] spans of each shard of a text, as match_shard
+    returns them, found with Python's re, which matches like the native matcher.
+    """
+    shards = {}
+    for index, pattern in enumerate(patterns):
+        for match in re.finditer(pattern, text):
+            shards.setdefault(match.start() // settings.MATCHER_SHARD_SIZE, []).append(
+                [index, match.start(), match.end()])
+    return [shards[shard] for shard in sorted(shards)]
+
+
+def payloads(sentences, pattern_count, seed):
+    """(task, payload) pairs of the matcher message bodies and results for a text of the given size."""
+    text = generate_text(sentences, seed)
+    spans = shard_spans(text, generate_patterns(pattern_count, 'mixed', seed))
+    text = text.decode('utf-8')
+    result = payment_result(False, 0)
+    processed = merge_shard_matches(spans, dict(result))
+    next_step = [{'task': 'matcher.tasks.process_counted_text', 'args': [], 'kwargs': {}, 'options': {},
+                  'subtask_type': None, 'immutable': False}]
+
+    documents = [['english', f'title {i}', generate_text(max(sentences // BULK_DOCUMENTS, 1), seed + i).decode('utf-8')]
+                 for i in range(BULK_DOCUMENTS)]
+    bulk_result = {
+        'status': 'success',
+        'results': [dict(result, title=title) for _, title, _ in documents],
+        'total_sentence_count': 0,
+    }
+
+    return [
+        ('count_and_check_payment', task_body(['user', 'english', 'title', text, 1], {'blob_key': None}, next_step)),
+        ('count_and_check_payment/blob', task_body(['user', 'english', 'title', None, 1], {'blob_key': '0' * 64},
+                                                   next_step)),
+        ('count_and_check_payment/result', result),
+        ('count_and_check_payment_bulk', task_body(['user', 1, documents], {})),
+        ('count_and_check_payment_bulk/result', bulk_result),
+        ('process_counted_text', task_body([result], {})),
+        ('merge_shard_matches', task_body([spans, result], {})),
+        ('merge_shard_matches/result', processed),
+    ]
+
+
+def measure(encode, decode, payload, repeat):
+    encode_times = []
+    decode_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = encode(payload)
+        encode_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        decode(data)
+        decode_times.append(time.perf_counter() - start)
+    return len(data), min(encode_times), min(decode_times)
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sentences', type=_int_list, default=[10, 100, 500],
+                        help='comma-separated text sizes, in 25-word sentences')
+    parser.add_argument('--patterns', type=int, default=150, help='number of patterns the texts are matched against')
+    parser.add_argument('--compress-min-size', type=int, default=DEFAULT_COMPRESS_MIN_SIZE,
+                        help='zmsgpack compresses payloads from this many bytes')
+    parser.add_argument('--repeat', type=int, default=20, help='runs per case; the fastest is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write results as JSON to this path (default: stdout)')
+    args = parser.parse_args(argv)
+
+    results = []
+    for sentences in args.sentences:
+        for task, payload in payloads(sentences, args.patterns, args.seed):
+            baseline = None
+            for name, (encode, decode) in serializers(args.compress_min_size).items():
+                size, encode_seconds, decode_seconds = measure(encode, decode, payload, args.repeat)
+                result = dict(task=task, sentences=sentences, serializer=name, bytes=size,
+                              encode_seconds=encode_seconds, decode_seconds=decode_seconds)
+                if baseline is None:
+                    baseline = result
+                result['bytes_saved'] = baseline['bytes'] - size
+                result['seconds_saved'] = (baseline['encode_seconds'] + baseline['decode_seconds']
+                                           - encode_seconds - decode_seconds)
+                print(f"{task}/sentences={sentences}/{name}: {size} bytes ({result['bytes_saved']:+d} saved), "
+                      f"encode {encode_seconds * 1e6:.1f}us, decode {decode_seconds * 1e6:.1f}us", file=sys.stderr)
+                results.append(result)
+
+    output = json.dumps({'compress_min_size': args.compress_min_size, 'patterns': args.patterns, 'results': results},
+                        indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""
+Local blob storage for large texts (the claim-check pattern).
+
+A text is written once under the sha256 of its UTF-8 bytes, which is also
+its content hash, and only that key travels through Celery. Tasks read the
+text back as a stream of decoded chunks, so neither the broker nor any
+process ever holds the whole document in memory.
+"""
+import codecs
+import hashlib
+import os
+import tempfile
+import time
+
+from django.conf import settings
+
+CHUNK_SIZE = 1 << 20
+
+
+class InvalidBlob(ValueError):
+    """The uploaded data is not UTF-8 encoded text."""
+
+
+def blob_path(key):
+    # Fan out over subdirectories so no directory grows too large
+    return os.path.join(settings.MATCHER_BLOB_ROOT, key[:2], key)
+
+
+def store_chunks(chunks):
+    """
+    Store a stream of bytes chunks; returns (key, size). The data must be
+    UTF-8 encoded text, otherwise InvalidBlob is raised and nothing is stored.
+    """
+    os.makedirs(settings.MATCHER_BLOB_ROOT, exist_ok=True)
+    digest = hashlib.sha256()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    size = 0
+
+    fd, temp_path = tempfile.mkstemp(dir=settings.MATCHER_BLOB_ROOT, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            for chunk in chunks:
+                decoder.decode(chunk)
+                digest.update(chunk)
+                file.write(chunk)
+                size += len(chunk)
+            decoder.decode(b"", final=True)
+
+        key = digest.hexdigest()
+        path = blob_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Blobs are immutable and content addressed, so an existing blob with
+        # this key already holds the same text.
+        os.replace(temp_path, path)
+    except UnicodeDecodeError as e:
+        os.unlink(temp_path)
+        raise InvalidBlob(f"The text must be UTF-8 encoded: {e}") from e
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+    return key, size
+
+
+def store_upload(uploaded_file):
+    # Django has already streamed large uploads to a temporary file
+    return store_chunks(uploaded_file.chunks(CHUNK_SIZE))
+
+
+def store_text(text):
+    encoded = text.encode("utf-8")
+    return store_chunks(encoded[start:start + CHUNK_SIZE] for start in range(0, len(encoded), CHUNK_SIZE))
+
+
+def blob_size(key):
+    return os.path.getsize(blob_path(key))
+
+
+def iter_text(key, chunk_size=CHUNK_SIZE):
+    """Read a stored text back as a stream of str chunks."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    with open(blob_path(key), "rb") as file:
+        while chunk := file.read(chunk_size):
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def purge_blobs(max_age):
+    """Delete blobs last written more than max_age seconds ago; returns how many were deleted."""
+    deleted = 0
+    cutoff = time.time() - max_age
+    for directory, _, filenames in os.walk(settings.MATCHER_BLOB_ROOT):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+                    deleted += 1
+            except FileNotFoundError:
+                pass
+    return deleted
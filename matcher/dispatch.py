@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+import uuid
+
+from celery import states
+from celery.result import EagerResult
+from django.conf import settings
+
+from . import blobs
+from .fingerprints import content_hash, needs_duplicate_check
+from .tasks import (check_usage_payment_required, count_and_check_payment, get_cached_sentence_count, level_options,
+                    matcher_workflow, needs_processing, payment_result, process_counted_text)
+
+logger = logging.getLogger(__name__)
+
+INLINE = "inline"
+CELERY = "celery"
+CACHED = "cache"
+
+
+class AdaptiveDispatcher:
+    """
+    Runs a Celery task in the calling process when it is cheap, and through
+    the broker otherwise.
+
+    The cost of a call is modelled as seconds = overhead + per_unit * size,
+    fitted with exponentially weighted least squares over previous inline
+    runs. Calls whose size is over max_inline_size, or whose estimated cost is
+    over max_inline_seconds, are sent to Celery. The first inline runs pay for
+    warming up the process, so the first `warmup` of them are not measured,
+    and once `explore_every` calls in a row have been sent to Celery because
+    of their estimate, the next one runs inline anyway so that a stale
+    estimate can recover.
+
+    When given, workflow(*args, **kwargs) builds the Celery signature sent
+    instead of the bare task, e.g. a chain starting with it. dispatch()
+    returns a Celery result either way (an EagerResult for inline runs), so
+    callers can .get() it or await it with await_result(). Callers that answer
+    a call without running the task at all, e.g. from a cache, report it with
+    record_cached(), so metrics() counts every call.
+    """
+
+    def __init__(self, task, max_inline_size, max_inline_seconds, smoothing=0.1, warmup=1, explore_every=100,
+                 workflow=None):
+        self.task = task
+        self.workflow = workflow
+        self.max_inline_size = max_inline_size
+        self.max_inline_seconds = max_inline_seconds
+        self.smoothing = smoothing
+        self.warmup = warmup
+        self.explore_every = explore_every
+
+        self._lock = threading.Lock()
+        # Weighted means of size, seconds, size^2 and size * seconds
+        self._moments = None
+        self._counts = {INLINE: 0, CELERY: 0, CACHED: 0}
+        self._inline_seconds = 0.0
+        self._skipped_since_inline = 0
+
+    def estimate(self, size):
+        """Estimated seconds to run the task inline, or None before the first inline run."""
+        with self._lock:
+            if self._moments is None:
+                return None
+            mean_size, mean_seconds, mean_size2, mean_product = self._moments
+
+        variance = mean_size2 - mean_size * mean_size
+        if variance > 0:
+            per_unit = max((mean_product - mean_size * mean_seconds) / variance, 0.0)
+            overhead = max(mean_seconds - per_unit * mean_size, 0.0)
+        else:
+            # Every run so far had the same size, so the cost cannot be split up
+            # yet; treat it as fixed until a run of another size is measured.
+            per_unit = 0.0
+            overhead = mean_seconds
+        return overhead + per_unit * size
+
+    def choose(self, size):
+        if size > self.max_inline_size:
+            return CELERY
+        estimate = self.estimate(size)
+        if estimate is not None and estimate > self.max_inline_seconds:
+            with self._lock:
+                self._skipped_since_inline += 1
+                if self._skipped_since_inline < self.explore_every:
+                    return CELERY
+        return INLINE
+
+    def dispatch(self, size, *args, **kwargs):
+        """Run the task for an input of the given size; returns (path, result)."""
+        path = self.choose(size)
+        if path == INLINE:
+            start = time.perf_counter()
+            result = self.task.apply(args, kwargs)
+            elapsed = time.perf_counter() - start
+            self._record_inline(size, elapsed)
+            logger.info("%s ran inline: size=%d seconds=%.6f", self.task.name, size, elapsed)
+        else:
+            if self.workflow is not None:
+                result = self.workflow(*args, **kwargs).apply_async()
+            else:
+                result = self.task.delay(*args, **kwargs)
+            with self._lock:
+                self._counts[CELERY] += 1
+            logger.info("%s sent to celery: size=%d task_id=%s", self.task.name, size, result.id)
+        return path, result
+
+    def _record_inline(self, size, seconds):
+        sample = (size, seconds, size * size, size * seconds)
+        with self._lock:
+            self._counts[INLINE] += 1
+            self._inline_seconds += seconds
+            self._skipped_since_inline = 0
+            if self._counts[INLINE] <= self.warmup:
+                return
+            if self._moments is None:
+                self._moments = sample
+            else:
+                self._moments = tuple(
+                    mean + self.smoothing * (value - mean) for mean, value in zip(self._moments, sample)
+                )
+
+    def record_cached(self):
+        """Count a call answered without running the task."""
+        with self._lock:
+            self._counts[CACHED] += 1
+
+    def metrics(self):
+        """
+        Counts of the calls in this process by path, the time spent running
+        the task inline, and the current estimate of the inline cost.
+        """
+        with self._lock:
+            metrics = {
+                "inline": self._counts[INLINE],
+                "celery": self._counts[CELERY],
+                "cache": self._counts[CACHED],
+                "inline_seconds": self._inline_seconds,
+            }
+        metrics["estimated_seconds_at_max_size"] = self.estimate(self.max_inline_size)
+        return metrics
+
+
+# Counting and pricing is linear in the text length, so size is the length of the text
+count_dispatcher = AdaptiveDispatcher(
+    count_and_check_payment,
+    max_inline_size=settings.MATCHER_INLINE_MAX_CHARS,
+    max_inline_seconds=settings.MATCHER_INLINE_MAX_SECONDS,
+    workflow=matcher_workflow,
+)
+
+
+def dispatch_matcher(username, language_name, title, text, user_level, blob_key=None, quota_user=None):
+    """
+    Start the matcher workflow for a text, passed inline or as the key of a
+    stored blob; returns (path, result), where result tracks the final
+    matcher_workflow result. The text is priced against the allowance of the
+    signed-in user quota_user, if any.
+
+    A text whose sentence count is cached is priced here without counting
+    it again, unless it still needs its duplicate check. On the Celery path
+    the whole workflow is one chain. Inline, the text is counted here.
+    Either way, only the processing step, if needed, goes to Celery.
+    """
+    text_hash = blob_key or content_hash(text)
+    size = blobs.blob_size(blob_key) if blob_key else len(text)
+
+    sentence_count = get_cached_sentence_count(text_hash, language_name)
+    if sentence_count is not None and not needs_duplicate_check(quota_user, title, text_hash):
+        path = CACHED
+        data = payment_result(*check_usage_payment_required(quota_user, user_level, [(text_hash, sentence_count)])[0])
+        result = EagerResult(str(uuid.uuid4()), data, states.SUCCESS)
+        count_dispatcher.record_cached()
+        logger.info("sentence count cache hit: size=%d", size)
+    else:
+        path, result = count_dispatcher.dispatch(
+            size, username, language_name, title, text, user_level, blob_key=blob_key, quota_user=quota_user
+        )
+
+    if path != CELERY:
+        data = result.get()
+        if needs_processing(data):
+            result = process_counted_text.apply_async(
+                (data,),
+                {"text": text, "blob_key": blob_key, "user_level": user_level, "language_name": language_name,
+                 "quota_user": quota_user, "title": title},
+                **level_options(user_level)
+            )
+    return path, result
@@ -0,0 +1,180 @@
+import hashlib
+import re
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+
+from .models import DocumentFingerprint
+
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 4
+BAND_BITS = SIMHASH_BITS // SIMHASH_BANDS
+# Texts whose SimHashes differ in at most this many bits are near duplicates.
+# It must stay below SIMHASH_BANDS so that near duplicates share a band.
+NEAR_DUPLICATE_DISTANCE = 3
+SHINGLE_WORDS = 3
+
+WORD_PATTERN = re.compile(r"\w+")
+TRAILING_WORD_PATTERN = re.compile(r"\w*\Z")
+# BIT_TABLES[i] maps every byte to 1 if its bit i is set and to 0 otherwise
+BIT_TABLES = [bytes((byte >> bit) & 1 for byte in range(256)) for bit in range(8)]
+
+DUPLICATE_TITLE = "Text with the same title already exists."
+DUPLICATE_TEXT = "The same text already exists under another title."
+NEAR_DUPLICATE_TEXT = "A very similar text already exists."
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def simhash(text):
+    """
+    64-bit SimHash of the set of 3-word shingles of a text, given as a
+    string or an iterable of string chunks. Similar texts get SimHashes that
+    differ in few bits.
+    """
+    chunks = (text,) if isinstance(text, str) else text
+
+    shingles = set()
+    # Words carried over to the next chunk: the last words of the previous
+    # chunks, which start its first shingles, and a word cut by the boundary
+    previous = []
+    partial = ""
+    for chunk in chunks:
+        chunk = partial + chunk.lower()
+        cut = TRAILING_WORD_PATTERN.search(chunk).start()
+        partial = chunk[cut:]
+        words = previous + WORD_PATTERN.findall(chunk, 0, cut)
+        shingles.update(" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1))
+        previous = words[-(SHINGLE_WORDS - 1):]
+
+    words = previous + ([partial] if partial else [])
+    shingles.update(" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1))
+    if not shingles:
+        # Texts shorter than one shingle
+        shingles.add(" ".join(words))
+
+    digests = b"".join(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest() for shingle in shingles)
+
+    # Set each bit of the result if it is set in the majority of the shingle
+    # hashes, counting one bit position of all hashes at a time.
+    value = 0
+    for byte in range(SIMHASH_BITS // 8):
+        column = digests[byte::8]
+        for bit in range(8):
+            if column.translate(BIT_TABLES[bit]).count(1) * 2 > len(shingles):
+                value |= 1 << (byte * 8 + bit)
+    return value
+
+
+def simhash_bands(value):
+    mask = (1 << BAND_BITS) - 1
+    return [(value >> (band * BAND_BITS)) & mask for band in range(SIMHASH_BANDS)]
+
+
+def to_signed(value):
+    # BigIntegerField is a signed 64-bit integer
+    return value - (1 << SIMHASH_BITS) if value >= 1 << (SIMHASH_BITS - 1) else value
+
+
+def to_unsigned(value):
+    return value & ((1 << SIMHASH_BITS) - 1)
+
+
+def needs_duplicate_check(username, title, text_hash):
+    """
+    Whether check_existing_text() has anything to do for a text: False for
+    anonymous texts and for texts already recorded under the same title.
+    """
+    if not username:
+        return False
+    return not DocumentFingerprint.objects.filter(
+        username=username, title=title or "", content_hash=text_hash
+    ).exists()
+
+
+def find_exact_duplicate(username, title, text_hash):
+    """
+    Look up the documents of a user with the same title or the same text.
+    Returns the reason for the conflict, None if there is none, or True if
+    this very document (same title and text) is already recorded.
+    """
+    if title:
+        same_title = DocumentFingerprint.objects.filter(username=username, title=title).only("content_hash").first()
+        if same_title is not None:
+            return True if same_title.content_hash == text_hash else DUPLICATE_TITLE
+
+    same_text = DocumentFingerprint.objects.filter(username=username, content_hash=text_hash).only("title").first()
+    if same_text is not None:
+        return True if same_text.title == title else DUPLICATE_TEXT
+
+    return None
+
+
+def find_near_duplicate(username, text_simhash):
+    """Returns the reason for the conflict if the user has a near duplicate of the text, else None."""
+    # Near duplicates share at least one SimHash band, so each band is an
+    # indexed lookup and only those candidates are compared bit by bit.
+    bands = Q()
+    for band, band_value in enumerate(simhash_bands(text_simhash)):
+        bands |= Q(**{f"simhash_band_{band}": band_value})
+    candidates = DocumentFingerprint.objects.filter(bands, username=username).values_list("simhash", flat=True)
+    for candidate in candidates:
+        if (to_unsigned(candidate) ^ text_simhash).bit_count() <= NEAR_DUPLICATE_DISTANCE:
+            return NEAR_DUPLICATE_TEXT
+    return None
+
+
+def find_duplicate(username, title, language_name, text, text_hash, record):
+    if not username:
+        return None
+
+    title = title or ""
+
+    duplicate = find_exact_duplicate(username, title, text_hash)
+    if duplicate is True:
+        return None
+    elif duplicate:
+        return duplicate
+
+    text_simhash = simhash(text)
+    duplicate = find_near_duplicate(username, text_simhash)
+    if duplicate or not record:
+        return duplicate
+
+    try:
+        with transaction.atomic():
+            DocumentFingerprint.objects.create(
+                username=username,
+                title=title,
+                language=language_name,
+                content_hash=text_hash,
+                simhash=to_signed(text_simhash),
+                **{f"simhash_band_{band}": band_value for band, band_value in enumerate(simhash_bands(text_simhash))}
+            )
+    except IntegrityError:
+        # A concurrent request recorded a document with the same title first
+        duplicate = find_exact_duplicate(username, title, text_hash)
+        return None if duplicate is True else duplicate
+    return None
+
+
+def check_existing_text(username, title, language_name, text, text_hash):
+    """
+    Duplicate check for a text submitted by a signed-in user, given as a
+    string or an iterable of string chunks, with its content_hash(). Returns
+    the reason the text is a duplicate of another document of the user, or
+    None. Nothing is recorded, texts are only recorded once processed by
+    record_text(). Texts without a username are not checked.
+    """
+    return find_duplicate(username, title, language_name, text, text_hash, record=False)
+
+
+def record_text(username, title, language_name, text, text_hash):
+    """
+    Like check_existing_text, but also record the text as a document of the
+    user if it is not a duplicate and was not already recorded. Texts
+    without a username are never recorded.
+    """
+    return find_duplicate(username, title, language_name, text, text_hash, record=True)
@@ -0,0 +1,40 @@
+# Generated by Django 5.0.3 on 2026-10-17 22:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentFingerprint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=150, verbose_name='Username')),
+                ('title', models.CharField(blank=True, default='', max_length=50, verbose_name='Title')),
+                ('language', models.CharField(max_length=100, verbose_name='Language')),
+                ('content_hash', models.CharField(help_text='sha256 of the text', max_length=64, verbose_name='Content Hash')),
+                ('simhash', models.BigIntegerField(verbose_name='SimHash')),
+                ('simhash_band_0', models.IntegerField()),
+                ('simhash_band_1', models.IntegerField()),
+                ('simhash_band_2', models.IntegerField()),
+                ('simhash_band_3', models.IntegerField()),
+                ('create_at', models.DateTimeField(auto_now_add=True, help_text='format : y-m-d H:M:S', verbose_name='date fingerprint created')),
+            ],
+            options={
+                'verbose_name': 'Document Fingerprint',
+                'verbose_name_plural': 'Document Fingerprints',
+                'ordering': ['-create_at'],
+                'indexes': [models.Index(fields=['username', 'title'], name='fingerprint_title_idx'), models.Index(fields=['username', 'content_hash'], name='fingerprint_content_idx'), models.Index(fields=['username', 'simhash_band_0'], name='fingerprint_band_0_idx'), models.Index(fields=['username', 'simhash_band_1'], name='fingerprint_band_1_idx'), models.Index(fields=['username', 'simhash_band_2'], name='fingerprint_band_2_idx'), models.Index(fields=['username', 'simhash_band_3'], name='fingerprint_band_3_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='documentfingerprint',
+            constraint=models.UniqueConstraint(condition=models.Q(('title', ''), _negated=True), fields=('username', 'title'), name='fingerprint_unique_title'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.0.3 on 2026-10-17 22:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matcher', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SentenceUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=150, verbose_name='Username')),
+                ('period', models.DateField(help_text='first day of the billing month', verbose_name='Period')),
+                ('sentence_count', models.PositiveBigIntegerField(default=0, verbose_name='Sentence Count')),
+                ('update_at', models.DateTimeField(auto_now=True, help_text='format : y-m-d H:M:S', verbose_name='date usage updated')),
+            ],
+            options={
+                'verbose_name': 'Sentence Usage',
+                'verbose_name_plural': 'Sentence Usages',
+                'ordering': ['-period'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='sentenceusage',
+            constraint=models.UniqueConstraint(fields=('username', 'period'), name='sentence_usage_unique_period'),
+        ),
+    ]
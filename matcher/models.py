@@ -1,3 +1,80 @@
 from django.db import models
+from django.db.models import Q
+from django.utils.translation import gettext_lazy as _
+
 
 # Create your models here.
+
+
+class DocumentFingerprint(models.Model):
+    """
+    Fingerprint of a text submitted by a user, for duplicate detection.
+
+    Exact duplicates are found through the indexed content hash. Near
+    duplicates are found through the 64-bit SimHash of the text, split into
+    four 16-bit bands that are indexed separately: texts whose SimHashes
+    differ in at most three bits share at least one band.
+    """
+    username = models.CharField(max_length=150, verbose_name=_("Username"))
+    title = models.CharField(max_length=50, blank=True, default="", verbose_name=_("Title"))
+    language = models.CharField(max_length=100, verbose_name=_("Language"))
+    content_hash = models.CharField(max_length=64, verbose_name=_("Content Hash"), help_text=_("sha256 of the text"))
+    simhash = models.BigIntegerField(verbose_name=_("SimHash"))
+    simhash_band_0 = models.IntegerField()
+    simhash_band_1 = models.IntegerField()
+    simhash_band_2 = models.IntegerField()
+    simhash_band_3 = models.IntegerField()
+    create_at = models.DateTimeField(
+        auto_now_add=True,
+        editable=False,
+        verbose_name=_("date fingerprint created"),
+        help_text=_("format : y-m-d H:M:S")
+    )
+
+    class Meta:
+        verbose_name = _("Document Fingerprint")
+        verbose_name_plural = _("Document Fingerprints")
+        ordering = ["-create_at"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["username", "title"], condition=~Q(title=""), name="fingerprint_unique_title"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["username", "title"], name="fingerprint_title_idx"),
+            models.Index(fields=["username", "content_hash"], name="fingerprint_content_idx"),
+            models.Index(fields=["username", "simhash_band_0"], name="fingerprint_band_0_idx"),
+            models.Index(fields=["username", "simhash_band_1"], name="fingerprint_band_1_idx"),
+            models.Index(fields=["username", "simhash_band_2"], name="fingerprint_band_2_idx"),
+            models.Index(fields=["username", "simhash_band_3"], name="fingerprint_band_3_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.id} - {self.username} : {self.title}"
+
+
+class SentenceUsage(models.Model):
+    """
+    Sentences a user has used in a billing month. The live counters are kept
+    in Redis by matcher.quota and periodically flushed here.
+    """
+    username = models.CharField(max_length=150, verbose_name=_("Username"))
+    period = models.DateField(verbose_name=_("Period"), help_text=_("first day of the billing month"))
+    sentence_count = models.PositiveBigIntegerField(default=0, verbose_name=_("Sentence Count"))
+    update_at = models.DateTimeField(
+        auto_now=True,
+        editable=False,
+        verbose_name=_("date usage updated"),
+        help_text=_("format : y-m-d H:M:S")
+    )
+
+    class Meta:
+        verbose_name = _("Sentence Usage")
+        verbose_name_plural = _("Sentence Usages")
+        ordering = ["-period"]
+        constraints = [
+            models.UniqueConstraint(fields=["username", "period"], name="sentence_usage_unique_period"),
+        ]
+
+    def __str__(self):
+        return f"{self.username} : {self.period:%Y-%m} - {self.sentence_count}"
@@ -0,0 +1,115 @@
+"""
+Map-reduce matching of stored texts with the native matcher.
+
+A text is split into shards of about MATCHER_SHARD_SIZE bytes that are
+matched by separate Celery tasks, and the spans found in every shard are
+merged back into the spans of the whole text. Each shard is read with up to
+MATCHER_SHARD_OVERLAP bytes of the next one, so matches that start in a shard
+but end in the next are still found, as long as they are shorter than that.
+"""
+import functools
+import itertools
+
+from django.conf import settings
+
+from . import blobs
+
+WHITESPACE = b" \t\n\r\f\v"
+# How far past the nominal end of a shard to look for whitespace to end it at
+BREAK_SEARCH_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=None)
+def load_patterns():
+    """The matcher patterns, one regular expression per line of MATCHER_PATTERNS_FILE."""
+    if not settings.MATCHER_PATTERNS_FILE:
+        return ()
+    with open(settings.MATCHER_PATTERNS_FILE, "rb") as file:
+        return tuple(line.rstrip(b"\r\n") for line in file if line.strip())
+
+
+def next_break(data):
+    """Offset in data just past its first whitespace, or None if it has none."""
+    offsets = [data.find(space) for space in WHITESPACE]
+    offsets = [offset for offset in offsets if offset >= 0]
+    if offsets:
+        return min(offsets) + 1
+    return None
+
+
+def shard_bounds(key, shard_size):
+    """
+    (start, end) byte offsets of the shards of a stored text. Shards end just
+    past whitespace, or at the end of the text, so no word, and no UTF-8
+    character, is split between two: a shard without whitespace after its
+    nominal end runs on to the end of the text.
+    """
+    size = blobs.blob_size(key)
+    starts = [0]
+    with open(blobs.blob_path(key), "rb") as file:
+        while starts[-1] + shard_size < size:
+            position = starts[-1] + shard_size
+            file.seek(position)
+            while data := file.read(BREAK_SEARCH_SIZE):
+                offset = next_break(data)
+                if offset is not None:
+                    position += offset
+                    break
+                position += len(data)
+            if position >= size:
+                break
+            starts.append(position)
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def read_shard(key, start, end, overlap):
+    """Read a shard of a stored text, with up to overlap bytes of the text after it."""
+    with open(blobs.blob_path(key), "rb") as file:
+        file.seek(start)
+        data = file.read(end - start + overlap)
+
+    if len(data) == end - start + overlap:
+        # The text goes on past the overlap: end the overlap at whitespace too,
+        # so a word cut by it does not look like a whole word at the end of the
+        # data. Without whitespace in the overlap, it ends with the shard, which
+        # ends with whitespace itself.
+        cut = max(data.rfind(space, end - start - 1) for space in WHITESPACE)
+        if cut >= 0:
+            data = data[:cut + 1]
+    return data
+
+
+def match_shard(key, start, end):
+    """
+    Match the matcher patterns against one shard of a stored text. Returns
+    the [pattern, start, end] spans of the matches starting in the shard, as
+    byte offsets in the whole text.
+    """
+    patterns = load_patterns()
+    if not patterns:
+        return []
+
+    # The native extension is only needed where shards are matched
+    from regex_matcher import compile_patterns
+
+    data = read_shard(key, start, end, settings.MATCHER_SHARD_OVERLAP)
+    # Shards are matched in parallel by worker processes, so each uses a single thread
+    spans = memoryview(compile_patterns(patterns).match(data, num_threads=1)).tolist()
+    return [[pattern, start + match_start, start + match_end]
+            for pattern, match_start, match_end in spans if match_start < end - start]
+
+
+def merge_spans(shard_spans):
+    """
+    Merge the spans of every shard of a text, in (pattern, start) order. Like
+    the matcher itself, only the leftmost non-overlapping matches of each
+    pattern are kept, which drops matches that overlap one ending in the
+    previous shard.
+    """
+    spans = sorted(itertools.chain.from_iterable(shard_spans), key=lambda span: (span[0], span[1]))
+    merged = []
+    for span in spans:
+        if merged and merged[-1][0] == span[0] and span[1] < merged[-1][2]:
+            continue
+        merged.append(span)
+    return merged
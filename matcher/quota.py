@@ -0,0 +1,196 @@
+"""
+Per-user sentence allowances, counted in Redis.
+
+Each user has a counter of the sentences used in the current billing month,
+and the set of the content hashes of the texts that used them. Texts are
+priced against the counter when they are submitted, and only reserved in it
+when they are processed, once per text and month: processing the same text
+again, e.g. on a retry, is free. Both are done in one Lua script, so
+concurrent submissions of a user cannot both take the last of the allowance,
+and neither needs a database query. Counters that changed are listed in a set
+and periodically flushed to SentenceUsage; a counter missing from Redis, e.g.
+after a restart, is seeded again from there.
+"""
+import datetime
+import functools
+import logging
+import math
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import SentenceUsage
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "quota:sentences"
+TEXTS_KEY_PREFIX = "quota:texts"
+DIRTY_KEY = "quota:sentences:dirty"
+# Counters outlive their billing month long enough to be flushed
+COUNTER_TTL = 60 * 60 * 24 * 62
+UNLIMITED = -1
+
+# KEYS: counter, reserved texts set, dirty set. ARGV: allowance (-1 for none),
+# ttl, 1 to reserve or 0 to only price, then a content hash and sentence count
+# per text. Texts already reserved are free. The others fit, in order, while
+# they stay within the allowance, and are reserved if asked to. Returns, for
+# every text, the number of its sentences over the allowance (0 if it fits):
+# with usage already past the allowance, e.g. after a downgrade, a text is
+# charged for its own sentences, not for the excess before it too. Returns
+# nil if the counter does not exist yet.
+RESERVE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local allowance = tonumber(ARGV[1])
+local used = tonumber(redis.call('GET', KEYS[1]))
+local fitting = {}
+local reserved = {}
+local overages = {}
+for i = 4, #ARGV, 2 do
+    local text = ARGV[i]
+    local count = tonumber(ARGV[i + 1])
+    if fitting[text] or redis.call('SISMEMBER', KEYS[2], text) == 1 then
+        overages[#overages + 1] = 0
+    elseif allowance < 0 or used + count <= allowance then
+        used = used + count
+        fitting[text] = true
+        reserved[#reserved + 1] = text
+        overages[#overages + 1] = 0
+    else
+        overages[#overages + 1] = math.min(count, used + count - allowance)
+    end
+end
+if ARGV[3] == '1' and #reserved > 0 then
+    redis.call('SET', KEYS[1], used, 'EX', ARGV[2])
+    redis.call('SADD', KEYS[2], unpack(reserved))
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    redis.call('SADD', KEYS[3], KEYS[1])
+end
+return overages
+"""
+
+# KEYS: dirty set. ARGV: batch size. Takes a batch of changed counters off the
+# set and returns their keys and values, flattened, in one atomic step.
+POP_DIRTY_SCRIPT = """
+local keys = redis.call('SPOP', KEYS[1], ARGV[1])
+if #keys == 0 then
+    return {}
+end
+local values = redis.call('MGET', unpack(keys))
+local result = {}
+for i, key in ipairs(keys) do
+    result[#result + 1] = key
+    result[#result + 1] = values[i]
+end
+return result
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def get_client():
+    # The broker instance by default: unlike the cache, it never evicts keys
+    return redis.Redis.from_url(settings.QUOTA_REDIS_URL)
+
+
+@functools.lru_cache(maxsize=None)
+def get_script(script):
+    return get_client().register_script(script)
+
+
+def current_period():
+    """First day of the current billing month."""
+    return timezone.now().date().replace(day=1)
+
+
+def counter_key(username, period):
+    return f"{KEY_PREFIX}:{period:%Y-%m}:{username}"
+
+
+def texts_key(username, period):
+    return f"{TEXTS_KEY_PREFIX}:{period:%Y-%m}:{username}"
+
+
+def parse_counter_key(key):
+    period, username = key[len(KEY_PREFIX) + 1:].split(":", 1)
+    return username, datetime.datetime.strptime(period, "%Y-%m").date()
+
+
+def seed_counter(username, period):
+    # Only runs when the counter is missing from Redis, the one time the database is read
+    used = SentenceUsage.objects.filter(username=username, period=period).values_list(
+        "sentence_count", flat=True
+    ).first()
+    get_client().set(counter_key(username, period), used or 0, ex=COUNTER_TTL, nx=True)
+
+
+def run_reserve_script(username, allowance, texts, reserve):
+    period = current_period()
+    keys = [counter_key(username, period), texts_key(username, period), DIRTY_KEY]
+    allowance = UNLIMITED if math.isinf(allowance) else int(allowance)
+    args = [allowance, COUNTER_TTL, 1 if reserve else 0]
+    for text_hash, sentence_count in texts:
+        args += [text_hash, sentence_count]
+
+    script = get_script(RESERVE_SCRIPT)
+    overages = script(keys=keys, args=args)
+    if overages is None:
+        seed_counter(username, period)
+        overages = script(keys=keys, args=args)
+    return overages
+
+
+def check_sentences(username, allowance, texts):
+    """
+    Price (content hash, sentence count) texts, in order, against what is left
+    of the user's allowance for the current billing month, without using it.
+    Returns the number of sentences of each text that are over the allowance,
+    0 for texts that fit or were already reserved this month. Raises
+    redis.RedisError if Redis cannot be reached.
+    """
+    return run_reserve_script(username, allowance, texts, reserve=False)
+
+
+def reserve_sentences(username, allowance, texts):
+    """
+    Like check_sentences, but also reserve the sentences of the texts that fit
+    in the allowance. A text is only reserved once per month, so reserving it
+    again is free.
+    """
+    return run_reserve_script(username, allowance, texts, reserve=True)
+
+
+def flush_usage(batch_size=1000):
+    """Write every counter changed since the last flush to SentenceUsage; returns how many were written."""
+    client = get_client()
+    pop_dirty = get_script(POP_DIRTY_SCRIPT)
+    flushed = 0
+    while True:
+        result = pop_dirty(keys=[DIRTY_KEY], args=[batch_size])
+        if not result:
+            return flushed
+
+        keys = result[0::2]
+        usages = []
+        for key, value in zip(keys, result[1::2]):
+            # A counter that expired since it was marked has been flushed before
+            if value is not None:
+                username, period = parse_counter_key(key.decode())
+                usages.append(SentenceUsage(username=username, period=period, sentence_count=int(value)))
+
+        # Counters hold totals, so writing one again, or a newer value, is always safe
+        try:
+            with transaction.atomic():
+                SentenceUsage.objects.bulk_create(
+                    usages,
+                    update_conflicts=True,
+                    unique_fields=["username", "period"],
+                    update_fields=["sentence_count", "update_at"],
+                )
+        except Exception:
+            client.sadd(DIRTY_KEY, *keys)
+            raise
+        flushed += len(usages)
+        logger.info("flushed %d sentence usage counters", len(usages))
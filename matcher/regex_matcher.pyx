@@ -0,0 +1,294 @@
+# distutils: language=c++
+import hashlib
+import threading
+from collections import OrderedDict
+
+from libc.stdint cimport int64_t
+from libcpp.memory cimport shared_ptr
+from libcpp.vector cimport vector
+from libcpp.string cimport string
+from cpython.buffer cimport PyBUF_FORMAT, PyBUF_WRITABLE
+
+cdef extern from "PatternSet.h":
+    cdef struct MatchSpan:
+        int64_t pattern
+        int64_t start
+        int64_t end
+
+    cdef cppclass PatternSet:
+        PatternSet(vector[string] patterns) except + nogil
+        void match(const char* data, size_t size, vector[MatchSpan]& spans,
+                   unsigned int num_threads, size_t shard_size) except + nogil
+        size_t size()
+        size_t literalCount()
+
+cdef extern from "RegexMatcher.h":
+    cdef cppclass RegexMatcher:
+        RegexMatcher(string text, shared_ptr[PatternSet] pattern_set,
+                     unsigned int num_threads, size_t shard_size) except +
+        void match(vector[MatchSpan]& spans) except + nogil
+
+cdef extern from "StreamMatcher.h":
+    cdef cppclass StreamMatcher:
+        StreamMatcher(shared_ptr[PatternSet] pattern_set, size_t window) except +
+        void feed(const char* data, size_t size, vector[MatchSpan]& spans) except + nogil
+        void finish(vector[MatchSpan]& spans) except + nogil
+        int64_t position()
+
+cdef MatchSpan _empty_span
+
+cdef class MatchSpans:
+    """
+    Read-only (pattern_index, start, end) int64 triples, in (pattern, start) order.
+
+    Exposed through the buffer protocol as a C-contiguous array of shape (n, 3),
+    so ``memoryview(spans)`` or ``numpy.asarray(spans)`` share the native memory.
+    """
+    cdef vector[MatchSpan] spans
+    cdef Py_ssize_t shape[2]
+    cdef Py_ssize_t strides[2]
+
+    def __len__(self):
+        return self.spans.size()
+
+    def __getitem__(self, Py_ssize_t index):
+        if index < 0:
+            index += self.spans.size()
+        if index < 0 or index >= <Py_ssize_t>self.spans.size():
+            raise IndexError("span index out of range")
+        cdef MatchSpan span = self.spans[index]
+        return span.pattern, span.start, span.end
+
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        if flags & PyBUF_WRITABLE:
+            raise BufferError("MatchSpans is read-only")
+
+        self.shape[0] = self.spans.size()
+        self.shape[1] = 3
+        self.strides[0] = sizeof(MatchSpan)
+        self.strides[1] = sizeof(int64_t)
+
+        if self.spans.empty():
+            buffer.buf = &_empty_span
+        else:
+            buffer.buf = self.spans.data()
+        if flags & PyBUF_FORMAT:
+            buffer.format = 'q'
+        else:
+            buffer.format = NULL
+        buffer.internal = NULL
+        buffer.itemsize = sizeof(int64_t)
+        buffer.len = self.spans.size() * sizeof(MatchSpan)
+        buffer.ndim = 2
+        buffer.obj = self
+        buffer.readonly = 1
+        buffer.shape = self.shape
+        buffer.strides = self.strides
+        buffer.suboffsets = NULL
+
+    def __releasebuffer__(self, Py_buffer *buffer):
+        pass
+
+cdef class PyPatternSet:
+    """
+    A compiled set of byte-string patterns that can be matched against any
+    number of texts, from any number of threads.
+
+    Span pattern indices refer to positions in the original pattern list.
+    """
+    cdef shared_ptr[PatternSet] pattern_set
+
+    def __cinit__(self, patterns):
+        cdef vector[string] cpp_patterns
+        cdef PatternSet *pattern_set
+        for pattern in patterns:
+            cpp_patterns.push_back(pattern)
+        with nogil:
+            pattern_set = new PatternSet(cpp_patterns)
+        self.pattern_set.reset(pattern_set)
+
+    def __len__(self):
+        return self.pattern_set.get().size()
+
+    @property
+    def literal_count(self):
+        """Number of patterns handled by the single-pass literal automaton."""
+        return self.pattern_set.get().literalCount()
+
+    def match(self, const unsigned char[::1] text, unsigned int num_threads=0, size_t shard_size=1 << 20):
+        """Match every pattern against a bytes-like text and return its MatchSpans."""
+        cdef MatchSpans result = MatchSpans.__new__(MatchSpans)
+        cdef size_t size = text.shape[0]
+        cdef const char* data = <const char*>&text[0] if size else NULL
+        with nogil:
+            self.pattern_set.get().match(data, size, result.spans, num_threads, shard_size)
+        return result
+
+    def stream(self, size_t window=1 << 16):
+        """Return a new PyStreamMatcher for this pattern set."""
+        return PyStreamMatcher(self, window)
+
+cdef PyPatternSet _as_pattern_set(patterns):
+    if isinstance(patterns, PyPatternSet):
+        return patterns
+    return PyPatternSet(patterns)
+
+cdef class PyRegexMatcher:
+    cdef RegexMatcher *matcher
+
+    def __cinit__(self, string text, patterns, unsigned int num_threads=0, size_t shard_size=1 << 20):
+        cdef PyPatternSet pattern_set = _as_pattern_set(patterns)
+        self.matcher = new RegexMatcher(text, pattern_set.pattern_set, num_threads, shard_size)
+
+    def __dealloc__(self):
+        del self.matcher
+
+    def match(self):
+        cdef MatchSpans result = MatchSpans.__new__(MatchSpans)
+        with nogil:
+            self.matcher.match(result.spans)
+        return result
+
+cdef class PyStreamMatcher:
+    """
+    Match patterns against text supplied in chunks of bytes-like objects.
+
+    Matching state is carried across chunk boundaries and only a bounded tail
+    of the input is retained. Span offsets are absolute positions in the
+    stream. Fallback (non-literal) regex matches longer than ``window`` bytes
+    may be missed.
+    """
+    cdef StreamMatcher *matcher
+    cdef bint busy
+
+    def __cinit__(self, patterns, size_t window=1 << 16):
+        cdef PyPatternSet pattern_set = _as_pattern_set(patterns)
+        self.matcher = new StreamMatcher(pattern_set.pattern_set, window)
+
+    def __dealloc__(self):
+        del self.matcher
+
+    @property
+    def position(self):
+        return self.matcher.position()
+
+    cdef _acquire(self):
+        if self.busy:
+            raise RuntimeError("PyStreamMatcher is already in use by another thread")
+        self.busy = True
+
+    def feed(self, const unsigned char[::1] chunk):
+        """Append a chunk and return the spans it completed."""
+        cdef MatchSpans result = MatchSpans.__new__(MatchSpans)
+        cdef size_t size = chunk.shape[0]
+        cdef const char* data = <const char*>&chunk[0] if size else NULL
+        self._acquire()
+        try:
+            with nogil:
+                self.matcher.feed(data, size, result.spans)
+        finally:
+            self.busy = False
+        return result
+
+    def finish(self):
+        """Signal end of input and return the remaining spans."""
+        cdef MatchSpans result = MatchSpans.__new__(MatchSpans)
+        self._acquire()
+        try:
+            with nogil:
+                self.matcher.finish(result.spans)
+        finally:
+            self.busy = False
+        return result
+
+    def stream(self, chunks):
+        """Feed every chunk from an iterable, yielding (pattern_index, start, end) spans as they complete."""
+        for chunk in chunks:
+            yield from self.feed(chunk)
+        yield from self.finish()
+
+# Compiled pattern sets, most recently used last, keyed by pattern_fingerprint().
+_cache_lock = threading.Lock()
+_cache = OrderedDict()
+_cache_pattern_bytes = 0
+_cache_max_entries = 64
+_cache_max_pattern_bytes = 16 << 20
+_cache_hits = 0
+_cache_misses = 0
+
+def pattern_fingerprint(patterns):
+    """Stable hex digest identifying an ordered list of byte-string patterns."""
+    digest = hashlib.blake2b(digest_size=16)
+    for pattern in patterns:
+        digest.update(len(pattern).to_bytes(8, 'little'))
+        digest.update(pattern)
+    return digest.hexdigest()
+
+def compile_patterns(patterns):
+    """
+    Return a PyPatternSet for patterns, compiling it only if no identical
+    pattern list is in the in-process LRU cache.
+    """
+    global _cache_hits, _cache_misses, _cache_pattern_bytes
+
+    patterns = list(patterns)
+    key = pattern_fingerprint(patterns)
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None:
+            _cache.move_to_end(key)
+            _cache_hits += 1
+            return entry[0]
+        _cache_misses += 1
+
+    # Compile without holding the lock; a concurrent miss for the same key
+    # may compile twice, but only one result is kept.
+    pattern_set = PyPatternSet(patterns)
+    pattern_bytes = sum(len(pattern) for pattern in patterns)
+
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None:
+            _cache.move_to_end(key)
+            return entry[0]
+        _cache[key] = (pattern_set, pattern_bytes)
+        _cache_pattern_bytes += pattern_bytes
+        _evict()
+    return pattern_set
+
+cdef _evict():
+    global _cache_pattern_bytes
+    while _cache and (len(_cache) > _cache_max_entries or _cache_pattern_bytes > _cache_max_pattern_bytes):
+        _, (_, pattern_bytes) = _cache.popitem(last=False)
+        _cache_pattern_bytes -= pattern_bytes
+
+def configure_pattern_cache(max_entries=None, max_pattern_bytes=None):
+    """Set the pattern cache limits, evicting least recently used sets as needed."""
+    global _cache_max_entries, _cache_max_pattern_bytes
+    with _cache_lock:
+        if max_entries is not None:
+            _cache_max_entries = max_entries
+        if max_pattern_bytes is not None:
+            _cache_max_pattern_bytes = max_pattern_bytes
+        _evict()
+
+def pattern_cache_info():
+    """Return hit/miss counters, current size and limits of the pattern cache."""
+    with _cache_lock:
+        return {
+            "hits": _cache_hits,
+            "misses": _cache_misses,
+            "entries": len(_cache),
+            "pattern_bytes": _cache_pattern_bytes,
+            "max_entries": _cache_max_entries,
+            "max_pattern_bytes": _cache_max_pattern_bytes,
+        }
+
+def clear_pattern_cache():
+    """Drop every cached pattern set and reset the counters."""
+    global _cache_hits, _cache_misses, _cache_pattern_bytes
+    with _cache_lock:
+        _cache.clear()
+        _cache_pattern_bytes = 0
+        _cache_hits = 0
+        _cache_misses = 0
\ No newline at end of file
@@ -1,10 +1,28 @@
 from rest_framework import serializers
-from django.core.validators import MinValueValidator
+from django.conf import settings
 
 
 class MatcherSerializer(serializers.Serializer):
-    username = serializers.CharField(required=False, allow_blank=True)
-    level = serializers.IntegerField(required=True, validators=[MinValueValidator(0)])
+    username = serializers.CharField(max_length=150, required=False, allow_blank=True)
+    language = serializers.CharField(required=True, allow_blank=False)
+    title = serializers.CharField(max_length=50, required=False, allow_blank=True)
+    text = serializers.CharField(required=False, allow_blank=False)
+    file = serializers.FileField(required=False, allow_empty_file=False)
+    mode = serializers.ChoiceField(choices=["sync", "async"], required=False, default="sync")
+
+    def validate(self, data):
+        # The text is sent either in the request or as an uploaded UTF-8 text file
+        if ("text" in data) == ("file" in data):
+            raise serializers.ValidationError("Provide either text or file.")
+        return data
+
+
+class MatcherDocumentSerializer(serializers.Serializer):
     language = serializers.CharField(required=True, allow_blank=False)
     title = serializers.CharField(max_length=50, required=False, allow_blank=True)
     text = serializers.CharField(required=True, allow_blank=False)
+
+
+class BulkMatcherSerializer(serializers.Serializer):
+    username = serializers.CharField(required=False, allow_blank=True)
+    documents = MatcherDocumentSerializer(many=True, allow_empty=False, max_length=settings.MATCHER_BULK_MAX_DOCUMENTS)
@@ -1,12 +1,13 @@
-from distutils.core import setup
-from distutils.extension import Extension
+from setuptools import Extension, setup
 from Cython.Build import cythonize
 
 extensions = [
-    Extension("regex_matcher", ["regex_matcher.pyx", "RegexMatcher.cpp"],
+    Extension("regex_matcher", ["regex_matcher.pyx", "PatternSet.cpp", "RegexMatcher.cpp",
+                                "StreamMatcher.cpp", "AhoCorasick.cpp"],
               language="c++")
 ]
 
 setup(
+    name="regex_matcher",
     ext_modules=cythonize(extensions)
 )
@@ -1,84 +1,379 @@
 # tasks.py
-from celery import shared_task
-from celery.result import AsyncResult
+from celery import chord, shared_task
+from celery.result import AsyncResult, allow_join_result
+from django.conf import settings
+from django.core.cache import cache
+from redis import RedisError
+import hashlib
+import logging
 import re
-import time
+
+from . import blobs, processing, quota
+from .fingerprints import check_existing_text, content_hash, record_text
+
+logger = logging.getLogger(__name__)
+
+
+class SentenceCounter:
+    """
+    Counts the non-blank fragments left after splitting text on a set of
+    punctuation characters, without building the fragments themselves.
+    """
+
+    def __init__(self, punctuation):
+        self.punctuation = punctuation
+        punctuation = re.escape(punctuation)
+        # A sentence starts at its first non-blank character and runs to the
+        # next punctuation mark, so each match is one non-blank fragment. The
+        # empty group makes findall() return the shared '' for every match
+        # instead of copying the sentence out of the text.
+        self.sentence_pattern = re.compile(rf'[^{punctuation}\s][^{punctuation}]*()')
+        # Matches when the chunk has text before its first punctuation mark
+        self.leading_pattern = re.compile(rf'[^{punctuation}]*?[^{punctuation}\s]')
+        self.non_blank_pattern = re.compile(r'\S')
+
+    def count(self, text):
+        """Count sentences in a string or in an iterable of string chunks."""
+        chunks = (text,) if isinstance(text, str) else text
+
+        count = 0
+        # Whether the text so far ends inside a sentence that was already counted
+        in_sentence = False
+        for chunk in chunks:
+            sentences = len(self.sentence_pattern.findall(chunk))
+            if sentences and in_sentence and self.leading_pattern.match(chunk):
+                # The first sentence continues the one the previous chunk ended in
+                sentences -= 1
+            count += sentences
+
+            last_mark = max(chunk.rfind(mark) for mark in self.punctuation)
+            if last_mark < 0:
+                in_sentence = in_sentence or bool(self.non_blank_pattern.search(chunk))
+            else:
+                in_sentence = bool(self.non_blank_pattern.search(chunk, last_mark + 1))
+
+        return count
+
+
+# Language-specific punctuation for sentence splitting, compiled once at import
+SENTENCE_COUNTERS = {
+    'Japanese': SentenceCounter('！？。…‥'),
+    'Korean': SentenceCounter('.?!…,'),
+    'English': SentenceCounter('.?!…,'),
+    # Add more languages as needed
+}
+
+DEFAULT_SENTENCE_COUNTER = SentenceCounter('.!?')
 
 
 def count_sentences(text, language_name):
-    # Define language-specific punctuation patterns for sentence splitting
-    punctuation_patterns = {
-        'Japanese': r'[！？。…‥]',
-        'Korean': r'[.?!…,]',
-        'English': r'[.?!…,]',
-        # Add more languages as needed
-    }
+    # text may be a string or an iterable of string chunks
+    counter = SENTENCE_COUNTERS.get(language_name, DEFAULT_SENTENCE_COUNTER)
+    return counter.count(text)
 
-    # Get the punctuation pattern for the specified language
-    punctuation_pattern = punctuation_patterns.get(language_name, r'[.!?]')
 
-    # Tokenize the text into sentences using the punctuation pattern
-    sentences = re.split(punctuation_pattern, text)
+def sentence_count_key(text_hash, language_name):
+    # Cache key addressed by the content, so resubmitting a text finds its count
+    digest = hashlib.sha256(language_name.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(text_hash.encode("ascii"))
+    return f"matcher:sentence_count:{digest.hexdigest()}"
 
-    # Filter out empty sentences
-    sentences = [sentence.strip() for sentence in sentences if sentence.strip()]
 
-    # Return the count of sentences
-    return len(sentences)
+def get_cached_sentence_counts(keys):
+    # A cache outage must not fail the request, the texts are counted instead
+    try:
+        return cache.get_many(keys)
+    except Exception as e:
+        logger.warning("Sentence count cache unavailable: %s", e)
+        return {}
 
 
-def check_payment_required(user_level, sentence_count):
-    # Define maximum sentence counts for different user levels
-    max_sentence_counts = {
-        1: 1500,
-        2: 3000,
-        3: 7000,
-        4: float('inf')  # No maximum for level 4
-    }
+def set_cached_sentence_counts(counts):
+    try:
+        cache.set_many(counts, settings.MATCHER_COUNT_CACHE_TTL)
+    except Exception as e:
+        logger.warning("Sentence count cache unavailable: %s", e)
+
 
-    # Define the price multiplier for sentences over the maximum count
-    price_multiplier = 0.052
+def get_cached_sentence_count(text_hash, language_name):
+    """Cached sentence count of a text, by its content_hash(), or None."""
+    key = sentence_count_key(text_hash, language_name)
+    return get_cached_sentence_counts([key]).get(key)
 
+
+def cached_count_sentences(documents):
+    """
+    Sentence counts of a list of (text hash, text, language) items, looked up
+    in and stored to the cache in one round trip each. A text may be a string
+    or an iterable of string chunks; it is only read on a cache miss.
+    """
+    keys = [sentence_count_key(text_hash, language_name) for text_hash, text, language_name in documents]
+    counts = get_cached_sentence_counts(keys)
+
+    missing = {}
+    for key, (text_hash, text, language_name) in zip(keys, documents):
+        if key not in counts and key not in missing:
+            missing[key] = count_sentences(text, language_name)
+    if missing:
+        set_cached_sentence_counts(missing)
+        counts.update(missing)
+
+    return [counts[key] for key in keys]
+
+
+# Maximum sentence counts for different user levels
+MAX_SENTENCE_COUNTS = {
+    1: 1500,
+    2: 3000,
+    3: 7000,
+    4: float('inf')  # No maximum for level 4
+}
+
+# Price multiplier for sentences over the maximum count
+PRICE_MULTIPLIER = 0.052
+
+
+def check_payment_required(user_level, sentence_count):
     # Get the maximum sentence count for the user's level
-    max_sentence_count = max_sentence_counts.get(user_level, 0)
+    max_sentence_count = MAX_SENTENCE_COUNTS.get(user_level, 0)
 
     # Check if the actual sentence count exceeds the maximum count
     if sentence_count > max_sentence_count:
         # Calculate the additional payment required
         extra_sentences = sentence_count - max_sentence_count
-        additional_payment = extra_sentences * price_multiplier
+        additional_payment = extra_sentences * PRICE_MULTIPLIER
         return True, additional_payment
     else:
         return False, 0
 
 
-@shared_task
-def count_and_check_payment(username, language_name, title, text, user_level):
+def check_payment_required_bulk(user_level, sentence_counts):
+    # Same rule as check_payment_required, with the level lookup done once for the whole batch
+    max_sentence_count = MAX_SENTENCE_COUNTS.get(user_level, 0)
+    return [
+        (True, (sentence_count - max_sentence_count) * PRICE_MULTIPLIER)
+        if sentence_count > max_sentence_count else (False, 0)
+        for sentence_count in sentence_counts
+    ]
+
+
+def check_usage_payment_required(quota_user, user_level, texts, reserve=False):
+    """
+    Price (content hash, sentence count) texts against the sentence allowance
+    of the signed-in user quota_user for the current billing month. With
+    reserve, the sentences of each text that fits are also reserved in it,
+    once per text and month. Texts of anonymous requests, and all texts while
+    the quota counters are unreachable or not configured, are priced on their
+    own as check_payment_required_bulk does.
+    """
+    if quota_user and settings.QUOTA_REDIS_URL:
+        check = quota.reserve_sentences if reserve else quota.check_sentences
+        try:
+            overages = check(quota_user, MAX_SENTENCE_COUNTS.get(user_level, 0), texts)
+        except RedisError as e:
+            logger.warning("Sentence quota unavailable: %s", e)
+        else:
+            return [(True, overage * PRICE_MULTIPLIER) if overage else (False, 0) for overage in overages]
+    return check_payment_required_bulk(user_level, [sentence_count for text_hash, sentence_count in texts])
+
+
+def payment_result(payment_required, sentences_counts):
+    if payment_required:
+        return {"message": "Payment is required.", "status": "payment_required", "sentence_count": sentences_counts}
+    else:
+        return {"message": "No payment required.", "status": "no_payment_required",
+                "sentence_count": sentences_counts}
+
+
+def text_chunks(text, blob_key):
+    # A text is passed either inline or as the key of a stored blob, which is streamed
+    return text if blob_key is None else blobs.iter_text(blob_key)
+
+
+@shared_task(serializer=settings.MATCHER_TASK_SERIALIZER)
+def count_and_check_payment(username, language_name, title, text, user_level, blob_key=None, quota_user=None):
     try:
-        # Check if the text already exists, existing text already set to false
-        existing_text = False
+        # The blob key is the content hash of the stored text
+        text_hash = blob_key or content_hash(text)
+
+        # Check if the text, or another text with the same title, already exists
+        # Only documents of the signed-in user are checked, never those of the username the request names
+        existing_text = check_existing_text(
+            quota_user, title, language_name, text_chunks(text, blob_key), text_hash
+        )
         if existing_text:
-            return {"message": "Text with the same title already exists.", "status": "error"}
+            return {"message": existing_text, "status": "duplicate"}
 
-        # Count sentences
-        sentence_count = count_sentences(text, language_name)
+        # Count sentences, or reuse the count of an earlier submission of the same text
+        sentence_count, = cached_count_sentences([(text_hash, text_chunks(text, blob_key), language_name)])
 
-        # Determine if payment is required
-        payment_required, sentences_counts = check_payment_required(user_level, sentence_count)
+        # Determine if payment is required. The allowance is only used once the text is processed.
+        return payment_result(*check_usage_payment_required(quota_user, user_level, [(text_hash, sentence_count)])[0])
 
-        if payment_required:
-            return {"message": "Payment is required.", "status": "payment_required", "sentence_count": sentences_counts}
-        else:
-            return {"message": "No payment required.", "status": "no_payment_required",
-                    "sentence_count": sentences_counts}
+    except Exception as e:
+        return {"error": str(e), "status": "error"}
+
+
+@shared_task(serializer=settings.MATCHER_TASK_SERIALIZER)
+def count_and_check_payment_bulk(username, user_level, documents, quota_user=None):
+    """
+    Count and price a batch of documents in one task.
+
+    documents is a list of (language, title, text) items, priced against the
+    allowance of the signed-in user quota_user, if any. Returns one
+    count_and_check_payment style result per document, plus the total
+    number of sentences of the batch.
+    """
+    try:
+        # Count sentences, reusing the counts of earlier submissions
+        text_hashes = [content_hash(text) for language_name, title, text in documents]
+        sentence_counts = cached_count_sentences([
+            (text_hash, text, language_name) for text_hash, (language_name, title, text) in zip(text_hashes, documents)
+        ])
+
+        # Determine if payment is required, for the whole batch at once. The
+        # documents are only priced, so none of the allowance is used.
+        texts = list(zip(text_hashes, sentence_counts))
+        results = [
+            dict(payment_result(payment_required, sentences_counts), title=title)
+            for (language_name, title, text), (payment_required, sentences_counts)
+            in zip(documents, check_usage_payment_required(quota_user, user_level, texts))
+        ]
+
+        return {
+            "status": "success",
+            "results": results,
+            # Not the sum of the results' sentence_count, which, as in count_and_check_payment, holds their payment
+            "total_sentence_count": sum(sentence_counts),
+        }
 
     except Exception as e:
         return {"error": str(e), "status": "error"}
 
 
+def needs_processing(data):
+    # The text is processed only when count_and_check_payment found no payment is required
+    return data["status"] == "no_payment_required"
+
+
+def reserve_usage(quota_user, user_level, language_name, text, blob_key):
+    """
+    Reserve the sentences of a text about to be processed in the allowance of
+    the signed-in user quota_user. Returns the payment_result() of the
+    reservation, which requires payment if the user's other texts used up
+    the allowance since the text was priced.
+    """
+    text_hash = blob_key or content_hash(text)
+    # Counted when the text was priced, so this is normally a cache hit
+    sentence_count, = cached_count_sentences([(text_hash, text_chunks(text, blob_key), language_name)])
+    return payment_result(
+        *check_usage_payment_required(quota_user, user_level, [(text_hash, sentence_count)], reserve=True)[0]
+    )
+
+
+@shared_task(bind=True, serializer=settings.MATCHER_TASK_SERIALIZER)
+def process_counted_text(self, data, text=None, blob_key=None, user_level=None, language_name=None,
+                         quota_user=None, title=None):
+    """
+    Second step of the matcher workflow: process the text if the
+    count_and_check_payment result passed in allows it, using up the
+    sentences of the text in the allowance of quota_user and recording it as
+    one of their documents. Returns that result, or, when the text is
+    processed, is replaced by the process_text() chord, which adds the
+    matches of the text to it under "processed".
+    """
+    if not needs_processing(data):
+        return data
+    if quota_user and settings.QUOTA_REDIS_URL:
+        data = reserve_usage(quota_user, user_level, language_name, text, blob_key)
+        if not needs_processing(data):
+            return data
+    if quota_user:
+        # Another request of the user may have recorded a duplicate since the text was checked
+        existing_text = record_text(
+            quota_user, title, language_name, text_chunks(text, blob_key), blob_key or content_hash(text)
+        )
+        if existing_text:
+            return {"message": existing_text, "status": "duplicate"}
+    if self.request.is_eager:
+        # Run eagerly, the chord is applied and waited for in this task
+        with allow_join_result():
+            return self.replace(process_text(data, text, blob_key, user_level))
+    return self.replace(process_text(data, text, blob_key, user_level))
+
+
+def level_options(user_level):
+    """
+    Celery options for a task run on behalf of a user of the given level:
+    higher levels go to the priority queue instead of the task's own route.
+    """
+    if user_level is not None and user_level >= settings.MATCHER_PRIORITY_MIN_LEVEL:
+        return {"queue": settings.PRIORITY_QUEUE}
+    return {}
+
+
+def matcher_workflow(username, language_name, title, text, user_level, blob_key=None, quota_user=None):
+    """
+    Count, price and process a text as one Celery chain. The processing
+    decision is taken on the worker, so the caller waits on a single result.
+    """
+    options = level_options(user_level)
+    return (
+        count_and_check_payment.s(
+            username, language_name, title, text, user_level, blob_key=blob_key, quota_user=quota_user
+        ).set(**options)
+        | process_counted_text.s(
+            text=text, blob_key=blob_key, user_level=user_level, language_name=language_name, quota_user=quota_user,
+            title=title
+        ).set(**options)
+    )
+
+
+@shared_task
+def purge_expired_blobs():
+    # Blobs only need to outlive the tasks that read them
+    return blobs.purge_blobs(settings.MATCHER_BLOB_MAX_AGE)
+
+
 @shared_task
-def process_text():
-    print("Start processing text...")
-    time.sleep(3)
-    print("Finish processing text...")
-    return {"message": "Process finished", "status": "success"}
+def flush_sentence_usage():
+    if not settings.QUOTA_REDIS_URL:
+        return 0
+    return quota.flush_usage()
+
+
+@shared_task(serializer=settings.MATCHER_TASK_SERIALIZER)
+def match_shard(blob_key, start, end):
+    return processing.match_shard(blob_key, start, end)
+
+
+@shared_task(serializer=settings.MATCHER_TASK_SERIALIZER)
+def merge_shard_matches(shard_spans, data):
+    spans = processing.merge_spans(shard_spans)
+    data["processed"] = {"message": "Process finished", "status": "success", "match_count": len(spans),
+                         "matches": spans}
+    return data
+
+
+def process_text(data, text=None, blob_key=None, user_level=None):
+    """
+    Match a text, passed inline or as the key of a stored blob, against the
+    matcher patterns as a map-reduce chord: a match_shard task per shard of
+    the text, run in parallel, whose spans merge_shard_matches merges and
+    adds to data under "processed". Without patterns there is nothing to
+    match, so the text is neither stored nor split.
+    """
+    if not processing.load_patterns():
+        return merge_shard_matches.si([], data).set(**level_options(user_level))
+
+    if blob_key is None:
+        # Shards are read from a blob, so a text passed inline is stored first
+        blob_key, _ = blobs.store_text(text)
+
+    options = level_options(user_level)
+    return chord(
+        [match_shard.si(blob_key, start, end).set(**options)
+         for start, end in processing.shard_bounds(blob_key, settings.MATCHER_SHARD_SIZE)],
+        merge_shard_matches.s(data).set(**options),
+    )
@@ -20,5 +20,6 @@ patterns = [pattern.encode('utf-8') for pattern in patterns]
 
 # Create PyRegexMatcher instance and perform matching
 matcher = PyRegexMatcher(text, patterns)
-matcher.match()
+spans = matcher.match()
+print(len(spans), "matches")
 print(time.time() - start)
@@ -1,3 +1,680 @@
-from django.test import TestCase
+import datetime
+import math
+import os
+import random
+import re
+import tempfile
+import time
+import uuid
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+import kombu.serialization
+from celery.exceptions import TimeoutError
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError
+from django.test import AsyncClient, SimpleTestCase, TestCase, override_settings
+
+from core import serialization
+from core.celery import app
+import regex_matcher
+from regex_matcher import PyPatternSet
+
+from . import blobs, dispatch, fingerprints, processing, quota, tasks, views
+from .models import DocumentFingerprint, SentenceUsage
+
+LITERAL_PATTERNS = [rb"cat", rb"at", rb"aa", rb"dog", rb"do"]
+BOUNDARY_PATTERNS = [rb"\bcat\b", rb"\bdo", rb"g\b", rb"\baa\b"]
+REGEX_PATTERNS = [rb"c[a-z]+t", rb"\d+", rb"[A-Z][a-z]*", rb"\bdo(g|t)s?\b"]
+ALL_PATTERNS = LITERAL_PATTERNS + BOUNDARY_PATTERNS + REGEX_PATTERNS
+
+WORDS = [b"cat", b"at", b"aaa", b"dog", b"dogs", b"dot", b"Cat", b"concat", b"x1", b"42", b"do_g"]
+SEPARATORS = [b" ", b"  ", b".", b"\n", b""]
+
+
+def random_text(rnd, size, words=WORDS, separators=SEPARATORS):
+    text = b""
+    while len(text) < size:
+        text += rnd.choice(words) + rnd.choice(separators)
+    return text
+
+
+def python_spans(patterns, text):
+    """The spans Python's re finds: the leftmost non-overlapping matches of each pattern."""
+    return [[index, match.start(), match.end()]
+            for index, pattern in enumerate(patterns) for match in re.finditer(pattern, text)]
+
+
+def stream_spans(pattern_set, chunks, window=1 << 16):
+    stream = pattern_set.stream(window=window)
+    spans = [list(span) for span in stream.stream(chunks)]
+    return sorted(spans)
+
+
+def random_chunks(rnd, text):
+    chunks = []
+    position = 0
+    while position < len(text):
+        size = rnd.randint(1, 40)
+        chunks.append(text[position:position + size])
+        position += size
+    return chunks
+
+
+class PatternSetTests(SimpleTestCase):
+    def assertMatchesPython(self, patterns, texts):
+        pattern_set = PyPatternSet(patterns)
+        for text in texts:
+            with self.subTest(text=text[:60]):
+                spans = memoryview(pattern_set.match(text)).tolist()
+                self.assertEqual(spans, python_spans(patterns, text))
+
+    def test_literal_patterns(self):
+        pattern_set = PyPatternSet(LITERAL_PATTERNS)
+        self.assertEqual(pattern_set.literal_count, len(LITERAL_PATTERNS))
+        rnd = random.Random(1)
+        self.assertMatchesPython(LITERAL_PATTERNS, [b"", b"aaaa", b"concatenate dogdo"]
+                                 + [random_text(rnd, 200) for _ in range(50)])
+
+    def test_word_boundary_patterns(self):
+        rnd = random.Random(2)
+        self.assertMatchesPython(BOUNDARY_PATTERNS, [b"cat", b"cats cat. _cat do_g dog", b"aa aaa aa"]
+                                 + [random_text(rnd, 200) for _ in range(50)])
+
+    def test_fallback_regex_patterns(self):
+        pattern_set = PyPatternSet(REGEX_PATTERNS)
+        self.assertEqual(pattern_set.literal_count, 0)
+        rnd = random.Random(3)
+        self.assertMatchesPython(REGEX_PATTERNS, [b"Cat concat x42 dots dogs"]
+                                 + [random_text(rnd, 200) for _ in range(50)])
+
+    def test_matches_across_shard_boundaries(self):
+        pattern_set = PyPatternSet(ALL_PATTERNS)
+        rnd = random.Random(4)
+        for _ in range(30):
+            text = random_text(rnd, 2000)
+            expected = python_spans(ALL_PATTERNS, text)
+            for shard_size in (1, 7, 64):
+                with self.subTest(shard_size=shard_size):
+                    spans = memoryview(pattern_set.match(text, num_threads=4, shard_size=shard_size)).tolist()
+                    self.assertEqual(spans, expected)
+
+    def test_matches_across_stream_chunk_boundaries(self):
+        pattern_set = PyPatternSet(ALL_PATTERNS)
+        rnd = random.Random(5)
+        for _ in range(30):
+            text = random_text(rnd, 2000)
+            expected = sorted(python_spans(ALL_PATTERNS, text))
+            self.assertEqual(stream_spans(pattern_set, random_chunks(rnd, text)), expected)
+
+            # Regex matches are only reported once a window of text past them
+            # has arrived, or at the end of the stream. Longer ones may be
+            # missed, so no word runs into the next here.
+            text = random_text(rnd, 2000, separators=SEPARATORS[:-1])
+            expected = sorted(python_spans(ALL_PATTERNS, text))
+            self.assertEqual(stream_spans(pattern_set, random_chunks(rnd, text), window=16), expected)
+
+
+class PatternCacheTests(SimpleTestCase):
+    def setUp(self):
+        info = regex_matcher.pattern_cache_info()
+        self.addCleanup(regex_matcher.configure_pattern_cache, info["max_entries"], info["max_pattern_bytes"])
+        self.addCleanup(regex_matcher.clear_pattern_cache)
+        regex_matcher.clear_pattern_cache()
+
+    def test_identical_patterns_are_compiled_once(self):
+        pattern_set = regex_matcher.compile_patterns(ALL_PATTERNS)
+        self.assertIs(regex_matcher.compile_patterns(list(ALL_PATTERNS)), pattern_set)
+        self.assertIsNot(regex_matcher.compile_patterns(ALL_PATTERNS[1:]), pattern_set)
+
+        info = regex_matcher.pattern_cache_info()
+        self.assertEqual((info["hits"], info["misses"], info["entries"]), (1, 2, 2))
+        text = b"cat concat dog 42"
+        self.assertEqual(memoryview(pattern_set.match(text)).tolist(), python_spans(ALL_PATTERNS, text))
+
+    def test_least_recently_used_sets_are_evicted(self):
+        regex_matcher.configure_pattern_cache(max_entries=2)
+        first = regex_matcher.compile_patterns([b"a"])
+        regex_matcher.compile_patterns([b"b"])
+        regex_matcher.compile_patterns([b"a"])
+        regex_matcher.compile_patterns([b"c"])
+
+        self.assertEqual(regex_matcher.pattern_cache_info()["entries"], 2)
+        self.assertIs(regex_matcher.compile_patterns([b"a"]), first)
+        misses = regex_matcher.pattern_cache_info()["misses"]
+        regex_matcher.compile_patterns([b"b"])
+        self.assertEqual(regex_matcher.pattern_cache_info()["misses"], misses + 1)
+
+        regex_matcher.configure_pattern_cache(max_pattern_bytes=0)
+        self.assertEqual(regex_matcher.pattern_cache_info()["entries"], 0)
+
+
+class StreamMatcherTests(SimpleTestCase):
+    def test_regex_match_longer_than_window_is_dropped(self):
+        # A fallback regex match that keeps growing past the window used to
+        # pin the retained tail, which grew and was rescanned on every feed
+        # until std::regex overflowed the stack.
+        stream = PyPatternSet([rb"x[a-z ]*", rb"\bend\b"]).stream(window=1 << 16)
+        stream.feed(b"x")
+        for _ in range(40):
+            self.assertEqual(len(stream.feed(b"ab cd " * 4096)), 0)
+        position = stream.position
+        spans = [tuple(span) for span in stream.feed(b"0 end 0")] + [tuple(span) for span in stream.finish()]
+        self.assertEqual(spans, [(1, position + 2, position + 5)])
+
+
+class ShardTests(SimpleTestCase):
+    def setUp(self):
+        blob_root = tempfile.TemporaryDirectory()
+        self.addCleanup(blob_root.cleanup)
+        settings = override_settings(MATCHER_BLOB_ROOT=blob_root.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_shards_never_split_a_word(self):
+        # Words longer than BREAK_SEARCH_SIZE: the nominal end of each shard
+        # falls in one, and its shard ends at the next whitespace, or at the
+        # end of the text when there is none
+        word = "c" * (2 * processing.BREAK_SEARCH_SIZE)
+        text = f"ab {word} ab {word}"
+        key, _ = blobs.store_text(text)
+        second = len(f"ab {word} ")
+        self.assertEqual(processing.shard_bounds(key, 4), [(0, second), (second, len(text))])
+
+    def test_matches_across_shard_boundaries(self):
+        with tempfile.NamedTemporaryFile(delete=False) as patterns_file:
+            patterns_file.write(b"\n".join(ALL_PATTERNS))
+        self.addCleanup(os.unlink, patterns_file.name)
+        self.addCleanup(processing.load_patterns.cache_clear)
+        processing.load_patterns.cache_clear()
+
+        rnd = random.Random(6)
+        with self.settings(MATCHER_PATTERNS_FILE=patterns_file.name, MATCHER_SHARD_OVERLAP=32):
+            for _ in range(20):
+                text = random_text(rnd, 3000)
+                key, _ = blobs.store_text(text.decode())
+                shard_spans = [processing.match_shard(key, start, end)
+                               for start, end in processing.shard_bounds(key, rnd.choice([16, 100, 500]))]
+                self.assertEqual(processing.merge_spans(shard_spans), python_spans(ALL_PATTERNS, text))
+
+
+class AsyncViewCsrfTests(TestCase):
+    url = "/api/matcher/async/"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user("alice", password="secret")
+
+    async def test_session_requests_need_a_csrf_token(self):
+        client = AsyncClient(enforce_csrf_checks=True)
+
+        # Without a session there is nothing to forge, the body is parsed as usual
+        response = await client.post(self.url, b"not json", content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+        await client.aforce_login(self.user)
+        response = await client.post(self.url, b"not json", content_type="application/json")
+        self.assertEqual(response.status_code, 403)
+        self.assertIn("CSRF Failed", response.json()["detail"])
+
+        response = await client.get("/admin/login/")
+        token = response.cookies["csrftoken"].value
+        response = await client.post(self.url, b"not json", content_type="application/json",
+                                     headers={"X-CSRFToken": token})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(QUOTA_REDIS_URL="redis://quota")
+class QuotaTests(TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+        patcher = mock.patch.object(quota, "get_client", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(quota.get_script.cache_clear)
+        quota.get_script.cache_clear()
+        self.period = quota.current_period()
+
+    def used(self, username):
+        return int(self.redis.get(quota.counter_key(username, self.period)))
+
+    def test_texts_are_priced_in_order_without_using_the_allowance(self):
+        SentenceUsage.objects.create(username="alice", period=self.period, sentence_count=2)
+        texts = [("a", 4), ("b", 4), ("c", 4)]
+        self.assertEqual(quota.check_sentences("alice", 10, texts), [0, 0, 4])
+        self.assertEqual(quota.check_sentences("alice", 10, texts), [0, 0, 4])
+        self.assertEqual(self.used("alice"), 2)
+        self.assertEqual(quota.check_sentences("alice", math.inf, texts), [0, 0, 0])
+
+    def test_overage_is_at_most_the_sentences_of_the_text(self):
+        # Usage past the allowance, e.g. after a downgrade, is not charged again
+        SentenceUsage.objects.create(username="alice", period=self.period, sentence_count=5000)
+        self.assertEqual(quota.check_sentences("alice", 0, [("a", 10)]), [10])
+        self.assertEqual(quota.check_sentences("alice", 4995, [("a", 10)]), [10])
+        self.assertEqual(quota.check_sentences("alice", 5005, [("a", 10)]), [5])
+
+    def test_texts_are_reserved_once_per_month(self):
+        self.assertEqual(quota.reserve_sentences("alice", 10, [("a", 4)]), [0])
+        self.assertEqual(quota.reserve_sentences("alice", 10, [("a", 4), ("a", 4)]), [0, 0])
+        self.assertEqual(self.used("alice"), 4)
+
+        # A text that does not fit is not reserved
+        self.assertEqual(quota.reserve_sentences("alice", 10, [("b", 8)]), [2])
+        self.assertEqual(self.used("alice"), 4)
+        self.assertEqual(quota.reserve_sentences("alice", math.inf, [("b", 8)]), [0])
+        self.assertEqual(self.used("alice"), 12)
+        self.assertEqual(quota.check_sentences("bob", 10, [("a", 4)]), [0])
+
+    def test_changed_counters_are_flushed(self):
+        quota.reserve_sentences("alice", 10, [("a", 4)])
+        quota.reserve_sentences("bob", 10, [("a", 3), ("b", 5)])
+        self.assertEqual(tasks.flush_sentence_usage(), 2)
+        self.assertEqual(tasks.flush_sentence_usage(), 0)
+        usage = SentenceUsage.objects.filter(period=self.period).values_list("username", "sentence_count")
+        self.assertEqual(dict(usage), {"alice": 4, "bob": 8})
+
+        # Counters that could not be written stay marked for the next flush
+        quota.reserve_sentences("alice", 10, [("c", 1)])
+        with mock.patch.object(SentenceUsage.objects, "bulk_create", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                tasks.flush_sentence_usage()
+        self.assertEqual(tasks.flush_sentence_usage(), 1)
+        self.assertEqual(SentenceUsage.objects.get(username="alice", period=self.period).sentence_count, 5)
+
+        # A counter missing from Redis is seeded from the flushed usage
+        self.redis.flushall()
+        self.assertEqual(quota.check_sentences("alice", 10, [("d", 6)]), [1])
+
+
+class FingerprintTests(TestCase):
+    text = "The quick brown fox jumps over the lazy dog. " * 20
+
+    def record(self, username, title, text):
+        return fingerprints.record_text(username, title, "English", text, fingerprints.content_hash(text))
+
+    def check(self, username, title, text):
+        return fingerprints.check_existing_text(username, title, "English", text, fingerprints.content_hash(text))
+
+    def test_simhash_is_stable(self):
+        # Stored fingerprints must keep matching, so the value must not change between releases
+        self.assertEqual(fingerprints.simhash("The quick brown fox jumps over the lazy dog"), 8459713369324106103)
+        rnd = random.Random(8)
+        text = random_text(rnd, 3000).decode()
+        value = fingerprints.simhash(text)
+        for _ in range(10):
+            chunks = [chunk.decode() for chunk in random_chunks(rnd, text.encode())]
+            self.assertEqual(fingerprints.simhash(chunks), value)
+        self.assertEqual(fingerprints.simhash(text.upper()), value)
+
+    def test_near_duplicates_share_a_band(self):
+        self.record("alice", "first", self.text)
+        value = fingerprints.simhash(self.text)
+        self.assertEqual(fingerprints.to_unsigned(fingerprints.to_signed(value)), value)
+        # Three bits apart, in different bands
+        self.assertEqual(fingerprints.find_near_duplicate("alice", value ^ 0b1 ^ 1 << 20 ^ 1 << 40),
+                         fingerprints.NEAR_DUPLICATE_TEXT)
+        # Four bits apart in one band: the other three bands match, but it is too far
+        self.assertIsNone(fingerprints.find_near_duplicate("alice", value ^ 0b1111))
+        # One bit apart in every band: no band matches, so it is not even compared
+        self.assertIsNone(fingerprints.find_near_duplicate("alice", value ^ 1 ^ 1 << 16 ^ 1 << 32 ^ 1 << 48))
+        self.assertIsNone(fingerprints.find_near_duplicate("bob", value))
+
+    def test_exact_and_near_duplicates(self):
+        self.assertIsNone(self.record("alice", "first", self.text))
+        self.assertIsNone(self.record("alice", "first", self.text))
+        self.assertIsNone(self.check("alice", "first", self.text))
+        self.assertEqual(self.check("alice", "first", "Another text"), fingerprints.DUPLICATE_TITLE)
+        self.assertEqual(self.check("alice", "second", self.text), fingerprints.DUPLICATE_TEXT)
+        # The same words with other punctuation and case
+        self.assertEqual(self.check("alice", "second", self.text.replace(".", "!").lower()),
+                         fingerprints.NEAR_DUPLICATE_TEXT)
+        self.assertIsNone(self.check("alice", "second", "Another text"))
+        self.assertIsNone(self.check("bob", "first", self.text))
+        self.assertEqual(DocumentFingerprint.objects.count(), 1)
+
+    def test_anonymous_texts_are_never_recorded(self):
+        self.assertIsNone(self.record(None, "first", self.text))
+        self.assertFalse(DocumentFingerprint.objects.exists())
+
+    def test_only_processed_texts_of_the_signed_in_user_are_recorded(self):
+        # The username the request names is not who submits it
+        result = tasks.count_and_check_payment.apply(("alice", "English", "first", self.text, 4)).get()
+        self.assertEqual(result["status"], "no_payment_required")
+        result = tasks.count_and_check_payment.apply(
+            ("alice", "English", "first", self.text, 4), {"quota_user": "bob"}
+        ).get()
+        self.assertEqual(result["status"], "no_payment_required")
+        self.assertFalse(DocumentFingerprint.objects.exists())
+
+        kwargs = {"text": self.text, "user_level": 4, "language_name": "English", "quota_user": "bob", "title": "first"}
+        result = tasks.process_counted_text.apply((result,), kwargs).get()
+        self.assertEqual(result["processed"]["status"], "success")
+        self.assertEqual(list(DocumentFingerprint.objects.values_list("username", "title")), [("bob", "first")])
+
+        result = tasks.count_and_check_payment.apply(
+            ("bob", "English", "first", "Another text.", 4), {"quota_user": "bob"}
+        ).get()
+        self.assertEqual(result, {"message": fingerprints.DUPLICATE_TITLE, "status": "duplicate"})
+        result = tasks.count_and_check_payment.apply(("bob", "English", "first", "Another text.", 4)).get()
+        self.assertEqual(result["status"], "no_payment_required")
+
+
+class RequestLevelTests(TestCase):
+    def test_anonymous_requests_get_the_default_level(self):
+        with self.settings(ENTITLEMENT_DEFAULT_LEVEL=1):
+            self.assertEqual(views.request_level(AnonymousUser()), 1)
+
+        # The level the request sends is ignored: at level 4 no payment would be required
+        response = self.client.post("/api/matcher/", {"level": 4, "language": "English", "text": "One. Two. Three."},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["status"], "payment_required")
+
+    def test_signed_in_users_get_the_level_of_their_subscriptions(self):
+        user = get_user_model().objects.create_user("alice")
+        with mock.patch.object(views, "resolve_level", return_value=3) as resolve_level:
+            self.assertEqual(views.request_level(user), 3)
+        resolve_level.assert_called_once_with(user)
+
+
+class BulkMatcherTests(TestCase):
+    url = "/api/matcher/bulk/"
+    documents = [
+        ["English", "first", "One. Two. Three."],
+        ["English", "second", "One sentence only"],
+        ["English", "third", "One. Two. Three."],
+    ]
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_documents_are_counted_and_priced_in_one_task(self):
+        result = tasks.count_and_check_payment_bulk.apply(("alice", 1, self.documents)).get()
+        self.assertEqual(result["status"], "success")
+        self.assertEqual([(item["title"], item["status"]) for item in result["results"]],
+                         [("first", "no_payment_required"), ("second", "no_payment_required"),
+                          ("third", "no_payment_required")])
+        self.assertEqual(result["total_sentence_count"], 7)
+
+        # Nothing is included at level 0
+        result = tasks.count_and_check_payment_bulk.apply(("alice", 0, self.documents)).get()
+        self.assertEqual([item["status"] for item in result["results"]], ["payment_required"] * 3)
+        for item, sentence_count in zip(result["results"], [3, 1, 3]):
+            self.assertAlmostEqual(item["sentence_count"], sentence_count * tasks.PRICE_MULTIPLIER)
+        self.assertEqual(result["total_sentence_count"], 7)
+
+    def test_view_prices_every_document(self):
+        documents = [{"language": language, "title": title, "text": text} for language, title, text in self.documents]
+        self.addCleanup(setattr, app.conf, "task_always_eager", app.conf.task_always_eager)
+        app.conf.task_always_eager = True
+        response = self.client.post(self.url, {"documents": documents}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["status"], "payment_required")
+        self.assertEqual([(item["title"], Decimal(str(item["amount"]))) for item in data["results"]],
+                         [("first", Decimal("0.0078")), ("second", Decimal("0.0026")), ("third", Decimal("0.0078"))])
+        self.assertEqual(Decimal(str(data["amount"])), Decimal("0.0182"))
+
+        response = self.client.post(self.url, {"documents": []}, content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+
+class AdaptiveDispatcherTests(SimpleTestCase):
+    def dispatcher(self, **kwargs):
+        task = mock.Mock()
+        task.name = "task"
+        return dispatch.AdaptiveDispatcher(task, **dict(dict(max_inline_size=1000, max_inline_seconds=0.01), **kwargs))
+
+    def test_large_inputs_go_to_celery(self):
+        dispatcher = self.dispatcher()
+        self.assertEqual(dispatcher.choose(1000), dispatch.INLINE)
+        self.assertEqual(dispatcher.choose(1001), dispatch.CELERY)
+
+    def test_inputs_estimated_to_be_slow_go_to_celery(self):
+        dispatcher = self.dispatcher(warmup=1, smoothing=0.5)
+        self.assertIsNone(dispatcher.estimate(100))
+        # The first run warms up the process and is not measured
+        dispatcher._record_inline(100, 1.0)
+        self.assertIsNone(dispatcher.estimate(100))
+
+        # 1 ms plus 10 us per unit
+        for size in (100, 300, 100, 300, 100, 300, 100, 300):
+            dispatcher._record_inline(size, 0.001 + 0.00001 * size)
+        self.assertAlmostEqual(dispatcher.estimate(0), 0.001)
+        self.assertAlmostEqual(dispatcher.estimate(500), 0.006)
+        self.assertEqual(dispatcher.choose(800), dispatch.INLINE)
+        self.assertEqual(dispatcher.choose(1000), dispatch.CELERY)
+
+    def test_slow_estimates_are_explored_again(self):
+        dispatcher = self.dispatcher(warmup=0, explore_every=3)
+        dispatcher._record_inline(10, 1.0)
+        self.assertEqual([dispatcher.choose(10) for _ in range(3)], [dispatch.CELERY, dispatch.CELERY, dispatch.INLINE])
+        dispatcher._record_inline(10, 0.001)
+        self.assertEqual(dispatcher.choose(10), dispatch.CELERY)
+
+    def test_metrics_count_every_path(self):
+        dispatcher = self.dispatcher()
+        self.assertEqual(dispatcher.dispatch(10, "text")[0], dispatch.INLINE)
+        dispatcher.task.apply.assert_called_once_with(("text",), {})
+        self.assertEqual(dispatcher.dispatch(2000, "text")[0], dispatch.CELERY)
+        dispatcher.task.delay.assert_called_once_with("text")
+        dispatcher.record_cached()
+
+        metrics = dispatcher.metrics()
+        self.assertEqual((metrics["inline"], metrics["celery"], metrics["cache"]), (1, 1, 1))
+        self.assertGreater(metrics["inline_seconds"], 0)
+
+
+class DispatchMatcherTests(TestCase):
+    url = "/api/matcher/dispatch/metrics/"
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_cached_counts_are_dispatched_without_counting(self):
+        text = "One. Two."
+        tasks.cached_count_sentences([(fingerprints.content_hash(text), text, "English")])
+        cached = dispatch.count_dispatcher.metrics()["cache"]
+        with mock.patch.object(dispatch.count_dispatcher, "dispatch") as count:
+            path, result = dispatch.dispatch_matcher(None, "English", None, text, 0)
+        count.assert_not_called()
+        self.assertEqual(path, dispatch.CACHED)
+        self.assertEqual(result.get()["status"], "payment_required")
+        self.assertEqual(dispatch.count_dispatcher.metrics()["cache"], cached + 1)
+
+    def test_metrics_are_only_shown_to_staff(self):
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.client.force_login(get_user_model().objects.create_user("admin", is_staff=True))
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json()), {"inline", "celery", "cache", "inline_seconds",
+                                                "estimated_seconds_at_max_size", "pid"})
+
+
+@override_settings(MATCHER_RESULT_TIMEOUT=0.01)
+class MatcherResultTimeoutTests(TestCase):
+    body = {"language": "English", "text": "One. Two."}
+    pending = {"job_id": "job-1", "status": "pending", "status_url": "/api/matcher/jobs/job-1/"}
+
+    def test_stuck_jobs_are_handed_over_to_the_client(self):
+        job = mock.Mock(id="job-1")
+        job.get.side_effect = TimeoutError
+        with mock.patch.object(views, "dispatch_matcher", return_value=(dispatch.CELERY, job)):
+            response = self.client.post("/api/matcher/", self.body, content_type="application/json")
+        job.get.assert_called_once_with(timeout=0.01)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json(), self.pending)
+        self.assertEqual(response.headers["Location"], self.pending["status_url"])
+
+    async def test_stuck_jobs_are_handed_over_to_the_client_by_the_async_view(self):
+        job = mock.Mock(id="job-1")
+        job.ready.return_value = False
+        with mock.patch.object(views, "dispatch_matcher", return_value=(dispatch.CELERY, job)):
+            response = await self.async_client.post("/api/matcher/async/", self.body, content_type="application/json")
+        job.get.assert_not_called()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json(), self.pending)
+
+    def test_stuck_bulk_requests_time_out(self):
+        job = mock.Mock(id="job-1")
+        job.get.side_effect = TimeoutError
+        documents = [{"language": "English", "text": "One. Two."}]
+        with mock.patch.object(views.count_and_check_payment_bulk, "apply_async", return_value=job):
+            response = self.client.post("/api/matcher/bulk/", {"documents": documents}, content_type="application/json")
+        self.assertEqual(response.status_code, 504)
+
+
+class MatcherJobTests(TestCase):
+    url = "/api/matcher/jobs/job-1/"
+
+    def get(self, **job):
+        with mock.patch.object(views.process_counted_text, "AsyncResult", return_value=mock.Mock(**job)) as result:
+            response = self.client.get(self.url)
+        result.assert_called_once_with("job-1")
+        return response
+
+    def test_async_mode_returns_the_job_right_away(self):
+        with mock.patch.object(views, "matcher_workflow") as workflow:
+            workflow.return_value.apply_async.return_value = mock.Mock(id="job-1")
+            response = self.client.post("/api/matcher/", {"language": "English", "text": "One.", "mode": "async"},
+                                        content_type="application/json")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json(), {"job_id": "job-1", "status": "pending", "status_url": self.url})
+        self.assertEqual(response.headers["Location"], self.url)
+
+    def test_running_jobs_are_pending(self):
+        response = self.get(**{"ready.return_value": False})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json(), {"job_id": "job-1", "status": "pending"})
+
+    def test_finished_jobs_answer_like_the_matcher(self):
+        response = self.get(**{"ready.return_value": True, "successful.return_value": True,
+                               "result": tasks.payment_result(True, 2 * tasks.PRICE_MULTIPLIER)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["status"], "payment_required")
+        amount = Decimal(str(response.json()["amount"]))
+        self.assertEqual(amount, views.calculate_pay_amount(2 * tasks.PRICE_MULTIPLIER))
+
+        response = self.get(**{"ready.return_value": True, "successful.return_value": True,
+                               "result": {"message": fingerprints.DUPLICATE_TITLE, "status": "duplicate"}})
+        self.assertEqual(response.status_code, 409)
+
+    def test_failed_jobs_are_errors(self):
+        response = self.get(**{"ready.return_value": True, "successful.return_value": False})
+        self.assertEqual(response.status_code, 500)
+
+
+class SentenceCountCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_texts_are_counted_once_per_language(self):
+        text = "One. Two, three!"
+        text_hash = fingerprints.content_hash(text)
+        self.assertIsNone(tasks.get_cached_sentence_count(text_hash, "English"))
+
+        with mock.patch.object(tasks, "count_sentences", wraps=tasks.count_sentences) as count_sentences:
+            documents = [(text_hash, text, "English"), (text_hash, text, "English"), (text_hash, text, "German")]
+            self.assertEqual(tasks.cached_count_sentences(documents), [3, 3, 2])
+            self.assertEqual(count_sentences.call_count, 2)
+
+            # Cached texts are not read again
+            self.assertEqual(tasks.cached_count_sentences([(text_hash, iter(()), "English")]), [3])
+            self.assertEqual(count_sentences.call_count, 2)
+        self.assertEqual(tasks.get_cached_sentence_count(text_hash, "English"), 3)
+        self.assertEqual(tasks.get_cached_sentence_count(text_hash, "German"), 2)
+
+    def test_cache_outage_counts_the_text(self):
+        text = "One. Two."
+        with mock.patch.object(tasks.cache, "get_many", side_effect=ConnectionError), \
+                mock.patch.object(tasks.cache, "set_many", side_effect=ConnectionError):
+            self.assertEqual(tasks.cached_count_sentences([(fingerprints.content_hash(text), text, "English")]), [2])
+            self.assertIsNone(tasks.get_cached_sentence_count(fingerprints.content_hash(text), "English"))
+
+
+class BlobTests(SimpleTestCase):
+    def setUp(self):
+        blob_root = tempfile.TemporaryDirectory()
+        self.addCleanup(blob_root.cleanup)
+        self.blob_root = blob_root.name
+        settings = override_settings(MATCHER_BLOB_ROOT=blob_root.name, MATCHER_BLOB_MIN_SIZE=10)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_texts_are_stored_by_content(self):
+        text = "naïve café " * 1000
+        key, size = blobs.store_text(text)
+        self.assertEqual(key, fingerprints.content_hash(text))
+        self.assertEqual((size, blobs.blob_size(key)), (len(text.encode()), len(text.encode())))
+        self.assertEqual(blobs.store_text(text), (key, size))
+
+        # Chunks never split a character
+        chunks = list(blobs.iter_text(key, chunk_size=7))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual("".join(chunks), text)
+
+    def test_uploads_must_be_utf8_text(self):
+        upload = SimpleUploadedFile("text.txt", "Überall.".encode())
+        key, _ = blobs.store_upload(upload)
+        self.assertEqual("".join(blobs.iter_text(key)), "Überall.")
+
+        with self.assertRaises(blobs.InvalidBlob):
+            blobs.store_upload(SimpleUploadedFile("text.txt", "Überall.".encode("latin-1")))
+        # Nothing but the first blob was written
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(self.blob_root)), 1)
+
+    def test_old_blobs_are_purged(self):
+        old, _ = blobs.store_text("old text")
+        new, _ = blobs.store_text("new text")
+        day_ago = time.time() - 24 * 60 * 60
+        os.utime(blobs.blob_path(old), (day_ago, day_ago))
+
+        self.assertEqual(blobs.purge_blobs(60 * 60), 1)
+        self.assertFalse(os.path.exists(blobs.blob_path(old)))
+        self.assertEqual("".join(blobs.iter_text(new)), "new text")
+
+    def test_only_long_texts_and_uploads_are_claim_checked(self):
+        self.assertEqual(views.claim_check({"text": "Short."}), ("Short.", None))
+
+        text = "A longer text."
+        self.assertEqual(views.claim_check({"text": text}), (None, fingerprints.content_hash(text)))
+        upload = SimpleUploadedFile("text.txt", b"Short.")
+        self.assertEqual(views.claim_check({"text": "", "file": upload}), (None, fingerprints.content_hash("Short.")))
+
+
+class SerializationTests(SimpleTestCase):
+    def test_payloads_round_trip(self):
+        result = {
+            "status": "processed",
+            "sentence_count": 3,
+            "amount": Decimal("1.55"),
+            "matches": [[0, 4, 9], [2, 10, 14]],
+            "counts": {0: 1, 2: 1},
+            "blob": b"\x00\xff",
+            "created": datetime.datetime(2024, 1, 1, 12, 30, tzinfo=datetime.timezone.utc),
+            "expires": datetime.datetime(2024, 1, 2, 12, 30),
+            "day": datetime.date(2024, 1, 1),
+            "job_id": uuid.UUID(int=1),
+            "shards": [{"start": 0, "end": 100, "matches": [[0, 4, 9]] * 200}],
+        }
+        for compress_min_size in (None, 0):
+            data = serialization.pack(result, compress_min_size)
+            self.assertEqual(data[:1], serialization.PLAIN if compress_min_size is None else serialization.ZLIB)
+            self.assertEqual(serialization.unpack(data), result)
+
+        # Registered with Kombu, so Celery encodes messages with it
+        content_type, encoding, data = kombu.serialization.dumps([[result], {}, {}], serializer=serialization.NAME)
+        self.assertEqual(kombu.serialization.loads(data, content_type, encoding), [[result], {}, {}])
+
+    def test_unknown_types_are_refused(self):
+        with self.assertRaises(TypeError):
+            serialization.pack({"value": object()})
+        with self.assertRaises(ValueError):
+            serialization.unpack(b"\x02")
@@ -1,8 +1,12 @@
 from django.urls import path
-from .views import MatcherView
+from .views import MatcherView, AsyncMatcherView, BulkMatcherView, MatcherJobView, MatcherDispatchMetricsView
 
 app_name = 'matcher'
 
 urlpatterns = [
-    path('matcher/', MatcherView.as_view(),name="matcher")
+    path('matcher/', MatcherView.as_view(),name="matcher"),
+    path('matcher/async/', AsyncMatcherView.as_view(), name="matcherAsync"),
+    path('matcher/bulk/', BulkMatcherView.as_view(), name="matcherBulk"),
+    path('matcher/jobs/<str:job_id>/', MatcherJobView.as_view(), name="matcherJob"),
+    path('matcher/dispatch/metrics/', MatcherDispatchMetricsView.as_view(), name="matcherDispatchMetrics"),
 ]
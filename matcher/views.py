@@ -1,11 +1,96 @@
+import os
+
+from asgiref.sync import sync_to_async
+from celery.exceptions import TimeoutError
+from django.conf import settings
+from django.urls import reverse
+from checkout.entitlements import resolve_level
+from core.async_views import AsyncAPIView, await_result
 from rest_framework import permissions, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from .tasks import count_and_check_payment, process_text
-from .serializers import MatcherSerializer
+from .blobs import InvalidBlob, store_text, store_upload
+from .dispatch import count_dispatcher, dispatch_matcher
+from .tasks import count_and_check_payment_bulk, level_options, matcher_workflow, process_counted_text
+from .serializers import MatcherSerializer, BulkMatcherSerializer
 
 from decimal import Decimal, ROUND_HALF_UP
 
+# Price per sentence
+PER_SENTENCE = Decimal('0.05')
+
+
+def calculate_pay_amount(sentence_count):
+    # Calculate payment amount and format it to 4 decimal places
+    return (Decimal(sentence_count) * PER_SENTENCE).quantize(Decimal("0.0001"), rounding=ROUND_HALF_UP)
+
+
+def request_level(user):
+    """
+    The level to price a request at: a signed-in user's level is resolved from
+    their subscriptions, anonymous requests get ENTITLEMENT_DEFAULT_LEVEL.
+    """
+    if user.is_authenticated:
+        return resolve_level(user)
+    return settings.ENTITLEMENT_DEFAULT_LEVEL
+
+
+def quota_user(user):
+    # Sentence allowances are only kept for signed-in users, never for a username the request names
+    return user.get_username() if user.is_authenticated else None
+
+
+def job_accepted(job):
+    """The 202 response body, status and headers of a matcher_workflow job the client polls MatcherJobView for."""
+    status_url = reverse("matcher:matcherJob", args=[job.id])
+    return (
+        {"job_id": job.id, "status": "pending", "status_url": status_url},
+        status.HTTP_202_ACCEPTED,
+        {"Location": status_url},
+    )
+
+
+def claim_check(validated_data):
+    """
+    Return (text, blob key) for the text of a matcher request. Uploaded files,
+    and texts longer than MATCHER_BLOB_MIN_SIZE characters, are stored as
+    blobs and only their key is passed on; shorter texts are passed inline.
+    """
+    upload = validated_data.get("file", None)
+    if upload is not None:
+        return None, store_upload(upload)[0]
+
+    text = validated_data["text"]
+    if len(text) > settings.MATCHER_BLOB_MIN_SIZE:
+        return None, store_text(text)[0]
+    return text, None
+
+
+def matcher_result(data):
+    """
+    Build the MatcherView response body and HTTP status from a
+    matcher_workflow result.
+    """
+    processed_data = data.get("processed")
+    # Handle different processing results
+    if data["status"] == "payment_required":
+        pay_amount = calculate_pay_amount(data["sentence_count"])
+
+        return {
+            "message": f"Your text is too long, you need to pay ${pay_amount} to continue with the process",
+            "amount": pay_amount,
+            "status": "payment_required",
+        }, status.HTTP_200_OK
+    elif data["status"] == "no_payment_required" and processed_data is not None:
+        return {
+            "message": processed_data["message"],
+            "status": "no_payment_required",
+            "data": "Your data"
+        }, status.HTTP_200_OK
+    elif data["status"] == "duplicate":
+        return {"error": data["message"], "status": "duplicate"}, status.HTTP_409_CONFLICT
+    return {"message": "The returned result is invalid"}, status.HTTP_500_INTERNAL_SERVER_ERROR
+
 
 class MatcherView(APIView):
     """
@@ -18,14 +103,27 @@ class MatcherView(APIView):
     - post: Processes a POST request containing data for matching and processing.
 
     Fields (from MatcherSerializer):
-    - username (optional): The username associated with the text (default: None).
-    - level (required): The level of the user, must be an integer greater than or equal to 0.
+    - username (optional): The username associated with the text (default: None). Sentence allowances
+      and duplicate checks are kept for signed-in users only, whatever the username.
     - language (required): The language associated with the text, cannot be blank.
     - title (optional): The title associated with the text, maximum length of 50 characters (default: None).
-    - text (required): The text to be processed, cannot be blank.
+    - text (required unless file is given): The text to be processed, cannot be blank. A signed-in user's
+      text that duplicates another text they had processed, or reuses one of its titles, is rejected with
+      409 Conflict.
+    - file (required unless text is given): The text to be processed as an uploaded UTF-8 text file,
+      for large texts. Send the request as multipart/form-data.
+    - mode (optional): "sync" waits for the result (default), for up to MATCHER_RESULT_TIMEOUT seconds,
+      then returns 202 like async mode. "async" returns 202 with a job id right away; poll MatcherJobView
+      for the result.
+
+    Texts of signed-in users are priced at the level of their subscriptions (see checkout.entitlements),
+    anonymous ones at ENTITLEMENT_DEFAULT_LEVEL.
+
+    In sync mode small texts are counted inline instead of on Celery, and texts counted before are
+    priced from the cached count (see matcher.dispatch). The X-Dispatch-Path response header says
+    which path the request took: inline, celery or cache. MatcherDispatchMetricsView counts the paths taken.
     """
     permission_classes = [permissions.AllowAny]
-    per_sentence = Decimal('0.05')  # Price per sentence
 
     def post(self, request, format=None):
         """
@@ -44,48 +142,267 @@ class MatcherView(APIView):
         if serializer.is_valid():
             # Extract validated data from serializer
             username = serializer.validated_data.get("username", None)
-            level = serializer.validated_data.get("level", None)
+            level = request_level(request.user)
+            language = serializer.validated_data.get("language", None)
+            title = serializer.validated_data.get("title", None)
+
+            # Store large texts as blobs, so only a reference goes through Celery
+            try:
+                text, blob_key = claim_check(serializer.validated_data)
+            except InvalidBlob as e:
+                return Response({"error": {"file": [str(e)]}}, status=status.HTTP_400_BAD_REQUEST)
+
+            if serializer.validated_data["mode"] == "async":
+                # Run the whole pipeline as a background job and return right away
+                job = matcher_workflow(
+                    username, language, title, text, level, blob_key=blob_key, quota_user=quota_user(request.user)
+                ).apply_async()
+                result, result_status, headers = job_accepted(job)
+                return Response(result, status=result_status, headers=headers)
+
+            # Count inline for small texts, otherwise count and process in one Celery chain
+            dispatch_path, response = dispatch_matcher(
+                username, language, title, text, level, blob_key=blob_key, quota_user=quota_user(request.user)
+            )
+
+            # Wait for the workflow to complete and retrieve the result, or hand it over as a job
+            try:
+                data = response.get(timeout=settings.MATCHER_RESULT_TIMEOUT)
+            except TimeoutError:
+                result, result_status, headers = job_accepted(response)
+                return Response(result, status=result_status,
+                                headers=dict(headers, **{"X-Dispatch-Path": dispatch_path}))
+
+            result, result_status = matcher_result(data)
+
+            # Return the processed data as HTTP response
+            return Response(result, status=result_status, headers={"X-Dispatch-Path": dispatch_path})
+        else:
+            # Return validation errors if serializer is invalid
+            return Response({"error": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class AsyncMatcherView(AsyncAPIView):
+    """
+    Async version of MatcherView, for the ASGI server.
+
+    Celery results are awaited without holding a thread, so a single process
+    can serve many requests that are waiting on the workers. Takes the same
+    fields and returns the same responses as MatcherView.
+
+    Methods:
+    - post: Processes a POST request containing data for matching and processing.
+    """
+
+    async def post(self, request):
+        """
+        Process a POST request containing data for matching and processing.
+
+        Parameters:
+        - request: HTTP request object
+
+        Returns:
+        - JsonResponse: HTTP response containing the result of processing.
+        """
+        request_data = await self.parse_data(request)
+        if request_data is None:
+            return self.invalid_body()
+
+        # Deserialize request data
+        serializer = MatcherSerializer(data=request_data)
+
+        if serializer.is_valid():
+            # Extract validated data from serializer
+            username = serializer.validated_data.get("username", None)
+            user = await request.auser()
+            level = await sync_to_async(request_level, thread_sensitive=False)(user)
             language = serializer.validated_data.get("language", None)
             title = serializer.validated_data.get("title", None)
-            text = serializer.validated_data.get("text", None)
-
-            # Asynchronously process text using Celery task
-            response = count_and_check_payment.delay(username, language, title, text, level)
-
-            # Wait for the task to complete and retrieve the result
-            data = response.get()
-
-            # Handle different processing results
-            if data["status"] == "payment_required":
-                # Calculate payment amount and format it to 4 decimal places
-                pay_amount = (Decimal(data["sentence_count"]) * self.per_sentence).quantize(
-                    Decimal("0.0001"),
-                    rounding=ROUND_HALF_UP
-                    )
-
-                result = {
-                    "message": f"Your text is too long, you need to pay ${pay_amount} to continue with the process",
-                    "amount": pay_amount,
-                    "status": "payment_required",
-                }
-            elif data["status"] == "no_payment_required":
-                # Asynchronously process text
-                processed_object = process_text.delay()
-                processed_data = processed_object.get()
-
-                result = {
-                    "message": processed_data["message"],
-                    "status": "no_payment_required",
-                    "data": "Your data"
-                }
-            else:
+
+            # Store large texts as blobs, so only a reference goes through Celery
+            try:
+                text, blob_key = await sync_to_async(claim_check, thread_sensitive=False)(serializer.validated_data)
+            except InvalidBlob as e:
+                return self.response({"error": {"file": [str(e)]}}, status=status.HTTP_400_BAD_REQUEST)
+
+            if serializer.validated_data["mode"] == "async":
+                # Run the whole pipeline as a background job and return right away. Publishing
+                # the job talks to the broker, so it is sent from a worker thread.
+                workflow = matcher_workflow(
+                    username, language, title, text, level, blob_key=blob_key, quota_user=quota_user(user)
+                )
+                job = await sync_to_async(workflow.apply_async, thread_sensitive=False)()
+                result, result_status, headers = job_accepted(job)
+                return self.response(result, status=result_status, headers=headers)
+
+            # Count inline for small texts, otherwise count and process in one Celery chain
+            dispatch_path, response = await sync_to_async(dispatch_matcher, thread_sensitive=False)(
+                username, language, title, text, level, blob_key=blob_key, quota_user=quota_user(user)
+            )
+
+            # Wait for the workflow without blocking the event loop, or hand it over as a job
+            try:
+                data = await await_result(response, timeout=settings.MATCHER_RESULT_TIMEOUT)
+            except TimeoutError:
+                result, result_status, headers = job_accepted(response)
+                return self.response(result, status=result_status,
+                                     headers=dict(headers, **{"X-Dispatch-Path": dispatch_path}))
+
+            result, result_status = matcher_result(data)
+
+            # Return the processed data as HTTP response
+            return self.response(result, status=result_status, headers={"X-Dispatch-Path": dispatch_path})
+        else:
+            # Return validation errors if serializer is invalid
+            return self.response({"error": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class BulkMatcherView(APIView):
+    """
+    API endpoint for pricing many documents in a single request.
+
+    All documents are counted and priced by one Celery task, so a batch costs
+    one broker and result-backend round trip instead of one per document.
+
+    Permissions:
+    - AllowAny: Allows unrestricted access to this endpoint.
+
+    Methods:
+    - post: Counts and prices every document in the request. Returns 504 if the batch is not priced
+      within MATCHER_RESULT_TIMEOUT seconds.
+
+    Fields (from BulkMatcherSerializer):
+    - username (optional): The username associated with the documents (default: None). Sentence
+      allowances are kept for signed-in users only, whatever the username.
+    - documents (required): List of documents, each with language (required), title (optional) and text (required).
+
+    Documents of signed-in users are priced at the level of their subscriptions (see checkout.entitlements),
+    anonymous ones at ENTITLEMENT_DEFAULT_LEVEL.
+    """
+    permission_classes = [permissions.AllowAny]
+
+    def post(self, request, format=None):
+        """
+        Process a POST request containing a batch of documents to price.
+
+        Parameters:
+        - request: HTTP request object
+        - format: Optional format for response data (default: None)
+
+        Returns:
+        - Response: HTTP response with the result for every document and the total amount.
+        """
+        # Deserialize request data
+        serializer = BulkMatcherSerializer(data=request.data)
+
+        if serializer.is_valid():
+            # Extract validated data from serializer
+            username = serializer.validated_data.get("username", None)
+            level = request_level(request.user)
+            documents = [
+                (document["language"], document.get("title", None), document["text"])
+                for document in serializer.validated_data["documents"]
+            ]
+
+            # Count and price the whole batch in one Celery task
+            job = count_and_check_payment_bulk.apply_async(
+                (username, level, documents), {"quota_user": quota_user(request.user)}, **level_options(level)
+            )
+            try:
+                data = job.get(timeout=settings.MATCHER_RESULT_TIMEOUT)
+            except TimeoutError:
+                return Response(
+                    {"message": "The documents could not be priced in time, please try again later."},
+                    status=status.HTTP_504_GATEWAY_TIMEOUT
+                )
+
+            if data["status"] != "success":
                 return Response(
                     {"message": "The returned result is invalid"},
                     status=status.HTTP_500_INTERNAL_SERVER_ERROR
                 )
 
-            # Return the processed data as HTTP response
-            return Response(result, status=status.HTTP_200_OK)
+            results = []
+            for item in data["results"]:
+                result = {"title": item["title"], "status": item["status"], "message": item["message"]}
+                if item["status"] == "payment_required":
+                    result["amount"] = calculate_pay_amount(item["sentence_count"])
+                results.append(result)
+
+            total_amount = sum((result["amount"] for result in results if "amount" in result), Decimal("0.0000"))
+            return Response(
+                {
+                    "results": results,
+                    "amount": total_amount,
+                    "status": "payment_required" if total_amount else "no_payment_required",
+                },
+                status=status.HTTP_200_OK
+            )
         else:
             # Return validation errors if serializer is invalid
             return Response({"error": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class MatcherJobView(APIView):
+    """
+    API endpoint for the status and result of a MatcherView job.
+
+    The job state is read from the Celery result backend. Celery reports
+    unknown job ids as pending, so an expired or mistyped id stays pending.
+
+    Permissions:
+    - AllowAny: Allows unrestricted access to this endpoint.
+
+    Methods:
+    - get: Returns 202 while the job is running and the MatcherView result once it has finished.
+    """
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request, job_id, format=None):
+        """
+        Process a GET request for the state of a job.
+
+        Parameters:
+        - request: HTTP request object
+        - job_id: Id returned by MatcherView in async mode
+        - format: Optional format for response data (default: None)
+
+        Returns:
+        - Response: HTTP response with the job state, or the result of processing.
+        """
+        # The job id is the id of the last task of the matcher_workflow chain
+        job = process_counted_text.AsyncResult(job_id)
+
+        if not job.ready():
+            return Response({"job_id": job_id, "status": "pending"}, status=status.HTTP_202_ACCEPTED)
+
+        if job.successful():
+            data = job.result
+            result, result_status = matcher_result(data)
+            return Response(result, status=result_status)
+
+        return Response(
+            {"message": "The returned result is invalid"},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+
+class MatcherDispatchMetricsView(APIView):
+    """
+    API endpoint for the metrics of the adaptive dispatcher of MatcherView.
+
+    The dispatcher decides, in each server process, whether a text is counted
+    inline, on Celery or from the sentence count cache (see matcher.dispatch),
+    so the metrics are those of the process that answers the request.
+
+    Permissions:
+    - IsAdminUser: Only staff users may read the metrics.
+
+    Methods:
+    - get: Returns the number of calls by path, the seconds spent counting
+      inline and the estimated inline cost of a text of MATCHER_INLINE_MAX_CHARS.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, format=None):
+        return Response(dict(count_dispatcher.metrics(), pid=os.getpid()), status=status.HTTP_200_OK)